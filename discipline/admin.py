@@ -3,8 +3,10 @@ from django.contrib import admin
 from models import *
 from django import forms
 from django.contrib import messages
+from django.contrib.admin.views.main import ChangeList
 from django.views.generic.simple import redirect_to
 from django.core import urlresolvers
+from discipline.instrumentation import instrumented
 
 class DisciplinedModelAdmin(admin.ModelAdmin):
     readonly_fields = ("uid",)
@@ -31,6 +33,14 @@ class DisciplinedModelAdmin(admin.ModelAdmin):
         editor = Editor.objects.get(user=request.user)
         editor.save_object(obj)
 
+class ActionChangeList(ChangeList):
+
+    @instrumented("ActionChangeList.get_results")
+    def get_results(self, request):
+        super(ActionChangeList, self).get_results(request)
+        # Every row needs the history of its object, fetch it all at once
+        self.result_list = Action.prefetch(self.result_list)
+
 class ActionAdmin(admin.ModelAdmin):
     
     list_display = (
@@ -48,24 +58,22 @@ class ActionAdmin(admin.ModelAdmin):
         "_details",
         "_status",
     )
-    exclude = ("reverted","action_type","object_uid")
-    list_filter = ("editor",)
+    exclude = ("reverted","action_type","object_uid","content_type")
+    list_filter = ("editor","content_type")
     actions = ("undo_actions",)
     search_fields = ("=object_uid",)
     list_select_related = True
     list_per_page = 50
     
+    def get_changelist(self, request, **kwargs):
+        return ActionChangeList
+
     def commit_time(self, obj):
         return obj.when.strftime('%d %b %Y %H:%M')
 
     def undo_actions(self, request, queryset):
         editor = Editor.objects.get(user=request.user)
-        actions = list(queryset.order_by("-when"))
-        errors = []
-        for action in actions:
-            if action.is_revertible: editor.undo_action(action)
-            else: errors.extend(action.undo_errors)
-        for error in errors:
+        for error in editor.undo_actions(queryset):
             messages.error(request, error)
     
     # You cannot delete commits
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""In-process caches of things that never change once written."""
+
+import datetime
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+
+class LRUCache(object):
+
+    """A mapping of at most maxsize items that forgets the least recently
+    used one when it is full. Safe to share between threads.
+
+    Attributes:
+    hits -- The number of successful lookups.
+    misses -- The number of lookups of missing keys.
+
+    """
+
+    # Positions in the links of the list, from the least recently used
+    # to the most recently used
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, maxsize=1000):
+        self._maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __get_maxsize(self):
+        return self._maxsize
+
+    maxsize = property(__get_maxsize)
+
+    def clear(self):
+        """Forget every item and reset the counters."""
+        self.lock.acquire()
+        try:
+            self.links = {}
+            # The root of the circular list
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, key, default=None):
+        """Return the item of the given key, or default if it isn't cached."""
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Move it to the most recently used end
+            link[self.PREV][self.NEXT] = link[self.NEXT]
+            link[self.NEXT][self.PREV] = link[self.PREV]
+            last = self.root[self.PREV]
+            last[self.NEXT] = self.root[self.PREV] = link
+            link[self.PREV] = last
+            link[self.NEXT] = self.root
+            return link[self.VALUE]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """Cache the given item, forgetting the least recently used one if
+        there are too many."""
+        maxsize = self.maxsize
+        if maxsize <= 0: return
+        self.lock.acquire()
+        try:
+            if key in self.links:
+                self.links[key][self.VALUE] = value
+                return
+            while len(self.links) >= maxsize:
+                oldest = self.root[self.NEXT]
+                self.root[self.NEXT] = oldest[self.NEXT]
+                oldest[self.NEXT][self.PREV] = self.root
+                del self.links[oldest[self.KEY]]
+            last = self.root[self.PREV]
+            link = [last, self.root, key, value]
+            last[self.NEXT] = self.root[self.PREV] = link
+            self.links[key] = link
+        finally:
+            self.lock.release()
+
+class ValueCache(LRUCache):
+
+    """The cache of decoded field values used by TimeMachine, keyed by the
+    id of the ModificationCommit they come from, or by what identifies the
+    Checkpoint or ObjectState that holds them. Its size is the
+    DISCIPLINE_VALUE_CACHE_SIZE setting, 10000 by default, 0 turns it off.
+    Only immutable values are cached, so they can be shared safely.
+    """
+
+    IMMUTABLE = (basestring, int, long, float, bool, Decimal,
+                 datetime.date, datetime.time, type(None))
+
+    def __get_maxsize(self):
+        return getattr(settings, "DISCIPLINE_VALUE_CACHE_SIZE", 10000)
+
+    maxsize = property(__get_maxsize)
+
+    def decode(self, key, text, decode):
+        """Return the decoded value of the given text, cached under the
+        given key. decode is the function that decodes it."""
+        if self.maxsize <= 0:
+            return decode(text)
+        cached = self.get(key)
+        # The text is kept as well, in case the id of a rolled back commit
+        # was used again
+        if cached is not None:
+            if cached[0] == text:
+                return cached[1]
+            self.lock.acquire()
+            self.hits -= 1
+            self.misses += 1
+            self.lock.release()
+        value = decode(text)
+        if isinstance(value, self.IMMUTABLE):
+            self.set(key, (text, value))
+        return value
+
+# The instance used by Discipline
+value_cache = ValueCache()
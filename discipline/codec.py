@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Encoding of the values of non-ForeignKey fields for ModificationCommit.
+
+The codec is chosen with the DISCIPLINE_VALUE_CODEC setting, the dotted
+path to a class with the methods of PickleCodec. The default is
+TypedCodec.
+"""
+
+import cPickle
+import datetime
+from decimal import Decimal
+
+from django.db.models import fields
+from django.utils.tzinfo import FixedOffset
+
+class PickleCodec(object):
+
+    """Store every value as a cPickle string, like Discipline always used
+    to."""
+
+    def encode(self, value, field=None):
+        """Return the text to store for the value of the given field."""
+        return cPickle.dumps(value)
+
+    def decode(self, text):
+        """Inverse of encode."""
+        return cPickle.loads(str(text))
+
+# The prefix of values encoded by TypedCodec. A protocol 0 pickle never
+# starts with it, so the old values can still be read.
+PREFIX = "~"
+
+class TypedCodec(PickleCodec):
+
+    """Store values as short readable text, prefixed with a character for
+    their type: "~i42", "~sHello", "~D2010-07-04". The type is chosen from
+    the class of the field, values that don't fit it are pickled.
+    Datetimes and times are stored as their isoformat(), so aware ones
+    keep their UTC offset, because not every tzinfo can be pickled.
+    """
+
+    def encode(self, value, field=None):
+        if value is None:
+            return PREFIX + "n"
+        if isinstance(field, (fields.BooleanField, fields.NullBooleanField)):
+            if isinstance(value, bool):
+                return PREFIX + (value and "b1" or "b0")
+        elif isinstance(field, fields.IntegerField):
+            if isinstance(value, (int, long)) and \
+               not isinstance(value, bool):
+                return PREFIX + "i" + str(value)
+        elif isinstance(field, fields.FloatField):
+            if isinstance(value, float):
+                return PREFIX + "f" + repr(value)
+        elif isinstance(field, fields.DecimalField):
+            if isinstance(value, Decimal):
+                return PREFIX + "d" + str(value)
+        elif isinstance(field, (fields.CharField, fields.TextField)):
+            if isinstance(value, basestring):
+                return PREFIX + "s" + value
+        elif isinstance(field, fields.DateTimeField):
+            if isinstance(value, datetime.datetime):
+                return PREFIX + "T" + value.isoformat(" ")
+        elif isinstance(field, fields.DateField):
+            if isinstance(value, datetime.date) and \
+               not isinstance(value, datetime.datetime):
+                return PREFIX + "D" + value.isoformat()
+        elif isinstance(field, fields.TimeField):
+            if isinstance(value, datetime.time):
+                return PREFIX + "t" + value.isoformat()
+        return super(TypedCodec, self).encode(value, field)
+
+    def decode(self, text):
+        if text[:1] != PREFIX:
+            return super(TypedCodec, self).decode(text)
+        decoder = _decoders.get(text[1:2])
+        if decoder is None:
+            raise ValueError("Unknown value type: %r" % text)
+        return decoder(text[2:])
+
+# Fixed positions are much faster to parse than splitting, and looking up
+# two digits at a time is much faster than int()
+_DIGITS = dict(("%02d" % i, i) for i in range(100))
+# The years most values are in, the others are parsed with int()
+_YEARS = dict(("%04d" % i, i) for i in range(1900, 2100))
+
+def _parse_rest(rest, digits=_DIGITS):
+    """Parse what isoformat() writes after the seconds, if anything: the
+    microseconds, then the UTC offset. Return both, the offset as a tzinfo
+    or None."""
+    microsecond = 0
+    tzinfo = None
+    if rest[:1] == ".":
+        microsecond = digits[rest[1:3]] * 10000 + digits[rest[3:5]] * 100 + \
+            digits[rest[5:7]]
+        rest = rest[7:]
+    if rest:
+        minutes = digits[rest[1:3]] * 60 + digits[rest[4:6]]
+        if rest[0] == "-": minutes = -minutes
+        tzinfo = FixedOffset(minutes)
+    return microsecond, tzinfo
+
+def _parse_date(value, digits=_DIGITS, years=_YEARS, date=datetime.date):
+    """Parse the output of datetime.date.isoformat()."""
+    try:
+        return date(years.get(value[0:4]) or int(value[0:4]),
+                    digits[value[5:7]], digits[value[8:10]])
+    except KeyError:
+        raise ValueError("Invalid date: %r" % value)
+
+def _parse_time(value, digits=_DIGITS):
+    """Parse the output of datetime.time.isoformat()."""
+    try:
+        microsecond, tzinfo = _parse_rest(value[8:])
+        return datetime.time(digits[value[0:2]], digits[value[3:5]],
+                             digits[value[6:8]], microsecond, tzinfo)
+    except KeyError:
+        raise ValueError("Invalid time: %r" % value)
+
+def _parse_datetime(value, digits=_DIGITS, years=_YEARS,
+                    new=datetime.datetime):
+    """Parse the output of datetime.datetime.isoformat(" ")."""
+    try:
+        # Naive values, with or without microseconds, are the usual ones
+        if len(value) == 26:
+            microsecond, tzinfo = int(value[20:26]), None
+        elif len(value) == 19:
+            microsecond, tzinfo = 0, None
+        else:
+            microsecond, tzinfo = _parse_rest(value[19:])
+        return new(years.get(value[0:4]) or int(value[0:4]),
+                   digits[value[5:7]], digits[value[8:10]],
+                   digits[value[11:13]], digits[value[14:16]],
+                   digits[value[17:19]], microsecond, tzinfo)
+    except KeyError:
+        raise ValueError("Invalid datetime: %r" % value)
+
+_decoders = {
+    "s": unicode,
+    "i": int,
+    "n": lambda value: None,
+    "b": lambda value: value == "1",
+    "f": float,
+    "d": Decimal,
+    "T": _parse_datetime,
+    "D": _parse_date,
+    "t": _parse_time,
+}
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Counting the calls, queries and time of Discipline's operations.
+
+Turned on by the DISCIPLINE_INSTRUMENTATION setting. While it is off, an
+instrumented function only costs a look at the setting and the database
+cursors aren't wrapped. While it is on, every call of one is added to
+stats and sent with the operation_finished signal.
+"""
+
+import time
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+from django.utils.functional import wraps
+
+# Sent after every instrumented call, the sender is the name of the
+# operation. Queries and db_time include those of nested operations.
+operation_finished = Signal(providing_args=["wall_time", "db_time",
+                                            "queries"])
+
+def _enabled():
+    return getattr(settings, "DISCIPLINE_INSTRUMENTATION", False)
+
+class OperationStats(object):
+
+    """The totals of every instrumented operation since the last reset.
+    Safe to share between threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self.lock.acquire()
+        try:
+            self.operations = {}
+        finally:
+            self.lock.release()
+
+    def record(self, name, wall_time, db_time, queries):
+        """Add a call of the named operation."""
+        self.lock.acquire()
+        try:
+            totals = self.operations.get(name)
+            if totals is None:
+                totals = self.operations[name] = [0, 0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += queries
+            totals[2] += db_time
+            totals[3] += wall_time
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        """Return a dict mapping the name of every operation called to a
+        dict of its calls, queries, db_time and wall_time, in seconds."""
+        self.lock.acquire()
+        try:
+            return dict((name, {
+                "calls": calls,
+                "queries": queries,
+                "db_time": db_time,
+                "wall_time": wall_time,
+            }) for name, (calls, queries, db_time, wall_time)
+              in self.operations.items())
+        finally:
+            self.lock.release()
+
+# The statistics of this process
+stats = OperationStats()
+
+# The operations running in each thread, innermost last, every one a list
+# of its queries and database time so far
+_running = threading.local()
+
+def _frames():
+    frames = getattr(_running, "frames", None)
+    if frames is None:
+        frames = _running.frames = []
+    return frames
+
+class _CountingCursor(object):
+
+    """Wraps a database cursor to add its queries and their time to the
+    running operations."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __count(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.time() - start
+            for frame in _frames():
+                frame[0] += 1
+                frame[1] += elapsed
+
+    def execute(self, sql, params=()):
+        return self.__count(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.__count(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def _install():
+    """Make the database connections of this thread count the queries of
+    running operations, once they are first needed."""
+    for connection in connections.all():
+        if getattr(connection, "_discipline_cursor", None): continue
+        original = connection.cursor
+        def cursor(original=original):
+            if not getattr(_running, "frames", None):
+                return original()
+            return _CountingCursor(original())
+        connection.cursor = cursor
+        connection._discipline_cursor = original
+    _running.installed = True
+
+def _uninstall():
+    """Give the database connections of this thread their own cursors
+    back."""
+    for connection in connections.all():
+        original = getattr(connection, "_discipline_cursor", None)
+        if not original: continue
+        connection.cursor = original
+        connection._discipline_cursor = None
+    _running.installed = False
+
+def instrumented(name):
+    """Decorate a function to record its calls as the operation with the
+    given name."""
+    def decorator(func):
+        def inner(*args, **kwargs):
+            if not _enabled():
+                if getattr(_running, "installed", False): _uninstall()
+                return func(*args, **kwargs)
+            if not getattr(_running, "installed", False): _install()
+            frames = _frames()
+            frame = [0, 0.0]
+            frames.append(frame)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall_time = time.time() - start
+                frames.pop()
+                stats.record(name, wall_time, frame[1], frame[0])
+                operation_finished.send(sender = name,
+                                        wall_time = wall_time,
+                                        db_time = frame[1],
+                                        queries = frame[0])
+        return wraps(func)(inner)
+    return decorator
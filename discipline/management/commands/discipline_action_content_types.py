@@ -0,0 +1,42 @@
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from discipline.models import Action, CreationCommit, CHUNK_SIZE, \
+    _by_action
+
+class Command(BaseCommand):
+    help = "Sets the content type of the Actions written before Discipline " \
+           "stored it, from the CreationCommits of their objects"
+
+    def handle(self, quiet=False, *args, **options):
+
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(Action._meta.db_table),
+            qn(Action._meta.get_field("content_type").column),
+            qn("id"))
+
+        actions = Action.objects.filter(content_type__isnull = True) \
+            .order_by("id").values_list("id", "object_uid")
+        last = 0
+        count = 0
+        while True:
+            chunk = list(actions.filter(id__gt = last)[:CHUNK_SIZE])
+            if not chunk: break
+            last = chunk[-1][0]
+
+            # The type of an object is that of its latest creation
+            content_types = {}
+            for uid, content_type in _by_action(CreationCommit.objects.filter(
+                    object_uid__in = list(set(uid for id, uid in chunk))),
+                    latest_first = False) \
+                    .values_list("object_uid", "content_type"):
+                content_types[uid] = content_type
+
+            updates = [(content_types[uid], id) for id, uid in chunk
+                       if uid in content_types]
+            if updates:
+                connection.cursor().executemany(sql, updates)
+                transaction.commit_unless_managed()
+            count += len(updates)
+
+        if not quiet: print "Set the content type of %d actions" % count
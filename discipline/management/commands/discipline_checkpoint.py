@@ -0,0 +1,55 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json 
+from optparse import make_option
+
+from django.conf import settings
+from django.db.models import Count
+from django.core.management.base import BaseCommand, CommandError
+from discipline.models import Action, Checkpoint, _latest_values
+
+class Command(BaseCommand):
+    help = "Creates the missing Checkpoints of existing history"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--interval", type="int", dest="interval",
+                    help="Number of Actions between Checkpoints, defaults "
+                         "to the DISCIPLINE_CHECKPOINT_INTERVAL setting"),
+    )
+
+    def handle(self, quiet=False, *args, **options):
+
+        interval = options.get("interval") or \
+            getattr(settings, "DISCIPLINE_CHECKPOINT_INTERVAL", None)
+        if not interval:
+            raise CommandError("Set DISCIPLINE_CHECKPOINT_INTERVAL or use "
+                               "--interval")
+
+        # Only objects with enough Actions can need a Checkpoint
+        uids = Action.objects.order_by().values("object_uid") \
+            .annotate(actions=Count("id")) \
+            .filter(actions__gte=interval) \
+            .values_list("object_uid", flat=True)
+
+        count = 0
+        for uid in uids.iterator():
+            existing = set(Checkpoint.objects.filter(object_uid=uid)
+                           .values_list("action", flat=True))
+            steps = Action.objects.filter(object_uid=uid) \
+                .order_by("id").values_list("id", flat=True)
+            since = 0
+            for step in steps:
+                since += 1
+                if step in existing:
+                    since = 0
+                elif since >= interval:
+                    Checkpoint.objects.create(
+                        object_uid = uid,
+                        action_id = step,
+                        state = json.dumps(_latest_values(uid, step)),
+                    )
+                    count += 1
+                    since = 0
+
+        if not quiet: print "Created %d Checkpoints" % count
@@ -0,0 +1,114 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sys
+import gzip
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from discipline.models import Action, CreationCommit, ModificationCommit, \
+    DeletionCommit, SchemaState, Editor, CHUNK_SIZE
+
+class Command(BaseCommand):
+    help = "Writes the whole history to a gzipped file of JSON lines, the " \
+           "SchemaStates and then every Action with its commits, in order"
+    args = "file"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--after", type="int", default=0,
+                    help="Only export the Actions after the one with this id"),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Give the file to write, - for the output")
+        if args[0] == "-":
+            out = gzip.GzipFile(fileobj=sys.stdout, mode="wb")
+        else:
+            out = gzip.open(args[0], "wb")
+        try:
+            count = export_history(out, options.get("after", 0))
+        finally:
+            out.close()
+        if args[0] != "-" and not options.get("quiet"):
+            print "Exported %d actions" % count
+
+def _write(out, record):
+    out.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+def _content_type(id):
+    content_type = ContentType.objects.get_for_id(id)
+    return "%s.%s" % (content_type.app_label, content_type.model)
+
+def export_history(out, after=0):
+    """Write the history after the given Action id to the file out and
+    return the number of Actions written. Everything is read CHUNK_SIZE
+    rows at a time in the order of the ids."""
+
+    states = SchemaState.objects.order_by("id")
+    last = 0
+    while True:
+        chunk = list(states.filter(id__gt = last)[:CHUNK_SIZE])
+        if not chunk: break
+        last = chunk[-1].id
+        for state in chunk:
+            _write(out, {
+                "type": "schema_state",
+                "id": state.id,
+                "when": state.when.isoformat(" "),
+                "state": state.state,
+            })
+
+    # Editors are few, the user is what identifies them elsewhere
+    usernames = {}
+    actions = Action.objects.order_by("id").values_list("id", "editor",
+        "when", "object_uid", "action_type", "content_type")
+    last = after
+    count = 0
+    while True:
+        chunk = list(actions.filter(id__gt = last)[:CHUNK_SIZE])
+        if not chunk: break
+        first, last = chunk[0][0], chunk[-1][0]
+        in_chunk = {"action__gte": first, "action__lte": last}
+
+        reverts = dict(Action.objects.filter(reverted__gte = first,
+                                             reverted__lte = last)
+                       .values_list("reverted", "id"))
+        creations = {}
+        for action, uid, content_type in CreationCommit.objects \
+                .filter(**in_chunk).order_by("id") \
+                .values_list("action", "object_uid", "content_type"):
+            creations.setdefault(action, []).append(
+                [uid, _content_type(content_type)])
+        deletions = {}
+        for action, uid in DeletionCommit.objects.filter(**in_chunk) \
+                .order_by("id").values_list("action", "object_uid"):
+            deletions.setdefault(action, []).append(uid)
+        modifications = {}
+        for action, uid, key, value in ModificationCommit.objects \
+                .filter(**in_chunk).order_by("id") \
+                .values_list("action", "object_uid", "key", "value"):
+            modifications.setdefault(action, []).append([uid, key, value])
+
+        for id, editor, when, uid, action_type, content_type in chunk:
+            if editor not in usernames:
+                usernames[editor] = Editor.objects.filter(id = editor) \
+                    .values_list("user__username", flat=True)[0]
+            _write(out, {
+                "type": "action",
+                "id": id,
+                "editor": usernames[editor],
+                "when": when.isoformat(" "),
+                "object_uid": uid,
+                "action_type": action_type,
+                "content_type": content_type and _content_type(content_type),
+                "reverts": reverts.get(id),
+                "creations": creations.get(id, []),
+                "deletions": deletions.get(id, []),
+                "modifications": modifications.get(id, []),
+            })
+        count += len(chunk)
+    return count
@@ -0,0 +1,172 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sys
+import gzip
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.core.management.color import no_style
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from discipline.codec import _parse_datetime
+from discipline.models import Action, CreationCommit, ModificationCommit, \
+    DeletionCommit, SchemaState, Editor, CHUNK_SIZE, _bulk_insert, \
+    _action_index, _schema_timeline, _last_action_id
+
+class Command(BaseCommand):
+    help = "Loads history written by discipline_export. Actions keep their " \
+           "ids, so an interrupted import continues after the last Action " \
+           "already in the database"
+    args = "file"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--after", type="int", default=None,
+                    help="Skip the Actions up to the one with this id, "
+                         "instead of those already in the database"),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Give the file to read, - for the input")
+        if args[0] == "-":
+            source = gzip.GzipFile(fileobj=sys.stdin, mode="rb")
+        else:
+            source = gzip.open(args[0], "rb")
+        try:
+            count = import_history(source, options.get("after"),
+                                   options.get("quiet"))
+        finally:
+            source.close()
+        if not options.get("quiet"):
+            print "Imported %d actions" % count
+
+class _Importer(object):
+
+    """Turns the records of an export into rows, remembering the Editors
+    and ContentTypes it looked up."""
+
+    def __init__(self):
+        self.editors = {}
+        self.content_types = {}
+
+    def editor(self, username):
+        if username not in self.editors:
+            if username is None:
+                editor = Editor.objects.filter(user__isnull = True)[:1]
+                editor = editor and editor[0] or \
+                    Editor.objects.create(user = None)
+            else:
+                try:
+                    user = User.objects.get(username = username)
+                except User.DoesNotExist:
+                    raise CommandError("Unknown user: %s" % username)
+                editor = Editor.objects.get_or_create(user = user)[0]
+            self.editors[username] = editor.id
+        return self.editors[username]
+
+    def content_type(self, name):
+        if name is None: return None
+        if name not in self.content_types:
+            try:
+                self.content_types[name] = ContentType.objects \
+                    .get_by_natural_key(*name.split(".")).id
+            except ContentType.DoesNotExist:
+                raise CommandError("Unknown model: %s" % name)
+        return self.content_types[name]
+
+    def write(self, records):
+        """Insert the Actions of the given records with their commits."""
+        actions = []
+        creations = []
+        deletions = []
+        modifications = []
+        reverts = []
+        for record in records:
+            actions.append(Action(
+                id = record["id"],
+                editor_id = self.editor(record["editor"]),
+                when = _parse_datetime(record["when"]),
+                object_uid = record["object_uid"],
+                action_type = record["action_type"],
+                content_type_id = self.content_type(record["content_type"]),
+            ))
+            if record["reverts"]:
+                reverts.append((record["id"], record["reverts"]))
+            for uid, content_type in record["creations"]:
+                creations.append(CreationCommit(
+                    object_uid = uid,
+                    action_id = record["id"],
+                    content_type_id = self.content_type(content_type),
+                ))
+            for uid in record["deletions"]:
+                deletions.append(DeletionCommit(
+                    object_uid = uid,
+                    action_id = record["id"],
+                ))
+            for uid, key, value in record["modifications"]:
+                modifications.append(ModificationCommit(
+                    object_uid = uid,
+                    action_id = record["id"],
+                    key = key,
+                    value = value,
+                ))
+        _bulk_insert(Action, actions, raw=True)
+        _bulk_insert(CreationCommit, creations)
+        _bulk_insert(DeletionCommit, deletions)
+        _bulk_insert(ModificationCommit, modifications)
+        if reverts:
+            qn = connection.ops.quote_name
+            connection.cursor().executemany(
+                "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                    qn(Action._meta.db_table), qn("reverted_id"), qn("id")),
+                reverts)
+
+def import_history(source, after=None, quiet=True):
+    """Insert the history in the file source after the Action with the id
+    after, by default the last one in the database. Every CHUNK_SIZE
+    Actions are inserted in a transaction of their own. Return the number
+    of Actions inserted."""
+
+    if after is None:
+        after = _last_action_id()
+    # SchemaStates are found by time, their ids don't matter
+    whens = set(SchemaState.objects.values_list("when", flat=True))
+    importer = _Importer()
+    write = transaction.commit_on_success(importer.write)
+    count = 0
+    records = []
+    for line in source:
+        record = json.loads(line)
+        if record["type"] == "schema_state":
+            when = _parse_datetime(record["when"])
+            if when not in whens:
+                state = SchemaState.objects.create(state = record["state"])
+                SchemaState.objects.filter(id = state.id).update(when = when)
+        elif record["type"] == "action":
+            if record["id"] <= after: continue
+            records.append(record)
+            if len(records) == CHUNK_SIZE:
+                write(records)
+                count += len(records)
+                if not quiet:
+                    print >> sys.stderr, \
+                        "Imported up to action %d" % records[-1]["id"]
+                records = []
+        else:
+            raise CommandError("Unknown record: %s" % line.strip())
+    if records:
+        write(records)
+        count += len(records)
+
+    # The ids were given, sequences don't know about them
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), [Action]):
+        cursor.execute(sql)
+    transaction.commit_unless_managed()
+    _action_index.clear()
+    _schema_timeline.clear()
+    return count
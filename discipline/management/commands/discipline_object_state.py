@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from discipline.models import CreationCommit, _rebuild_object_state
+
+class Command(BaseCommand):
+    help = "Rebuilds the ObjectState of every Discipline-controlled object " \
+           "from its history"
+
+    def handle(self, quiet=False, *args, **options):
+
+        uids = CreationCommit.objects.values_list("object_uid", flat=True) \
+            .order_by("object_uid").distinct()
+
+        count = 0
+        for uid in uids.iterator():
+            _rebuild_object_state(uid)
+            count += 1
+            if not quiet and not count % 1000:
+                print "%d objects..." % count
+
+        if not quiet: print "Rebuilt the ObjectState of %d objects" % count
@@ -0,0 +1,58 @@
+from django.db import connection, transaction
+from django.db.models.fields import FieldDoesNotExist
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from discipline.models import CreationCommit, ModificationCommit, \
+    CHUNK_SIZE, _encode_value, _decode_value
+
+class Command(BaseCommand):
+    help = "Rewrites the values of ModificationCommits with the codec set by " \
+           "DISCIPLINE_VALUE_CODEC, for example the old pickled values"
+
+    def handle(self, quiet=False, *args, **options):
+
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(ModificationCommit._meta.db_table), qn("value"), qn("id"))
+
+        commits = ModificationCommit.objects.order_by("id") \
+            .values_list("id", "object_uid", "key", "value")
+        last = 0
+        count = 0
+        while True:
+            chunk = list(commits.filter(id__gt = last)[:CHUNK_SIZE])
+            if not chunk: break
+            last = chunk[-1][0]
+
+            models = {}
+            uids = set(uid for id, uid, key, value in chunk)
+            for uid, content_type in CreationCommit.objects.filter(
+                    object_uid__in = list(uids)) \
+                    .values_list("object_uid", "content_type"):
+                models[uid] = ContentType.objects.get_for_id(content_type) \
+                    .model_class()
+
+            updates = []
+            for id, uid, key, value in chunk:
+                model = models.get(uid)
+                if model is None or value is None: continue
+                try:
+                    field = model._meta.get_field(key)
+                except FieldDoesNotExist:
+                    # Without the field there is no telling its type
+                    continue
+                # ForeignKeys are stored as uids
+                if getattr(field, "rel", None): continue
+                try:
+                    encoded = _encode_value(_decode_value(value), field)
+                except Exception:
+                    continue
+                if encoded != value:
+                    updates.append((encoded, id))
+
+            if updates:
+                connection.cursor().executemany(sql, updates)
+                transaction.commit_unless_managed()
+            count += len(updates)
+
+        if not quiet: print "Re-encoded %d values" % count
@@ -0,0 +1,50 @@
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from django.conf import settings
+from django.core.management import get_commands, load_command_class
+from django.core.management.base import BaseCommand
+
+from discipline.instrumentation import stats
+
+class Command(BaseCommand):
+    help = "Prints the calls, queries, database time and wall time of " \
+           "every Discipline operation. Given the name of another command " \
+           "and its arguments, runs it with instrumentation on first"
+    args = "[command [arguments]]"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--json", action="store_true", default=False,
+                    help="Print the statistics as a JSON object"),
+    )
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(Command, self).create_parser(prog_name, subcommand)
+        # The options after the command name are its own
+        parser.disable_interspersed_args()
+        return parser
+
+    def handle(self, *args, **options):
+
+        if args:
+            name = args[0]
+            command = load_command_class(get_commands()[name], name)
+            settings.DISCIPLINE_INSTRUMENTATION = True
+            stats.reset()
+            command.run_from_argv(["manage.py", name] + list(args[1:]))
+
+        operations = stats.as_dict()
+        if options.get("json"):
+            print json.dumps(operations, sort_keys=True)
+            return
+        print "%-32s %8s %8s %12s %12s" % (
+            "operation", "calls", "queries", "db ms", "wall ms")
+        for name in sorted(operations):
+            totals = operations[name]
+            print "%-32s %8d %8d %12.3f %12.3f" % (
+                name, totals["calls"], totals["queries"],
+                totals["db_time"] * 1000, totals["wall_time"] * 1000)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Editor'
+        db.create_table('discipline_editor', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['auth.User'], unique=True, null=True)),
+        ))
+        db.send_create_signal('discipline', ['Editor'])
+
+        # Adding model 'Action'
+        db.create_table('discipline_action', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('editor', self.gf('django.db.models.fields.related.ForeignKey')(related_name='commits', to=orm['discipline.Editor'])),
+            ('when', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, db_index=True, blank=True)),
+            ('reverted', self.gf('django.db.models.fields.related.OneToOneField')(related_name='reverts', unique=True, null=True, to=orm['discipline.Action'])),
+            ('object_uid', self.gf('django.db.models.fields.CharField')(max_length=32, db_index=True)),
+            ('action_type', self.gf('django.db.models.fields.CharField')(max_length=2, db_index=True)),
+        ))
+        db.send_create_signal('discipline', ['Action'])
+
+        # Adding model 'CreationCommit'
+        db.create_table('discipline_creationcommit', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('object_uid', self.gf('django.db.models.fields.CharField')(max_length=32, db_index=True)),
+            ('action', self.gf('django.db.models.fields.related.ForeignKey')(related_name='creation_commits', to=orm['discipline.Action'])),
+        ))
+        db.send_create_signal('discipline', ['CreationCommit'])
+
+        # Adding model 'DeletionCommit'
+        db.create_table('discipline_deletioncommit', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('object_uid', self.gf('django.db.models.fields.CharField')(max_length=32, db_index=True)),
+            ('action', self.gf('django.db.models.fields.related.ForeignKey')(related_name='deletion_commits', to=orm['discipline.Action'])),
+        ))
+        db.send_create_signal('discipline', ['DeletionCommit'])
+
+        # Adding model 'ModificationCommit'
+        db.create_table('discipline_modificationcommit', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('object_uid', self.gf('django.db.models.fields.CharField')(max_length=32, db_index=True)),
+            ('action', self.gf('django.db.models.fields.related.ForeignKey')(related_name='modification_commits', to=orm['discipline.Action'])),
+            ('key', self.gf('django.db.models.fields.CharField')(max_length=30, null=True)),
+            ('value', self.gf('django.db.models.fields.TextField')(null=True)),
+        ))
+        db.send_create_signal('discipline', ['ModificationCommit'])
+
+        # Adding model 'SchemaState'
+        db.create_table('discipline_schemastate', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('when', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('state', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal('discipline', ['SchemaState'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'Editor'
+        db.delete_table('discipline_editor')
+
+        # Deleting model 'Action'
+        db.delete_table('discipline_action')
+
+        # Deleting model 'CreationCommit'
+        db.delete_table('discipline_creationcommit')
+
+        # Deleting model 'DeletionCommit'
+        db.delete_table('discipline_deletioncommit')
+
+        # Deleting model 'ModificationCommit'
+        db.delete_table('discipline_modificationcommit')
+
+        # Deleting model 'SchemaState'
+        db.delete_table('discipline_schemastate')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'discipline.action': {
+            'Meta': {'ordering': "['-when']", 'object_name': 'Action'},
+            'action_type': ('django.db.models.fields.CharField', [], {'max_length': '2', 'db_index': 'True'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'commits'", 'to': "orm['discipline.Editor']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'}),
+            'reverted': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'reverts'", 'unique': 'True', 'null': 'True', 'to': "orm['discipline.Action']"}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'discipline.creationcommit': {
+            'Meta': {'object_name': 'CreationCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'creation_commits'", 'to': "orm['discipline.Action']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        'discipline.deletioncommit': {
+            'Meta': {'object_name': 'DeletionCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'deletion_commits'", 'to': "orm['discipline.Action']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        'discipline.editor': {
+            'Meta': {'object_name': 'Editor'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'unique': 'True', 'null': 'True'})
+        },
+        'discipline.modificationcommit': {
+            'Meta': {'object_name': 'ModificationCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'modification_commits'", 'to': "orm['discipline.Action']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '30', 'null': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        'discipline.schemastate': {
+            'Meta': {'ordering': "['-when']", 'object_name': 'SchemaState'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['discipline']
\ No newline at end of file
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    # On SQLite, South adds the content_type column of 0003 by copying
+    # discipline_action, and the copy lost the indexes of the other columns
+    indexes = ['editor_id', 'when', 'object_uid', 'action_type',
+               'content_type_id']
+
+    def forwards(self, orm):
+        if db.backend_name != 'sqlite3':
+            return
+        indexed = set()
+        for index in db.execute('PRAGMA index_list("discipline_action")'):
+            columns = db.execute('PRAGMA index_info("%s")' % index[1])
+            indexed.add(tuple([column[2] for column in columns]))
+        for column in self.indexes:
+            if (column,) not in indexed:
+                db.create_index('discipline_action', [column])
+        if ('reverted_id',) not in indexed:
+            db.create_index('discipline_action', ['reverted_id'], unique=True)
+
+    def backwards(self, orm):
+        # The indexes are those the table had before 0003
+        pass
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'discipline.action': {
+            'Meta': {'ordering': "['-when']", 'object_name': 'Action'},
+            'action_type': ('django.db.models.fields.CharField', [], {'max_length': '2', 'db_index': 'True'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'commits'", 'to': "orm['discipline.Editor']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'}),
+            'reverted': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'reverts'", 'unique': 'True', 'null': 'True', 'to': "orm['discipline.Action']"}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'discipline.checkpoint': {
+            'Meta': {'object_name': 'Checkpoint'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'checkpoints'", 'to': "orm['discipline.Action']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {})
+        },
+        'discipline.creationcommit': {
+            'Meta': {'object_name': 'CreationCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'creation_commits'", 'to': "orm['discipline.Action']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        'discipline.deletioncommit': {
+            'Meta': {'object_name': 'DeletionCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'deletion_commits'", 'to': "orm['discipline.Action']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        },
+        'discipline.editor': {
+            'Meta': {'object_name': 'Editor'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'unique': 'True', 'null': 'True'})
+        },
+        'discipline.modificationcommit': {
+            'Meta': {'object_name': 'ModificationCommit'},
+            'action': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'modification_commits'", 'to': "orm['discipline.Action']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '30', 'null': 'True'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        'discipline.objectstate': {
+            'Meta': {'object_name': 'ObjectState'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'exists': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'object_uid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {}),
+            'step': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'discipline.renderedaction': {
+            'Meta': {'object_name': 'RenderedAction'},
+            'action': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'rendered'", 'unique': 'True', 'primary_key': 'True', 'to': "orm['discipline.Action']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'parts': ('django.db.models.fields.TextField', [], {})
+        },
+        'discipline.schemastate': {
+            'Meta': {'ordering': "['-when']", 'object_name': 'SchemaState'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'state': ('django.db.models.fields.TextField', [], {}),
+            'when': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['discipline']
\ No newline at end of file
@@ -1,18 +1,36 @@
 # -*- coding: utf-8 -*-
 
-import cPickle
 import uuid
 import copy
+import threading
+import Queue
+import atexit
+import logging
+import bisect
+import array
+from contextlib import contextmanager
 try:
     import json
 except ImportError:
     import simplejson as json 
 import datetime
 
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError, \
+    reset_queries
 from django.db.models import *
+from django.db.models import signals
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core import urlresolvers
+from django.utils.encoding import smart_unicode
+from django.utils.functional import wraps
+from django.utils.importlib import import_module
+
+from discipline.cache import value_cache
+from discipline.instrumentation import instrumented
 
 __all__ = (
     "DisciplinedModel", 
@@ -22,75 +40,721 @@ __all__ = (
     "CreationCommit",
     "ModificationCommit",
     "DeletionCommit",
+    "ObjectState",
+    "Checkpoint",
+    "RenderedAction",
     "TimeMachine",
+    "ObjectHistory",
     "DisciplineException",
     "DisciplineIntegrityError",
+    "flush_history",
 )
 
-def save_object(instance, editor):
-
+# Instances of value codec classes by their dotted path
+_codecs = {}
+
+def _codec():
+    """Return the codec set by the DISCIPLINE_VALUE_CODEC setting, see
+    discipline.codec."""
+    path = getattr(settings, "DISCIPLINE_VALUE_CODEC",
+                   "discipline.codec.TypedCodec")
+    if path not in _codecs:
+        module, name = path.rsplit(".", 1)
+        _codecs[path] = getattr(import_module(module), name)()
+    return _codecs[path]
+
+def _encode_value(value, field=None):
+    """Serialize a non-ForeignKey field value for a ModificationCommit,
+    given the field object to choose how."""
+    return _codec().encode(value, field)
+
+def _decode_value(value):
+    """Inverse of _encode_value."""
+    return _codec().decode(value)
+
+def _tracked_fields(model):
+    """Return a tuple of two lists: the names of every field of the model
+    that Discipline keeps track of and the names of its ForeignKeys."""
     fields = []
     fks = []
-    mods = []
-
-    for field in instance.__class__._meta.fields:
+    for field in model._meta.fields:
         if field.name == "uid": continue
         fields.append(field.name)
         if field.__class__.__name__ == "ForeignKey":
             fks.append(field.name)
+    return fields, fks
+
+# Number of values to put in a single "IN (...)" clause
+CHUNK_SIZE = 500
+
+def _chunks(items, size=CHUNK_SIZE):
+    """Split a list into lists of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _by_action(queryset, latest_first=True):
+    """Order a QuerySet of commits by the id of their Action. Unlike
+    order_by("-action__id"), this doesn't join the Action table, so the
+    rows can come straight from an index in order."""
+    column = "%s.%s" % (queryset.model._meta.db_table, "action_id")
+    return queryset.extra(order_by = [latest_first and "-" + column
+                                      or column])
+
+def _latest_commits_query(uids, step=None, after=None):
+    """Return a values_list QuerySet of the id, object uid, key and encoded
+    value of the last ModificationCommit of every field of the given
+    objects, optionally not later than the Action with id step and later
+    than the one with id after."""
+    qn = connection.ops.quote_name
+    table = qn(ModificationCommit._meta.db_table)
+    # The latest Action, not the greatest id: the commits of concurrent
+    # transactions can be written in a different order than their Actions
+    where = ""
+    params = []
+    if step is not None:
+        where += " AND latest.%s <= %%s" % qn("action_id")
+        params.append(step)
+    if after is not None:
+        where += " AND latest.%s > %%s" % qn("action_id")
+        params.append(after)
+    return ModificationCommit.objects.filter(object_uid__in = uids).extra(
+        where = ["%(table)s.%(action)s = (SELECT MAX(latest.%(action)s) "
+                 "FROM %(table)s latest WHERE latest.%(uid)s = "
+                 "%(table)s.%(uid)s AND latest.%(key)s = %(table)s.%(key)s"
+                 "%(where)s)" % {
+                     "table": table,
+                     "action": qn("action_id"),
+                     "uid": qn("object_uid"),
+                     "key": qn("key"),
+                     "where": where,
+                 }],
+        params = params,
+    ).order_by("id").values_list("id", "object_uid", "key", "value")
+
+def _latest_commits_many(uids, step=None, after=None):
+    """Return a dict mapping each of the given uids to a dict that maps
+    field names to a tuple of the id and the still encoded value of the
+    last ModificationCommit of that field, optionally not later than the
+    Action with id step and later than the one with id after. Runs a single
+    query for every CHUNK_SIZE uids.
+    """
+    result = dict([(uid, {}) for uid in uids])
+    for chunk in _chunks(result.keys()):
+        for id, uid, key, value in _latest_commits_query(chunk, step, after):
+            result[uid][key] = (id, value)
+    return result
+
+def _latest_values_many(uids, step=None, after=None):
+    """Like _latest_commits_many, with only the encoded values."""
+    result = _latest_commits_many(uids, step, after)
+    for uid, commits in result.items():
+        result[uid] = dict([(key, value)
+                            for key, (id, value) in commits.items()])
+    return result
+
+def _latest_values(uid, step=None, after=None):
+    """Like _latest_values_many, for a single object."""
+    return _latest_values_many([uid], step, after)[uid]
+
+def _values_before(actions):
+    """Return a dict mapping the id of each of the given Actions to a dict
+    of the encoded values of the fields of its object right before it.
+    Runs a single query for every CHUNK_SIZE objects.
+    """
+    history = {}
+    last = max(action.id for action in actions)
+    uids = list(set(action.object_uid for action in actions))
+    for chunk in _chunks(uids):
+        modcommits = _by_action(ModificationCommit.objects.filter(
+            object_uid__in = chunk,
+            action__id__lt = last,
+        ), latest_first = False).values_list("object_uid", "action", "key",
+                                             "value")
+        for uid, step, key, value in modcommits:
+            history.setdefault(uid, []).append((step, key, value))
+    result = {}
+    for action in actions:
+        values = {}
+        for step, key, value in history.get(action.object_uid, []):
+            if step >= action.id: break
+            values[key] = value
+        result[action.id] = values
+    return result
+
+def _stored_states(uids):
+    """Return a dict mapping each of the given uids to a tuple (existed,
+    exists, values) describing what Discipline has on record for the
+    object: whether it was ever created, whether it currently exists and
+    the encoded values of its fields. Runs a constant number of queries for
+    every CHUNK_SIZE uids.
+    """
+    states = {}
+    for chunk in _chunks(list(set(uids))):
+        if _object_state_enabled():
+            for state in _current_object_states(chunk):
+                states[state.object_uid] = (True, state.exists,
+                                            state.get_values())
+        rest = [uid for uid in chunk if uid not in states]
+        if not rest: continue
+        # The last creation or deletion of each object
+        last = {}
+        creations_deletions = Action.objects.filter(
+            object_uid__in = rest,
+            action_type__in = ("cr", "dl"),
+        ).order_by().values_list("object_uid", "id", "action_type")
+        for uid, id, action_type in creations_deletions:
+            if uid not in last or last[uid][0] < id:
+                last[uid] = (id, action_type)
+        values = _latest_values_many(last.keys())
+        for uid in rest:
+            if uid in last:
+                states[uid] = (True, last[uid][1] == "cr", values[uid])
+            else:
+                states[uid] = (False, False, {})
+    return states
+
+def _stored_state(uid):
+    """Like _stored_states, for a single object."""
+    return _stored_states([uid])[uid]
+
+def _bulk_insert(model, objects, raw=False):
+    """Insert many objects of the same model with a single executemany()
+    call. Objects don't get their ids set, so use this for rows nothing
+    else refers to. With raw, the ids of the objects and all of their
+    values are inserted as they are, auto_now_add fields included.
+    """
+    if not objects: return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if raw or not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    if raw:
+        values = lambda f, obj: getattr(obj, f.attname)
+    else:
+        values = lambda f, obj: f.pre_save(obj, True)
+    params = [[f.get_db_prep_save(values(f, obj), connection=connection)
+               for f in fields] for obj in objects]
+    connection.cursor().executemany(sql, params)
+    transaction.commit_unless_managed()
+
+def _bulk_delete(model, pks):
+    """Delete the objects with the given primary keys with a single query,
+    without looking for related objects and without sending signals."""
+    if not pks: return
+    qn = connection.ops.quote_name
+    connection.cursor().execute("DELETE FROM %s WHERE %s IN (%s)" % (
+        qn(model._meta.db_table),
+        qn(model._meta.pk.column),
+        ", ".join(["%s"] * len(pks)),
+    ), list(pks))
+    transaction.commit_unless_managed()
+
+def _clear_many_to_many(model, pks):
+    """Delete the rows linking the objects with the given primary keys to
+    others through automatically created ManyToManyField tables, which
+    _bulk_delete leaves behind."""
+    if not pks: return
+    qn = connection.ops.quote_name
+    # Explicit through models are deleted by cascading like any other
+    tables = [(field.m2m_db_table(), field.m2m_column_name())
+              for field in model._meta.many_to_many
+              if field.rel.through._meta.auto_created]
+    for related in model._meta.get_all_related_many_to_many_objects():
+        if related.field.rel.through._meta.auto_created:
+            tables.append((related.field.m2m_db_table(),
+                           related.field.m2m_reverse_name()))
+    cursor = connection.cursor()
+    for table, column in tables:
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(table), qn(column), ", ".join(["%s"] * len(pks))), list(pks))
+    transaction.commit_unless_managed()
+
+def _content_type_of(model):
+    """Return the ContentType of the given model. In a data migration it
+    can be a model of South's frozen orm that the app no longer has, which
+    ContentType.objects.get_for_model can't cache."""
+    opts = model._meta
+    if get_model(opts.app_label, opts.object_name) is None:
+        return ContentType.objects.get_or_create(
+            app_label = opts.app_label,
+            model = opts.object_name.lower(),
+            defaults = {"name": smart_unicode(opts.verbose_name_raw)},
+        )[0]
+    return ContentType.objects.get_for_model(model)
+
+def _create_actions(actions):
+    """Save many new Actions and set their ids, which are read from the
+    database as the rows are inserted, never guessed from their contents.
+    PostgreSQL returns them from a single INSERT for every CHUNK_SIZE
+    Actions. SQLite lets a single transaction write at a time, so the rows
+    of one executemany() get consecutive ids up to last_insert_rowid().
+    Other databases insert the Actions one at a time.
+    """
+    if not actions: return
+    qn = connection.ops.quote_name
+    opts = Action._meta
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES " % (
+        qn(opts.db_table), ", ".join([qn(f.column) for f in fields]))
+    row = "(%s)" % ", ".join(["%s"] * len(fields))
+    params = [[f.get_db_prep_save(f.pre_save(action, True),
+                                  connection=connection)
+               for f in fields] for action in actions]
+    cursor = connection.cursor()
+    # Oracle returns one id into a variable, PostgreSQL returns rows
+    returning = connection.features.can_return_id_from_insert and \
+        connection.ops.return_insert_id()
+    ids = []
+    if returning and not returning[1]:
+        for chunk in _chunks(params):
+            cursor.execute(sql + ", ".join([row] * len(chunk)) + " " +
+                           returning[0] % qn(opts.pk.column),
+                           [value for values in chunk for value in values])
+            ids.extend([id for (id,) in cursor.fetchall()])
+    elif connection.settings_dict["ENGINE"].endswith("sqlite3"):
+        cursor.executemany(sql + row, params)
+        cursor.execute("SELECT last_insert_rowid()")
+        last = cursor.fetchone()[0]
+        ids = range(last - len(actions) + 1, last + 1)
+    else:
+        for values in params:
+            cursor.execute(sql + row, values)
+            ids.append(connection.ops.last_insert_id(cursor, opts.db_table,
+                                                     opts.pk.column))
+    for action, id in zip(actions, ids):
+        action.id = id
+    transaction.commit_unless_managed()
+
+def _differs(stored, current):
+    """Whether the stored value of a field differs from its current value.
+    A naive and an aware datetime can't be compared, they always differ."""
+    try:
+        return stored != current
+    except TypeError:
+        return True
+
+def _changes(instance, existed, exists, values):
+    """Work out what saving the given object adds to its history, given
+    what _stored_state returns for it. Return a tuple of the type of the
+    new Action and a list of (field name, encoded value) pairs for its
+    ModificationCommits, or None if there are no modifications.
+    """
 
-    # Existed at least at some point in time
-    existed = bool(CreationCommit.objects.filter(object_uid=instance.uid))
+    fields, fks = _tracked_fields(instance.__class__)
+    mods = []
 
     if existed:
-        mods = []
-        inst = TimeMachine(instance.uid)
         for field in fields:
-            if inst.get(field) != getattr(instance, field):
+            if field in fks:
+                # Compare uids, no need to fetch the related object
+                current = getattr(instance,
+                                  instance._meta.get_field(field).attname)
+                if values.get(field) != current:
+                    mods.append(field)
+            elif field not in values:
+                if getattr(instance, field) is not None:
+                    mods.append(field)
+            elif _differs(_decode_value(values[field]),
+                          getattr(instance, field)):
                 mods.append(field)
         # Make sure there are actual changes
-        if inst.exists and not mods: 
-            raise DisciplineException("You are trying to save an " \
-                "object with no modifications.")
+        if exists and not mods: 
+            return None
 
     # The object doesn't exist
-    if not existed or not inst.exists:
-
-        action = Action.objects.create(
-            object_uid = instance.uid,
-            action_type = "cr",
-            editor = editor,
-        )
-
-        CreationCommit.objects.create(
-            object_uid = instance.uid,
-            action = action,
-            content_type = ContentType.objects \
-                .get_for_model(instance.__class__)
-        )
+    if not exists:
+        action_type = "cr"
         # Create a modcommit for everything
         if not mods: mods = fields
     else: 
-        action = Action.objects.create(
-            object_uid = instance.uid,
-            action_type = "md",
-            editor = editor,
-        )
+        action_type = "md"
 
-    # Create MicroCommit for each modification
+    modifications = []
     for field in mods:
         if field in fks:
-            value = getattr(instance,field).uid
+            value = getattr(instance,
+                            instance._meta.get_field(field).attname)
         else:
-            value = cPickle.dumps(getattr(instance,field))
-        ModificationCommit.objects.create(
+            value = _encode_value(getattr(instance, field),
+                                  instance._meta.get_field(field))
+        modifications.append((field, value))
+
+    return action_type, modifications
+
+def save_objects(instances, editor):
+    """Record the current state of many already saved objects. The history
+    is the same as that of calling save_object on each of them in order,
+    but it is read and written with a constant number of queries, except
+    for ObjectStates and Checkpoints. Objects without modifications are
+    skipped. Return the list of new Actions.
+    """
+
+    stored = _stored_states([instance.uid for instance in instances])
+    pending = []
+    for instance in instances:
+        existed, exists, values = stored[instance.uid]
+        changes = _changes(instance, existed, exists, values)
+        if not changes: continue
+        action_type, modifications = changes
+        values = dict(values)
+        values.update(modifications)
+        # Later saves of the same object build on this one
+        stored[instance.uid] = (True, True, values)
+        action = Action(
             object_uid = instance.uid,
+            action_type = action_type,
+            editor = editor,
+            content_type = _content_type_of(instance.__class__),
+        )
+        pending.append((instance, action, modifications, values))
+
+    actions = [action for instance, action, mods, values in pending]
+    _create_actions(actions)
+
+    creations = []
+    modcommits = []
+    for instance, action, modifications, values in pending:
+        if action.action_type == "cr":
+            creations.append(CreationCommit(
+                object_uid = instance.uid,
+                action = action,
+                content_type = action.content_type,
+            ))
+        # Create MicroCommit for each modification
+        for field, value in modifications:
+            modcommits.append(ModificationCommit(
+                object_uid = instance.uid,
+                action = action,
+                key = field,
+                value = value
+            ))
+    _bulk_insert(CreationCommit, creations)
+    _bulk_insert(ModificationCommit, modcommits)
+
+    for instance, action, modifications, values in pending:
+        if _object_state_enabled():
+            _record_object_state(instance.uid,
+                _content_type_of(instance.__class__),
+                True, action.id, values)
+        _auto_checkpoint(instance.uid, action, values)
+
+    return actions
+
+def save_object(instance, editor):
+    """Record the current state of an already saved object and return the
+    new Action. Raise DisciplineException if nothing has changed."""
+    actions = save_objects([instance], editor)
+    if not actions:
+        raise DisciplineException("You are trying to save an " \
+            "object with no modifications.")
+    return actions[0]
+
+def _checkpoint_interval():
+    """Return the DISCIPLINE_CHECKPOINT_INTERVAL setting: None if
+    Checkpoints aren't used at all, 0 if they are only created on demand,
+    otherwise the number of Actions on an object between Checkpoints."""
+    return getattr(settings, "DISCIPLINE_CHECKPOINT_INTERVAL", None)
+
+def _auto_checkpoint(uid, action, values):
+    """Create a Checkpoint at the given Action if enough Actions were
+    performed on the object since the last one."""
+    interval = _checkpoint_interval()
+    if not interval: return
+    last = _by_action(Checkpoint.objects.filter(object_uid=uid)) \
+        .values_list("action", flat=True)[:1]
+    since = Action.objects.filter(
+        object_uid = uid,
+        id__gt = last and last[0] or 0,
+    ).count()
+    if since >= interval:
+        Checkpoint.objects.create(
+            object_uid = uid,
             action = action,
-            key = field,
-            value = value
+            state = json.dumps(values),
         )
 
-    return action
+def _object_state_enabled():
+    return getattr(settings, "DISCIPLINE_OBJECT_STATE", False)
+
+def _current_object_states(uids):
+    """Return the ObjectStates of the given objects whose step is the id
+    of the latest Action on the object, using a single query. Those of
+    objects changed while the DISCIPLINE_OBJECT_STATE setting was off or by
+    discipline_import are behind their history and left out."""
+    qn = connection.ops.quote_name
+    latest = "SELECT MAX(%(id)s) FROM %(action)s WHERE " \
+        "%(action)s.%(uid)s = %(state)s.%(uid)s" % {
+            "state": qn(ObjectState._meta.db_table),
+            "action": qn(Action._meta.db_table),
+            "id": qn("id"),
+            "uid": qn("object_uid"),
+        }
+    states = ObjectState.objects.filter(object_uid__in = uids) \
+        .extra(select = {"latest_step": latest})
+    return [state for state in states if state.step == state.latest_step]
+
+def _get_object_state(uid):
+    """Return the ObjectState of the given object or None if it isn't
+    being maintained or doesn't have an up to date one."""
+    if not _object_state_enabled():
+        return None
+    states = _current_object_states([uid])
+    return states and states[0] or None
+
+def _rebuild_object_state(uid):
+    """Recreate the ObjectState of the given object from its history."""
+    creation = _by_action(CreationCommit.objects.filter(object_uid=uid))[0]
+    last = Action.objects.filter(object_uid=uid).order_by("-id")[0]
+    last_type = Action.objects.filter(
+        object_uid = uid,
+        action_type__in = ("cr", "dl"),
+    ).order_by("-id").values_list("action_type", flat=True)[0]
+    _record_object_state(uid, creation.content_type, last_type == "cr",
+                         last.id, _latest_values(uid))
+
+def _record_object_state(uid, content_type, exists, step, values=None):
+    """Update the ObjectState of the given object, creating it if needed.
+    If values is None, only the exists flag and the step are updated, which
+    never creates a new ObjectState."""
+    update = {"exists": exists, "step": step}
+    if values is not None:
+        update["content_type"] = content_type
+        update["state"] = json.dumps(values)
+    if ObjectState.objects.filter(object_uid=uid).update(**update):
+        return
+    if values is not None:
+        ObjectState.objects.create(object_uid=uid, **update)
+
+# The Editor.batch() running in each thread, if any
+_batches = threading.local()
+
+def _current_batch():
+    return getattr(_batches, "current", None)
+
+class _Batch(object):
+
+    """The objects saved inside an Editor.batch() whose history hasn't
+    been written yet."""
+
+    def __init__(self):
+        self.order = []
+        self.snapshots = {}
+
+    def defer(self, editor, obj):
+        """Remember the current state of an object saved by the editor.
+        Later saves of it replace this one but keep its place in line."""
+        key = (editor.pk, obj.uid)
+        if key not in self.snapshots:
+            self.order.append(key)
+        self.snapshots[key] = (editor, copy.copy(obj))
+
+    def flush(self):
+        """Write the history of every deferred object."""
+        editor = None
+        objs = []
+        for key in self.order:
+            if editor is not None and editor.pk != key[0]:
+                save_objects(objs, editor)
+                objs = []
+            editor, obj = self.snapshots[key]
+            objs.append(obj)
+        if objs:
+            save_objects(objs, editor)
+        self.order = []
+        self.snapshots = {}
+
+def _async_history_enabled():
+    return getattr(settings, "DISCIPLINE_ASYNC_HISTORY", False)
+
+class _Ticket(object):
+
+    """What the thread that submitted a task to _HistoryWriter gets to
+    know about it: whether it has run and the exception it raised."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+class _HistoryWriter(object):
+
+    """Runs tasks one after the other in a background thread, in the
+    order they were submitted. At most DISCIPLINE_ASYNC_HISTORY_QUEUE_SIZE
+    tasks wait at a time, submitting more blocks until there is room. The
+    thread is started with the first task. Every thread only waits for its
+    own tasks and only hears about their exceptions.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        # The tickets of the tasks each thread submitted since it last
+        # flushed, minus those that ran without errors
+        self.local = threading.local()
+
+    def __tickets(self):
+        tickets = getattr(self.local, "tickets", None)
+        if tickets is None:
+            tickets = self.local.tickets = []
+        return tickets
+
+    def submit(self, func, *args):
+        """Run func(*args) in the background after the tasks submitted
+        before it."""
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.queue = Queue.Queue(getattr(settings,
+                    "DISCIPLINE_ASYNC_HISTORY_QUEUE_SIZE", 1000))
+                self.thread = threading.Thread(target = self.work,
+                                               name = "discipline-history")
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        tickets = self.__tickets()
+        while tickets and tickets[0].done.isSet() and not tickets[0].error:
+            del tickets[0]
+        ticket = _Ticket()
+        tickets.append(ticket)
+        self.queue.put((func, args, ticket))
+
+    def work(self):
+        while True:
+            func, args, ticket = self.queue.get()
+            try:
+                try:
+                    func(*args)
+                except Exception, e:
+                    ticket.error = e
+                    # In case the thread that submitted it never flushes
+                    logging.getLogger("discipline").exception(
+                        "Writing history in the background failed")
+            finally:
+                # Like at the end of a request, close the connection of the
+                # thread once it has nothing left to do, and after an error
+                # in case the connection itself is what failed
+                if ticket.error is not None or self.queue.empty():
+                    try:
+                        connection.close()
+                    except Exception:
+                        logging.getLogger("discipline").exception(
+                            "Closing the history connection failed")
+                # Debug mode would keep every query of the thread
+                reset_queries()
+                ticket.done.set()
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until every task the current thread submitted has run.
+        Raise the first exception one of them raised, if any."""
+        tickets = self.__tickets()
+        if not tickets: return
+        # Tasks run in order, when the last one is done so are the others
+        tickets[-1].done.wait()
+        self.local.tickets = []
+        for ticket in tickets:
+            if ticket.error is not None:
+                raise ticket.error
+
+    def join(self):
+        """Wait until the tasks of every thread have run."""
+        if self.queue is not None:
+            self.queue.join()
+
+# The writer of the history of Editor.save_objects() in the background
+_history_writer = _HistoryWriter()
+atexit.register(_history_writer.join)
+
+def flush_history():
+    """Wait until the history of every object the current thread saved is
+    written. Only needed with DISCIPLINE_ASYNC_HISTORY on, to read it right
+    away. Raise the first exception writing it raised, if any."""
+    _history_writer.flush()
+
+def _intent(obj):
+    """Return what the history of a saved object is written from: its
+    model, its uid and the values of its tracked fields, ForeignKeys as
+    the uids they point to."""
+    model = obj.__class__
+    return model, obj.uid, [
+        (field.attname, getattr(obj, field.attname))
+        for field in model._meta.fields if field.name != "uid"]
+
+def _write_history(editor, intents):
+    """Record the history of saved objects from their _intent(), in the
+    transaction of the thread running it."""
+    objs = [model(uid = uid, **dict(values))
+            for model, uid, values in intents]
+    try:
+        transaction.commit_on_success(save_objects)(objs, editor)
+    except:
+        _action_index.clear()
+        raise
+
+def _separate_database():
+    """Whether the background writer can reach the database on its own
+    connection, which isn't so with an in-memory SQLite database."""
+    return connection.settings_dict["NAME"] != ":memory:"
+
+def _history_transaction(func):
+    """Run the decorated function in its own transaction. Inside
+    Editor.batch(), run it in the batch's transaction instead, after
+    writing the deferred history to keep everything in order. The history
+    the current thread saved in the background is waited for first."""
+    def inner(*args, **kwargs):
+        _history_writer.flush()
+        batch = _current_batch()
+        if batch is None:
+            try:
+                return transaction.commit_on_success(func)(*args, **kwargs)
+            except:
+                # The ids of the Actions rolled back are used again
+                _action_index.clear()
+                raise
+        batch.flush()
+        return func(*args, **kwargs)
+    return wraps(func)(inner)
+
+def _record_deletions(uids, first):
+    """Mark the ObjectStates of the given objects as not existing, with the
+    step of their last Action, using a single query. first is the id of
+    the first of the deletions; ObjectStates that weren't up to date before
+    them are left behind their history."""
+    qn = connection.ops.quote_name
+    latest = "(SELECT MAX(%(id)s) FROM %(action)s WHERE " \
+        "%(action)s.%(uid)s = %(state)s.%(uid)s%(before)s)"
+    names = {
+        "state": qn(ObjectState._meta.db_table),
+        "action": qn(Action._meta.db_table),
+        "id": qn("id"),
+        "uid": qn("object_uid"),
+    }
+    connection.cursor().execute(
+        "UPDATE %(state)s SET %(exists)s = %%s, %(step)s = %(latest)s "
+        "WHERE %(uid)s IN (%(uids)s) AND %(step)s = %(previous)s" % dict(
+            names,
+            exists = qn("exists"),
+            step = qn("step"),
+            uids = ", ".join(["%s"] * len(uids)),
+            latest = latest % dict(names, before = ""),
+            previous = latest % dict(names, before = " AND %s.%s < %%s" % (
+                names["action"], names["id"])),
+        ), [False] + list(uids) + [first])
+    transaction.commit_unless_managed()
+
+def _record_reverts(actions):
+    """Save the reverted field of the given Actions with a single query."""
+    if not actions: return
+    qn = connection.ops.quote_name
+    connection.cursor().executemany(
+        "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(Action._meta.db_table), qn("reverted_id"), qn("id")),
+        [(action.reverted_id, action.id) for action in actions])
+    transaction.commit_unless_managed()
 
 class DisciplineException(Exception):
     pass
@@ -109,6 +773,7 @@ class Editor(Model):
             text = u"Anonymous %d" % self.user.id 
         return text
 
+    @instrumented("Editor.save_object")
     def save_object(self, obj):
         """Save an object with Discipline
 
@@ -116,44 +781,277 @@ class Editor(Model):
         (regardless of whether it already exists or not) and registers with
         Discipline, creating a new Action object. Do not use obj.save()!
         """
-        obj.save()
+        self.save_objects([obj])
+
+    @instrumented("Editor.save_objects")
+    def save_objects(self, objs):
+        """Save many objects with Discipline
+
+        Takes a list of Django objects. The result is the same as calling
+        save_object on each of them in order, but their history is written
+        at once in a single transaction. Returns the list of new Actions,
+        objects without modifications don't get one. Inside batch(), the
+        history is deferred and an empty list is returned.
+
+        With the DISCIPLINE_ASYNC_HISTORY setting on, outside of batch(),
+        only the objects are saved right away and their history is written
+        by a background thread, in order. An empty list is returned, call
+        flush_history() before reading the history.
+        """
+        objs = list(objs)
+        batch = _current_batch()
+        if batch is None and _async_history_enabled() and \
+           _separate_database():
+            for obj in objs:
+                obj.save()
+            # The objects may change before the history is written
+            _history_writer.submit(_write_history, self,
+                                   [_intent(obj) for obj in objs])
+            return []
+        if batch is None:
+            return self._save_objects(objs)
+        for obj in objs:
+            obj.save()
+            batch.defer(self, obj)
+        return []
+
+    @_history_transaction
+    def _save_objects(self, objs):
+        for obj in objs:
+            obj.save()
+        return save_objects(objs, editor=self)
+
+    @contextmanager
+    def batch(self):
+        """Defer the history of objects saved inside a with block
+
+        Objects are still saved right away, but their history is written
+        when the block ends, in a single transaction together with
+        everything else done inside the block. Saving an object several
+        times results in a single Action. If the block raises an exception,
+        the transaction is rolled back and nothing is saved::
+
+            with editor.batch():
+                editor.save_object(obj)
+        """
+        if _current_batch() is not None:
+            # A nested batch is part of the outer one
+            yield
+            return
+        _history_writer.flush()
+        _batches.current = _Batch()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
         try:
-            save_object(obj, editor=self)
-        except DisciplineException:
-            pass
+            try:
+                yield
+                _batches.current.flush()
+            except:
+                transaction.rollback()
+                # The ids of the Actions rolled back are used again
+                _action_index.clear()
+                raise
+            else:
+                transaction.commit()
+        finally:
+            _batches.current = None
+            transaction.leave_transaction_management()
 
+    @instrumented("Editor.delete_object")
+    @_history_transaction
     def delete_object(self, obj, post_delete=False):
         """Delete an object with Discipline
 
         Only argument is a Django object. Analogous to Editor.save_object.
+        Objects deleted by cascading are found level by level and deleted
+        CHUNK_SIZE at a time, children before their parents.
         """
-        # Collect related objects that will be deleted by cascading
-        links = [rel.get_accessor_name() for rel in \
-                 obj._meta.get_all_related_objects()]
-        # Recursively delete each of them
-        for link in links:
-            objects = getattr(obj, link).all()
-            for o in objects:
-                self.delete_object(o, post_delete)
+        # Delete related objects that would be deleted by cascading
+        for rel in obj._meta.get_all_related_objects():
+            self._delete_related(rel, [obj.uid], post_delete)
         # Delete the actual object
-        self._delete_object(obj, post_delete)
+        self._delete_objects(obj.__class__, [obj], post_delete=True)
+        if not post_delete: obj.delete()
 
-    def _delete_object(self, obj, post_delete):
-        action = Action.objects.create(
-            object_uid = obj.uid,
+    def _delete_related(self, rel, uids, post_delete):
+        """Delete the objects pointing to the given objects through the
+        given relation, along with everything pointing to them in turn.
+
+        Only CHUNK_SIZE objects of each level are in memory at a time, so
+        the number of queries grows with the number of objects divided by
+        CHUNK_SIZE and memory use doesn't grow at all.
+        """
+        related = rel.model._default_manager.filter(**{
+            "%s__in" % rel.field.name: uids,
+        }).order_by("pk")
+        last = None
+        while True:
+            # With post_delete, objects stay in place until later, so
+            # continue after the last one instead of starting over
+            if last is None:
+                chunk = list(related[:CHUNK_SIZE])
+            else:
+                chunk = list(related.filter(pk__gt = last)[:CHUNK_SIZE])
+            if not chunk: return
+            pks = [obj.pk for obj in chunk]
+            for subrel in rel.model._meta.get_all_related_objects():
+                self._delete_related(subrel, pks, post_delete)
+            self._delete_objects(rel.model, chunk, post_delete)
+            last = pks[-1]
+
+    def _delete_objects(self, model, objs, post_delete):
+        """Register the deletion of the given objects of the given model and
+        delete them with a single query, unless post_delete is True. Like
+        Model.delete, that sends pre_delete and post_delete for each of
+        them."""
+        uids = [obj.pk for obj in objs]
+        content_type = _content_type_of(model)
+        actions = [Action(
+            object_uid = uid,
             action_type = "dl",
             editor = self,
-        )
-        DeletionCommit(
-            object_uid = obj.uid,
+            content_type = content_type,
+        ) for uid in uids]
+        _create_actions(actions)
+        _bulk_insert(DeletionCommit, [DeletionCommit(
+            object_uid = action.object_uid,
             action = action,
-        ).save()
-        if not post_delete: obj.delete()
+        ) for action in actions])
+        if _object_state_enabled():
+            _record_deletions(uids, actions[0].id)
+        if not post_delete:
+            # Django sends no signals for automatic many-to-many tables
+            send = not model._meta.auto_created
+            for obj in objs:
+                if send: signals.pre_delete.send(sender = model, instance = obj)
+            _clear_many_to_many(model, uids)
+            _bulk_delete(model, uids)
+            for obj in objs:
+                if send: signals.post_delete.send(sender = model, instance = obj)
+        return actions
 
     def undo_action(self, action):
         """Undo the given action"""
         action.undo(self)
 
+    @_history_transaction
+    def undo_actions(self, actions):
+        """Undo many actions in a single transaction
+
+        Takes a queryset or a list of Actions. They are undone from the
+        latest to the earliest, CHUNK_SIZE at a time, and an action that
+        only becomes revertible once some of the others are undone is
+        undone after them. Returns the list of errors of the actions that
+        could not be undone.
+        """
+        if isinstance(actions, QuerySet):
+            actions = actions.order_by("-id")
+            def chunks():
+                chunk = list(actions[:CHUNK_SIZE])
+                while chunk:
+                    yield chunk
+                    chunk = list(actions.filter(
+                        id__lt = chunk[-1].id)[:CHUNK_SIZE])
+        else:
+            actions = sorted(actions, key=lambda a: a.id, reverse=True)
+            def chunks():
+                return _chunks(actions)
+        failed = []
+        unchanged = []
+        for chunk in chunks():
+            pending = failed + chunk
+            while pending:
+                handled = self._undo_revertible(pending)
+                if not handled: break
+                unchanged.extend([a for a in handled if not a.reverted_id])
+                handled = set(a.id for a in handled)
+                pending = [a for a in pending if a.id not in handled]
+            # These might still be undone after the older ones
+            failed = pending
+        errors = []
+        for action in sorted(failed + unchanged, key=lambda a: -a.id):
+            errors.extend(action.undo_errors)
+        return errors
+
+    def _undo_revertible(self, actions):
+        """Undo the latest of the given Actions, ordered from the latest to
+        the earliest, that are revertible right now and don't depend on
+        each other. Return the list of the Actions that were handled, those
+        that didn't need any changes are left without reverted."""
+        errors = Action.check_revertible(actions)
+        # Undoing a creation deletes an object, which could keep a
+        # later restoration from being revertible and vice versa, so only
+        # one kind is undone at a time. Each object is only touched once.
+        deleting = None
+        undone = []
+        uids = set()
+        for action in actions:
+            if errors[action.id] or action.object_uid in uids: continue
+            if deleting is None:
+                deleting = action.action_type == "cr"
+            elif deleting != (action.action_type == "cr"):
+                break
+            undone.append(action)
+            uids.add(action.object_uid)
+        if not undone: return []
+
+        infos = _object_information(uids)
+        by_model = {}
+        for action in undone:
+            model = infos[action.object_uid].content_type.model_class()
+            by_model.setdefault(model, []).append(action)
+
+        reverts = {}
+        if deleting:
+            for model, created in by_model.items():
+                objs = model._default_manager.filter(
+                    pk__in = [action.object_uid for action in created])
+                for revert in self._delete_objects(model, list(objs), False):
+                    reverts[revert.object_uid] = revert
+        else:
+            # Restore every object as it was right before its action
+            values = _values_before(undone)
+            objs = []
+            for model, restored in by_model.items():
+                fields, fks = _tracked_fields(model)
+                existing = model._default_manager.in_bulk(
+                    [action.object_uid for action in restored])
+                for action in restored:
+                    obj = existing.get(action.object_uid)
+                    if obj is None:
+                        obj = model(uid = action.object_uid)
+                    before = values[action.id]
+                    for key in fields:
+                        field = model._meta.get_field(key)
+                        if key not in before:
+                            # Added to the model after the object was last
+                            # saved, it had the value the column was added
+                            # with
+                            setattr(obj, field.attname, field.get_default())
+                        elif key in fks:
+                            setattr(obj, field.attname, before[key])
+                        else:
+                            setattr(obj, key, _decode_value(before[key]))
+                    obj.save()
+                    objs.append(obj)
+            for revert in save_objects(objs, self):
+                reverts[revert.object_uid] = revert
+
+        for action in undone:
+            revert = reverts.get(action.object_uid)
+            if revert is None:
+                # Nothing to change, the object is already in that state
+                action._Action__undo_errors = [
+                    "Cannot undo action %s: the %s is already as it was"
+                    " before it"
+                    % (action.id,
+                       infos[action.object_uid].content_type.name,)]
+                action.reverted_id = None
+                continue
+            action.reverted_id = revert.id
+        _record_reverts([action for action in undone if action.reverted_id])
+        return undone
+
 def get_uuid():
     return uuid.uuid4().hex
 
@@ -187,6 +1085,15 @@ class DisciplinedModel(Model):
     class Meta:
         abstract = True
     
+class ActionManager(Manager):
+
+    def for_model(self, model):
+        """Return the Actions on objects of the given model or ContentType,
+        using the content_type column instead of joining the commits."""
+        if not isinstance(model, ContentType):
+            model = ContentType.objects.get_for_model(model)
+        return self.filter(content_type = model)
+
 class Action(Model):
 
     """Represents a unit of change at a specific point in time by a 
@@ -221,6 +1128,17 @@ class Action(Model):
         db_index = True,
     )
 
+    # The model of the object, copied from its CreationCommit to look up
+    # the history of a model without joining. Null for Actions written
+    # before it existed, see the discipline_action_content_types command.
+    content_type = ForeignKey(
+        ContentType,
+        null = True,
+        db_index = True,
+    )
+
+    objects = ActionManager()
+
     class Meta:
         # Most of the time you will need most recent
         ordering = ["-when"]
@@ -229,19 +1147,75 @@ class Action(Model):
     def __unicode__(self):
         return "%s: %s" % (unicode(self.editor), unicode(self.when))
     
+    # Set by Action.prefetch: the ContentType of the object and whether it
+    # presently exists
+    __presently = None
+
+    @instrumented("Action._description")
     def _description(self):
         """A concise html explanation of this Action."""
 
-        inst = self.timemachine.presently
+        if self.__presently:
+            content_type, exists = self.__presently
+        elif self.content_type_id and self.action_type == "dl":
+            content_type = ContentType.objects.get_for_id(
+                self.content_type_id)
+            exists = False
+        else:
+            info = _object_information([self.object_uid])[self.object_uid]
+            content_type = info.content_type
+            exists = self.action_type != "dl" and \
+                _exists_at(info, info.last_action_id)
 
         if self.action_type == "dl":
-            return "Deleted %s" % inst.content_type.name
+            return "Deleted %s" % content_type.name
         elif self.action_type == "cr":
-            return "Created %s" % inst._object_type_html()
+            return "Created %s" % _object_type_html(
+                content_type, self.object_uid, exists)
         else:
-            return "Modified %s" % inst._object_type_html()
+            return "Modified %s" % _object_type_html(
+                content_type, self.object_uid, exists)
 
     _description.allow_tags = True
+
+    def prefetch(cls, actions):
+        """Fetch what the admin shows about many Actions at once.
+
+        Take a queryset or a list of Actions and return them as a list,
+        with their editors and users, the Actions they revert or are
+        reverted by and the type and existence of their objects already
+        loaded. Runs a constant number of queries for every CHUNK_SIZE
+        Actions.
+
+        """
+        actions = list(actions)
+        if not actions: return actions
+        present = Action.objects.order_by("-id")[0].id
+        infos = _object_information(set(a.object_uid for a in actions))
+        editors = Editor.objects.select_related("user").in_bulk(
+            list(set(a.editor_id for a in actions)))
+        reverted = {}
+        reverts = {}
+        for chunk in _chunks(actions):
+            reverted.update(Action.objects.in_bulk(
+                [a.reverted_id for a in chunk if a.reverted_id]))
+            for action in Action.objects.filter(
+                    reverted__in = [a.id for a in chunk]):
+                reverts[action.reverted_id] = action
+        editor_cache = cls._meta.get_field("editor").get_cache_name()
+        reverted_cache = cls._meta.get_field("reverted").get_cache_name()
+        for action in actions:
+            info = infos[action.object_uid]
+            action.__presently = (info.content_type,
+                                  _exists_at(info, present))
+            setattr(action, editor_cache, editors[action.editor_id])
+            if action.reverted_id:
+                setattr(action, reverted_cache,
+                        reverted[action.reverted_id])
+            action.__reverts = reverts.get(action.id)
+        return actions
+
+    prefetch = classmethod(prefetch)
     
     # To save database queries
     __timemachine = False
@@ -259,86 +1233,53 @@ class Action(Model):
 
     timemachine = property(__get_timemachine)
 
-    def __get_is_revertible(self):
-        """Return a boolean representing whether this Action is revertible
-        or not"""
+    def check_revertible(cls, actions):
+        """Find out whether many Actions are revertible at the same time.
 
-        # If it was already reverted
-        if self.reverted:
-            return False
+        Take a queryset or a list of Actions, return a dict mapping the id
+        of each to a list of the errors that keep it from being undone,
+        empty if it is revertible. The undo_errors of every Action are set
+        too. The number of queries doesn't grow with the number of Actions,
+        only with the number of objects divided by CHUNK_SIZE.
 
-        errors = []
-        inst = self.timemachine
-        
-        if inst.fields != inst.presently.fields or \
-           inst.foreignkeys != inst.presently.foreignkeys:
-           self.__undo_errors = [
-               "Cannot undo action %s. The database schema"
-               " for %s has changed"
-                % (self.id,
-                   inst.content_type.name,)]
-           return False
+        """
+        actions = list(actions)
+        errors = dict((action.id, []) for action in actions)
+        pending = []
+        for action in actions:
+            if action.reverted_id:
+                errors[action.id].append(
+                    "Cannot undo action %s: it was already undone"
+                    % action.id)
+            else:
+                pending.append(action)
+        if pending:
+            _check_revertible(pending, errors)
+        for action in actions:
+            action.__undo_errors = errors[action.id]
+        return errors
 
+    check_revertible = classmethod(check_revertible)
 
-        if self.action_type in ["dl", "md"]:
-            # If undoing deletion, make sure it actually doesn't exist
-            if self.action_type == "dl" and inst.presently.exists:
-                errors.append(
-                    "Cannot undo action %d: the %s you are trying to"
-                    " recreate already exists"
-                    % (self.id,
-                       inst.content_type.name,))
-            # The only problem we can have by reversing this action
-            # is that some of its foreignkeys could be pointing to
-            # objects that have since been deleted.
-            check_here = inst.at_previous_action
-            for field in inst.foreignkeys:
-                fk = check_here.get_timemachine_instance(field)
-                # If the ForeignKey doesn't have a value
-                if not fk: continue
-                if not fk.exists:
-                    errors.append(
-                        "Cannot undo action %s: the %s used to link to"
-                        " a %s that has since been deleted"
-                        % (self.id,
-                           inst.content_type.name,
-                           fk.content_type.name,))
+    @instrumented("Action.is_revertible")
+    def __get_is_revertible(self):
+        """Return a boolean representing whether this Action is revertible
+        or not"""
 
-        else: # self.action_type == "cr"
-            # Make sure it actually exists
-            if not self.timemachine.presently.exists:
-                errors.append(
-                    "Cannot undo action %s: the %s you are trying"
-                    " to delete doesn't currently exist"
-                    % (self.id, inst.content_type.name,))
-            # The only problem we can have by undoing this action is
-            # that it could have foreignkeys pointed to it, so deleting
-            # it will cause deletion of other objects
-            else:
-                links = [rel.get_accessor_name() 
-                         for rel in \
-                         inst.get_object()._meta.get_all_related_objects()]
-                for link in links:
-                    objects = getattr(inst.get_object(), link).all()
-                    for rel in objects:
-                        errors.append(
-                           "Cannot undo action %s: you are trying to"
-                           " delete a %s that has a %s pointing to it" %
-                           (self.id, 
-                            inst.content_type.name,
-                            ContentType.objects.get_for_model(rel.__class__),))
-
-        self.__undo_errors = errors
-        return (len(errors) == 0)
+        return not Action.check_revertible([self])[self.id]
 
     is_revertible = property(__get_is_revertible)
 
+    __undo_errors = None
+
     def __get__undo_errors(self):
-        if self.__undo_errors == None: self._get__is_revertible()
+        if self.__undo_errors is None: self.is_revertible
         return self.__undo_errors
 
     undo_errors = property(__get__undo_errors)
 
+    @instrumented("Action.undo")
+    @_history_transaction
     def undo(self, editor):
         """Create a new Action that undos the effects of this one, or,
         more accurately, reverts the object of this Action to the state
@@ -363,22 +1304,35 @@ class Action(Model):
             # This is safe from race conditions but still a pretty inelegant
             # solution. I can't figure out a different way to find the last action
             # for now
-            self.reverted = DeletionCommit.objects.filter(
+            self.reverted = _by_action(DeletionCommit.objects.filter(
                 object_uid = self.object_uid
-            ).order_by("-action__id")[0].action
+            ))[0].action
             self.save()
 
+    # The Action that this one reverts, False if not looked up yet
+    __reverts = False
+
+    def __get_reverts(self):
+        if self.__reverts is False:
+            # Turns out that is related field in null, Django
+            # doesn't even make it a property of the object
+            # http://code.djangoproject.com/ticket/11920
+            try:
+                self.__reverts = self.reverts
+            except Action.DoesNotExist:
+                self.__reverts = None
+        return self.__reverts
+
+    @instrumented("Action._status")
     def _status(self):
         """Return html saying whether this Action is reverted by another
         one or reverts another one."""
         text = ""
-        # Turns out that is related field in null, Django
-        # doesn't even make it a property of the object
-        # http://code.djangoproject.com/ticket/11920
-        if hasattr(self, "reverts"):
+        reverts = self.__get_reverts()
+        if reverts:
             text += '(reverts <a href="%s">%s</a>)<br/>' % (
-                self.reverts.get_absolute_url(),
-                self.reverts.id
+                reverts.get_absolute_url(),
+                reverts.id
             )
         if self.reverted:
             text += '(reverted in <a href="%s">%s</a>)<br/>' % (
@@ -400,49 +1354,94 @@ class Action(Model):
         text = "Time: %s\n" % self.when
         text += "Comitter: %s\n" % self.editor
 
-        inst = self.timemachine.presently
+        name = ContentType.objects.get_for_id(
+            self._get_rendered().content_type_id).name
 
         if self.action_type == "dl":
-            text += "Deleted %s\n" % inst._object_type_text()
+            text += "Deleted %s\n" % name
         elif self.action_type == "cr":
-            text += "Created %s\n" % inst._object_type_text()
+            text += "Created %s\n" % name
         else:
-            text += "Modified %s\n" % inst._object_type_text()
+            text += "Modified %s\n" % name
         text += self._details(nohtml=True)
         return text
 
     summary = property(__summary)
 
+    # The RenderedAction, looked up or created by _get_rendered
+    __rendered = None
+
+    def _get_rendered(self):
+        """Return the RenderedAction of this Action, rendering it first if
+        it doesn't have one yet."""
+        if self.__rendered is None:
+            try:
+                self.__rendered = RenderedAction.objects.get(action = self)
+            except RenderedAction.DoesNotExist:
+                inst = self.timemachine
+                # If deleted or created, show every field, otherwise only
+                # the modified
+                if self.action_type in ("dl","cr",):
+                    fields = inst.fields + inst.foreignkeys
+                else: fields = [i.key for i in self.modification_commits.all()]
+                parts = []
+                for field in fields:
+                    # If modified, show what it was like one step earlier
+                    if self.action_type == "md":
+                        old = inst.at_previous_action._field_value_part(field)
+                    else:
+                        old = None
+                    parts.append([field, old, inst._field_value_part(field)])
+                self.__rendered = RenderedAction(
+                    action = self,
+                    content_type = inst.content_type,
+                    parts = json.dumps(parts),
+                )
+                sid = transaction.savepoint()
+                try:
+                    self.__rendered.save(force_insert = True)
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    # Rendered at the same time somewhere else
+                    transaction.savepoint_rollback(sid)
+        return self.__rendered
+
+    @instrumented("Action._details")
     def _details(self, nohtml=False):
         """Return the html representation of the Action."""
         text = ""
-        inst = self.timemachine
-
-        # If deleted or created, show every field, otherwise only
-        # the modified
-        if self.action_type in ("dl","cr",):
-            fields = inst.fields + inst.foreignkeys
-        else: fields = [i.key for i in self.modification_commits.all()]
-
-        for field in fields:
+        parts = self._get_rendered().get_parts()
+
+        # The names of related objects can change, so they are looked up
+        # every time
+        refs = []
+        for field, old, new in parts:
+            for value in (old, new):
+                if value and value[0] == "object":
+                    refs.append(tuple(value[1:]))
+        names = _object_names(refs, html = not nohtml)
+
+        def show(value):
+            if value[0] == "object":
+                return names[tuple(value[1:])]
+            return value[1]
+
+        for field, old, new in parts:
             if not nohtml:
                 text += "<strong>%s</strong>: " % field
             else:
                 text += "%s: " % field
 
-            # If modified, show what it was like one step earlier
-            if self.action_type == "md":
+            if old is not None:
                 if not nohtml:
-                    text += "%s &#8594; " % \
-                            inst.at_previous_action._field_value_html(field)
+                    text += "%s &#8594; " % show(old)
                 else:
-                    text += "%s -> " % \
-                            inst.at_previous_action._field_value_text(field)
+                    text += "%s -> " % show(old)
 
             if not nohtml:
-                text += "%s<br/>" % inst._field_value_html(field)
+                text += "%s<br/>" % show(new)
             else:
-                text += "%s\n" % inst._field_value_text(field)
+                text += "%s\n" % show(new)
 
         return text   
 
@@ -496,6 +1495,439 @@ class ModificationCommit(Model):
     )
     value = TextField(null=True)
  
+# Times are kept in the index as microseconds since then, a float holds
+# them exactly
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _to_microseconds(when):
+    delta = when - _EPOCH
+    return float((delta.days * 86400 + delta.seconds) * 1000000 +
+                 delta.microseconds)
+
+def _from_microseconds(microseconds):
+    return _EPOCH + datetime.timedelta(microseconds = microseconds)
+
+# How long after the Action that follows it a missing id is looked for, in
+# seconds. An Action committed after others with higher ids shows up by
+# then, the id of a rolled back Action never does.
+_GAP_TIMEOUT = 60
+
+class _ActionIndex(object):
+
+    """The id and time of every Action in two arrays sorted by id, to find
+    the step at a point in time and the time of a step by binary search
+    instead of querying the biggest table. Loaded on first use, then only
+    the Actions after the last known one are read, along with the last
+    known one itself: if it was rolled back, the index starts over.
+
+    Ids missing from the Actions read are looked for again for
+    _GAP_TIMEOUT seconds, from the first of them on, and an Action
+    committed late is put in its place. Until then, step_at leaves times
+    after the Action before the first missing id to the database.
+
+    An Action whose time is out of order with those of its neighbours
+    (concurrent writers) is found by step_at at the nearest time that keeps
+    the times sorted. Its own time is still what _when_of returns. The
+    index can be turned off with the DISCIPLINE_ACTION_INDEX setting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.__reset()
+
+    def clear(self):
+        """Forget every Action, for example after rolling back a
+        transaction that created some."""
+        self.lock.acquire()
+        try:
+            self.__reset()
+        finally:
+            self.lock.release()
+
+    def __reset(self):
+        self.ids = array.array("l")
+        self.whens = array.array("d")
+        # The real time of Actions whose time in whens was moved to keep
+        # it sorted
+        self.exceptions = {}
+        # The missing ids, with the time of the Action after them
+        self.gaps = {}
+
+    def __when(self, i):
+        id = self.ids[i]
+        if id in self.exceptions:
+            return self.exceptions[id]
+        return _from_microseconds(self.whens[i])
+
+    def __insert(self, i, id, when):
+        """Put an Action at position i of the arrays."""
+        microseconds = _to_microseconds(when)
+        if i and microseconds < self.whens[i - 1]:
+            microseconds = self.whens[i - 1]
+        elif i < len(self.whens) and microseconds > self.whens[i]:
+            microseconds = self.whens[i]
+        if microseconds != _to_microseconds(when):
+            self.exceptions[id] = when
+        self.ids.insert(i, id)
+        self.whens.insert(i, microseconds)
+
+    def __gap_start(self):
+        """Return the time after which step_at can't answer because of
+        missing ids, or None."""
+        if not self.gaps: return None
+        i = bisect.bisect_left(self.ids, min(self.gaps))
+        return i and self.whens[i - 1] or 0.0
+
+    def __catch_up(self):
+        """Add the Actions created since the last known one and those with
+        missing ids that appeared, starting over if the last known one
+        changed. Called with the lock held."""
+        recent = _to_microseconds(datetime.datetime.now()) - \
+            _GAP_TIMEOUT * 1000000
+        for id, after in self.gaps.items():
+            if after < recent: del self.gaps[id]
+        last = self.ids and self.ids[-1] or 0
+        start = min(self.gaps.keys() + [last])
+        rows = list(Action.objects.filter(id__gte = start).order_by("id")
+                    .values_list("id", "when")[:last - start + 1 +
+                                               CHUNK_SIZE * 10])
+        if last and [row for row in rows if row[0] == last] != \
+                [(last, self.__when(-1))]:
+            self.__reset()
+            return self.__catch_up()
+        chunk = []
+        for id, when in rows:
+            if id in self.gaps:
+                del self.gaps[id]
+                self.__insert(bisect.bisect_left(self.ids, id), id, when)
+            elif id > last:
+                chunk.append((id, when))
+        while True:
+            for id, when in chunk:
+                if last and _to_microseconds(when) >= recent:
+                    for missing in xrange(last + 1, id):
+                        self.gaps[missing] = _to_microseconds(when)
+                self.__insert(len(self.ids), id, when)
+                last = id
+            if len(chunk) < CHUNK_SIZE * 10: break
+            chunk = list(Action.objects.filter(id__gt = last)
+                         .order_by("id")
+                         .values_list("id", "when")[:CHUNK_SIZE * 10])
+
+    def catch_up(self):
+        """Add the Actions created since the last known one."""
+        self.lock.acquire()
+        try:
+            self.__catch_up()
+        finally:
+            self.lock.release()
+
+    def step_at(self, when):
+        """Return the id of the last Action done at or before the given
+        time, or None if there is none or it can't be told yet."""
+        microseconds = _to_microseconds(when)
+        self.lock.acquire()
+        try:
+            # Only Actions done after the last known one can change the
+            # answer, or ones with missing ids
+            gap_start = self.__gap_start()
+            if not self.whens or microseconds >= self.whens[-1] or \
+                    gap_start is not None and microseconds >= gap_start:
+                self.__catch_up()
+                gap_start = self.__gap_start()
+                if gap_start is not None and microseconds >= gap_start:
+                    return None
+            i = bisect.bisect_right(self.whens, microseconds)
+            if not i: return None
+            return self.ids[i - 1]
+        finally:
+            self.lock.release()
+
+    def when_of(self, step):
+        """Return the time of the Action with the given id, or None if it
+        isn't known."""
+        self.lock.acquire()
+        try:
+            if not self.ids or step > self.ids[-1] or step in self.gaps:
+                self.__catch_up()
+            i = bisect.bisect_left(self.ids, step)
+            if i == len(self.ids) or self.ids[i] != step:
+                return None
+            return self.__when(i)
+        finally:
+            self.lock.release()
+
+_action_index = _ActionIndex()
+
+def _action_index_enabled():
+    return getattr(settings, "DISCIPLINE_ACTION_INDEX", True)
+
+def _step_at(when):
+    """Return the id of the last Action done at or before the given time."""
+    if _action_index_enabled():
+        step = _action_index.step_at(when)
+        if step is not None: return step
+    try:
+        return Action.objects.filter(
+            when__lte = when
+        )[0].id
+    except IndexError:
+        raise DisciplineException("You tried to get an a TimeMachine"
+                "at current action, but there is no action!")
+
+def _when_of(step):
+    """Return the time of the Action with the given id."""
+    if _action_index_enabled():
+        when = _action_index.when_of(step)
+        if when is not None: return when
+    return Action.objects.get(id = step).when
+
+def _last_action_id():
+    """Return the id of the latest Action, or 0 if there is none. Ids only
+    grow, so it tells whether any Action was done since it was last read,
+    and unlike counting the Actions it only reads the end of an index."""
+    ids = list(Action.objects.order_by("-id")
+               .values_list("id", flat = True)[:1])
+    return ids and ids[0] or 0
+
+class _ObjectInformation(object):
+
+    """What doesn't change about an object at different points in time:
+    its ContentType, the ids of the Actions that created and deleted it in
+    sorted tuples, and the id of the latest Action when this was read.
+    Immutable, so every TimeMachine of the object can share one."""
+
+    __slots__ = ("content_type", "creation_times", "deletion_times",
+                 "last_action_id")
+
+    def __init__(self, content_type, creation_times, deletion_times,
+                 last_action_id):
+        set = super(_ObjectInformation, self).__setattr__
+        set("content_type", content_type)
+        set("creation_times", tuple(sorted(creation_times)))
+        set("deletion_times", tuple(sorted(deletion_times)))
+        set("last_action_id", last_action_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Object information can't be changed")
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, key):
+        # Used to be a dict
+        return getattr(self, key)
+
+def _object_information(uids):
+    """Return a dict mapping each of the given uids to the information
+    about the object that doesn't change at different points in time, an
+    _ObjectInformation. Runs two queries for every CHUNK_SIZE uids.
+    """
+    last_action_id = _last_action_id()
+    creation_times = {}
+    deletion_times = {}
+    for uid in uids:
+        creation_times[uid] = []
+        deletion_times[uid] = []
+    content_types = {}
+    for chunk in _chunks(creation_times.keys()):
+        creations = CreationCommit.objects.filter(object_uid__in = chunk) \
+            .values_list("object_uid", "action", "content_type")
+        for uid, action, content_type in creations:
+            creation_times[uid].append(action)
+            # The type of the object is that of its latest creation
+            if action >= max(creation_times[uid]):
+                content_types[uid] = content_type
+        deletions = DeletionCommit.objects.filter(object_uid__in = chunk) \
+            .values_list("object_uid", "action")
+        for uid, action in deletions:
+            deletion_times[uid].append(action)
+    infos = {}
+    for uid in creation_times:
+        if uid not in content_types:
+            raise DisciplineException("You tried to make a TimeMachine out of"
+                               " an object that doesn't exist!")
+        infos[uid] = _ObjectInformation(
+            ContentType.objects.get_for_id(content_types[uid]),
+            creation_times[uid], deletion_times[uid], last_action_id)
+    return infos
+
+def _exists_at(info, step):
+    """Return whether the object with the given information (see
+    _object_information) existed right after the Action with the given
+    id."""
+    # The *last* time that it was created
+    i = bisect.bisect_right(info.creation_times, step)
+    if not i: return False
+    created_on = info.creation_times[i - 1]
+
+    # The *last* time that it was deleted
+    i = bisect.bisect_right(info.deletion_times, step)
+    if i and info.deletion_times[i - 1] > created_on: return False
+
+    return True
+
+def _object_url(content_type, uid):
+    """Return the admin url of the object with the given ContentType and
+    uid."""
+    return urlresolvers.reverse(
+        "admin:%s_%s_change" % (content_type.app_label, content_type.model),
+        args = (uid,))
+
+def _object_type_html(content_type, uid, exists):
+    """Return an html admin link with the object's type as text. If the
+    object doesn't exist, return the object's type crossed out."""
+    if exists:
+        return "<a href=\"%s\">%s</a>" % (_object_url(content_type, uid),
+                                          content_type.name,)
+    else:
+        return "<s>%s</s>" % content_type.name
+
+def _object_names(refs, html):
+    """Take a list of (ContentType id, uid) tuples and return a dict mapping
+    each of them to the name of the object, as an html admin link or as
+    text, or "(deleted)" if it doesn't exist anymore. Runs a query for every
+    model."""
+    uids = {}
+    for content_type_id, uid in refs:
+        uids.setdefault(content_type_id, set()).add(uid)
+    names = {}
+    for content_type_id, model_uids in uids.items():
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        model = content_type.model_class()
+        objs = {}
+        if model is not None:
+            objs = model._default_manager.in_bulk(list(model_uids))
+        for uid in model_uids:
+            obj = objs.get(uid)
+            if obj is None:
+                name = "(deleted)"
+            elif html:
+                name = "<a href=\"%s\">%s</a>" % (
+                    _object_url(content_type, uid), unicode(obj))
+            else:
+                name = unicode(obj)
+            names[(content_type_id, uid)] = name
+    return names
+
+def _check_revertible(actions, errors):
+    """Add the reasons why each of the given Actions that haven't been
+    reverted can't be undone to its list in errors, a dict keyed by Action
+    id. See Action.check_revertible.
+    """
+    present = Action.objects.order_by("-id")[0]
+    infos = _object_information(set(a.object_uid for a in actions))
+
+    # Like a TimeMachine, use the last SchemaState before the given time
+    schema_states = _schema_timeline.states(present.when)
+    now = _schema_timeline.index(present.when)
+
+    # Every model is only compared once for every SchemaState
+    schemas = {}
+    restores = []
+    creations = {}
+
+    for action in actions:
+        info = infos[action.object_uid]
+        content_type = info.content_type
+        then = _schema_timeline.index(action.when)
+        key = (content_type.id, then)
+        if key not in schemas:
+            old = then and schema_states[then - 1] \
+                .get_for_content_type(content_type)
+            new = now and schema_states[now - 1] \
+                .get_for_content_type(content_type)
+            if not old or not new or old["fields"] != new["fields"] or \
+               old["foreignkeys"] != new["foreignkeys"]:
+                old = None
+            schemas[key] = old
+        schema = schemas[key]
+
+        if not schema:
+            errors[action.id].append(
+                "Cannot undo action %s. The database schema"
+                " for %s has changed"
+                % (action.id, content_type.name,))
+            continue
+
+        exists = _exists_at(info, present.id)
+
+        if action.action_type in ["dl", "md"]:
+            # If undoing deletion, make sure it actually doesn't exist
+            if action.action_type == "dl" and exists:
+                errors[action.id].append(
+                    "Cannot undo action %d: the %s you are trying to"
+                    " recreate already exists"
+                    % (action.id, content_type.name,))
+            # Its foreignkeys could be pointing to objects that have
+            # since been deleted, these are checked all at once below
+            if schema["foreignkeys"]:
+                restores.append((action, schema["foreignkeys"]))
+
+        else: # action.action_type == "cr"
+            # Make sure it actually exists
+            if not exists:
+                errors[action.id].append(
+                    "Cannot undo action %s: the %s you are trying"
+                    " to delete doesn't currently exist"
+                    % (action.id, content_type.name,))
+            # Otherwise it could have foreignkeys pointed to it, checked
+            # below for every model at once
+            else:
+                creations.setdefault(content_type, []).append(action)
+
+    if restores:
+        # The values of the foreignkeys right before each Action
+        keys = set()
+        for action, foreignkeys in restores:
+            keys.update(foreignkeys)
+        history = {}
+        last = max(action.id for action, foreignkeys in restores)
+        uids = list(set(action.object_uid for action, foreignkeys in restores))
+        for chunk in _chunks(uids):
+            modcommits = ModificationCommit.objects.filter(
+                object_uid__in = chunk,
+                key__in = list(keys),
+                action__id__lt = last,
+            ).values_list("object_uid", "key", "action", "value")
+            for uid, key, step, value in modcommits:
+                history.setdefault((uid, key), []).append((step, value))
+        links = []
+        for action, foreignkeys in restores:
+            for key in foreignkeys:
+                commits = sorted(history.get((action.object_uid, key), []))
+                i = bisect.bisect_left(commits, (action.id,)) - 1
+                # If the ForeignKey doesn't have a value
+                if i < 0 or not commits[i][1]: continue
+                links.append((action, commits[i][1]))
+        if links:
+            targets = _object_information(set(uid for a, uid in links))
+            for action, uid in links:
+                if not _exists_at(targets[uid], present.id):
+                    errors[action.id].append(
+                        "Cannot undo action %s: the %s used to link to"
+                        " a %s that has since been deleted"
+                        % (action.id,
+                           infos[action.object_uid].content_type.name,
+                           targets[uid]["content_type"].name,))
+
+    for content_type, created in creations.items():
+        uids = [action.object_uid for action in created]
+        for rel in content_type.model_class()._meta.get_all_related_objects():
+            linked = set()
+            for chunk in _chunks(uids):
+                linked.update(rel.model._default_manager.filter(**{
+                    "%s__in" % rel.field.name: chunk,
+                }).order_by().values_list(rel.field.attname, flat=True) \
+                  .distinct())
+            for action in created:
+                if action.object_uid in linked:
+                    errors[action.id].append(
+                       "Cannot undo action %s: you are trying to"
+                       " delete a %s that has a %s pointing to it" %
+                       (action.id,
+                        content_type.name,
+                        ContentType.objects.get_for_model(rel.model),))
+
 class TimeMachine:
 
     """Use this to find the state of objects at different moments in time.
@@ -512,43 +1944,43 @@ class TimeMachine:
 
     """
 
-    def __init__(self, uid, when=None, step=None, info=None):
+    @instrumented("TimeMachine.__init__")
+    def __init__(self, uid, when=None, step=None, info=None,
+                 schema_state=None, history=None):
 
         self.uid = uid
+        self.__history = history
 
         if not when and not step: when = datetime.datetime.now()
         
-        if when:
-            self.when = when 
+        if when and step:
+            # Both are known already (see TimeMachine.bulk)
+            self.when = when
+            self.step = step
 
-            try:
-                self.step = Action.objects.filter(
-                    when__lte = self.when
-                )[0].id
-            except IndexError:
-                raise DisciplineException("You tried to get an a TimeMachine"
-                        "at current action, but there is no action!")
+        elif when:
+            self.when = when 
+            self.step = _step_at(when)
 
         elif step:
             self.step = step
-            self.when = Action.objects.get(id = step).when
+            self.when = _when_of(step)
 
 
         if not info:
-            info = self.__update_information()
+            self.__update_information()
         else:
             self.info = info
-            for key in info.keys():
-                setattr(self, key, info[key])
 
         # Find the last SchemaState for this model in this app
-        ss = SchemaState.objects.filter(when__lt = self.when)[0]\
-                .get_for_content_type(self.content_type)
+        if not schema_state:
+            schema_state = _schema_timeline.at(self.when)
+        ss = schema_state.get_for_content_type(self.content_type)
 
         self.model_exists = not not ss
 
         if not self.model_exists: 
-            if sorted(self.creation_times)[0] <= self.step:
+            if self.creation_times[0] <= self.step:
                 raise DisciplineIntegrityError(
                     "%s with uid %s was created before the schema for its" \
                     " model was registered by Discipline (created: %s)." \
@@ -564,35 +1996,35 @@ class TimeMachine:
         """Gether information that doesn't change at different points in
         time"""
 
-        info = {}
+        self.info = _object_information([self.uid])[self.uid]
 
-        info["actions_count"] = Action.objects.count()
-        
-        info["creation_times"] = []
-        info["deletion_times"] = []
-
-        info["content_type"] = None
-
-        # Find object type and when it was created
-
-        for ccommit in CreationCommit.objects.filter(object_uid=self.uid):
-            info["creation_times"].append(ccommit.action.id)
-        info["creation_times"].sort()
+    # The information is shared by the TimeMachines of the object
+    content_type = property(lambda self: self.info.content_type)
+    creation_times = property(lambda self: self.info.creation_times)
+    deletion_times = property(lambda self: self.info.deletion_times)
+    last_action_id = property(lambda self: self.info.last_action_id)
 
-        for dcommit in DeletionCommit.objects.filter(object_uid=self.uid):
-            info["deletion_times"].append(dcommit.action.id)
-        info["deletion_times"].sort()
-
-        try:
-            info["content_type"] = ccommit.content_type
-        except NameError:
-            raise DisciplineException("You tried to make a TimeMachine out of"
-                               " an object that doesn't exist!")
+    def bulk(cls, uids, when=None, step=None):
+        """Return TimeMachines for many objects at the same time.
 
-        self.info = info
+        Take a list of uids and optionally when or step (see the
+        constructor), return a dict mapping each uid to its TimeMachine.
+        Unlike constructing each TimeMachine separately, this runs a
+        constant number of queries for every 500 objects.
 
-        for key in info.keys():
-            setattr(self, key, info[key])
+        """
+        if not when and not step: when = datetime.datetime.now()
+        if when and not step: step = _step_at(when)
+        elif step and not when: when = _when_of(step)
+        schema_state = _schema_timeline.at(when)
+        timemachines = {}
+        for uid, info in _object_information(uids).items():
+            timemachines[uid] = cls(uid, when = when, step = step,
+                                    info = info,
+                                    schema_state = schema_state)
+        return timemachines
+
+    bulk = classmethod(bulk)
     
     def at(self, step):
         """Return a TimeMachine for the same object at a different time.
@@ -602,10 +2034,15 @@ class TimeMachine:
         at the time right after the Action.
 
         """
+        history = self.__history
+        # The history doesn't know about later Actions
+        if history is not None and step > history.last_action_id:
+            history = None
         return TimeMachine(
             self.uid,
             step = step,
-            info = copy.deepcopy(self.info)
+            info = self.info,
+            history = history,
         )
         
     def __presently(self):
@@ -618,20 +2055,138 @@ class TimeMachine:
 
     at_previous_action = property(__at_previous_action)
 
-    def _get_modcommit(self, key):
+    def _get_modcommit(self, key, after=None):
         """Return the last modcommit of the given field. If no
         modcommit exists (for example after a migration that created
-        new fields) returns None.
+        new fields) returns None. If after is given, only look at
+        modcommits of later Actions than the one with that id.
         """
+        modcommits = ModificationCommit.objects.filter(
+            object_uid = self.uid,
+            key = key,
+            action__id__lte = self.step
+        )
+        if after is not None:
+            modcommits = modcommits.filter(action__id__gt = after)
         try:
-            return ModificationCommit.objects.filter(
-                object_uid = self.uid,
-                key = key,
-                action__id__lte = self.step
-            ).order_by("-action__id")[0]
+            return _by_action(modcommits)[0]
         except IndexError:
             return None
 
+    __checkpoint = False
+
+    def _get_checkpoint(self):
+        """Return the latest Checkpoint at or before the time of this
+        TimeMachine, or None."""
+        if self.__checkpoint is False:
+            self.__checkpoint = None
+            if _checkpoint_interval() is not None:
+                try:
+                    self.__checkpoint = _by_action(Checkpoint.objects.filter(
+                        object_uid = self.uid,
+                        action__id__lte = self.step,
+                    ))[0]
+                except IndexError:
+                    pass
+        return self.__checkpoint
+
+    def checkpoint(self):
+        """Save a Checkpoint of the object at the time of this TimeMachine
+        and return it, making later lookups of its past cheaper."""
+        checkpoint = Checkpoint.objects.create(
+            object_uid = self.uid,
+            action_id = self.step,
+            state = json.dumps(_latest_values(self.uid, self.step)),
+        )
+        self.__checkpoint = checkpoint
+        return checkpoint
+
+    __object_state = False
+
+    def _get_object_state(self):
+        """Return the ObjectState of this object if it is maintained and
+        already describes the object at the time of this TimeMachine, that
+        is, no Action on this object has happened since. Otherwise None."""
+        if self.__object_state is False:
+            self.__object_state = _get_object_state(self.uid)
+        if self.__object_state and self.__object_state.step <= self.step:
+            return self.__object_state
+        return None
+
+    __values = None
+
+    # Maps field names to the key of their decoded values in value_cache:
+    # the id of the ModificationCommit they come from, or what identifies
+    # the Checkpoint or ObjectState that holds them
+    __sources = None
+
+    def _get_values(self):
+        """Return a dict mapping the name of every field with a value to
+        its encoded value. Runs at most one query for the values and
+        caches them, since the past doesn't change."""
+        if self.__values is None:
+            if self.__history is not None:
+                self.__values, self.__sources = \
+                    self.__history._values_at(self.step)
+                return self.__values
+            state = self._get_object_state()
+            checkpoint = self._get_checkpoint()
+            values = {}
+            sources = {}
+            if state:
+                values = state.get_values()
+                for key in values:
+                    sources[key] = ("state", self.uid, state.step, key)
+            else:
+                if checkpoint:
+                    values = checkpoint.get_values()
+                    for key in values:
+                        sources[key] = ("checkpoint", checkpoint.pk, key)
+                    commits = _latest_commits_many([self.uid], self.step,
+                        after=checkpoint.action_id)[self.uid]
+                else:
+                    commits = _latest_commits_many([self.uid],
+                                                   self.step)[self.uid]
+                for key, (id, value) in commits.items():
+                    values[key] = value
+                    sources[key] = id
+            self.__values = values
+            self.__sources = sources
+        return self.__values
+
+    def _get_value(self, key):
+        """Return the encoded value of the given field, taken from the
+        ObjectState when possible, or None if it has no value."""
+        if self.__values is not None or self.__history is not None:
+            return self._get_values().get(key)
+        if self.__sources is None:
+            self.__sources = {}
+        state = self._get_object_state()
+        if state:
+            self.__sources[key] = ("state", self.uid, state.step, key)
+            return state.get_values().get(key)
+        checkpoint = self._get_checkpoint()
+        if checkpoint:
+            # Only the modcommits since the Checkpoint have to be searched
+            modcommit = self._get_modcommit(key, after=checkpoint.action_id)
+            if not modcommit:
+                self.__sources[key] = ("checkpoint", checkpoint.pk, key)
+                return checkpoint.get_values().get(key)
+        else:
+            modcommit = self._get_modcommit(key)
+        if not modcommit: return None
+        self.__sources[key] = modcommit.id
+        return modcommit.value
+
+    def _decode(self, key, value):
+        """Decode the given value of the given field, which was just
+        returned by _get_value or _get_values, through value_cache."""
+        source = (self.__sources or {}).get(key)
+        if source is None:
+            return _decode_value(value)
+        return value_cache.decode(source, value, _decode_value)
+
+    @instrumented("TimeMachine.get")
     def get(self, key):
         """Return the value of a field.
         
@@ -641,18 +2196,71 @@ class TimeMachine:
         DisciplineException
 
         """
-        modcommit = self._get_modcommit(key)
-        if not modcommit: return None
+        value = self._get_value(key)
+        if value is None: return None
         # If this isn't a ForeignKey, then just return the value
         if key not in self.foreignkeys:
-            return cPickle.loads(str(modcommit.value))
+            return self._decode(key, value)
         # If it is, then return the object instance
         try:
-            return TimeMachine(uid = modcommit.value).get_object()
+            return TimeMachine(uid = value).get_object()
         except self.content_type.DoesNotExist:
             raise DisciplineException("When restoring a ForeignKey, the " \
                 "%s %s was not found." % (self.content_type.name, self.uid))
 
+    def get_many(self, keys=None):
+        """Return the values of many fields at once.
+
+        Take a list of field names (by default all fields), return a dict
+        mapping each of them to the value get would return. All values are
+        found with a single query, related objects are then fetched with
+        one query per related model.
+
+        """
+        if keys is None: keys = self.fields + self.foreignkeys
+        values = self._get_values()
+        result = {}
+        related = {}
+        for key in keys:
+            value = values.get(key)
+            if value is None:
+                result[key] = None
+            elif key not in self.foreignkeys:
+                result[key] = self._decode(key, value)
+            else:
+                model = self._foreignkey_model(key)
+                related.setdefault(model, []).append((key, value))
+        for model, pairs in related.items():
+            if model is None:
+                # The field is gone from the model, ask the history
+                for key, uid in pairs:
+                    result[key] = TimeMachine(uid = uid).get_object()
+                continue
+            objects = model.objects.in_bulk([uid for key, uid in pairs])
+            for key, uid in pairs:
+                if uid not in objects:
+                    raise model.DoesNotExist("When restoring a ForeignKey, "
+                        "the %s %s was not found." % (
+                        model._meta.verbose_name, uid))
+                result[key] = objects[uid]
+        return result
+
+    def values(self):
+        """Return a dict mapping every field name to its value."""
+        return self.get_many()
+
+    def _foreignkey_model(self, key):
+        """Return the model the given ForeignKey currently points to or None
+        if the model doesn't have such a ForeignKey anymore."""
+        model = self.content_type.model_class()
+        if model is None: return None
+        try:
+            field = model._meta.get_field(key)
+        except FieldDoesNotExist:
+            return None
+        if not getattr(field, "rel", None): return None
+        return field.rel.to
+
     def get_timemachine_instance(self, key):
         """Return a TimeMachine for a related object.
 
@@ -661,41 +2269,25 @@ class TimeMachine:
         return a TimeMachine for that related object.
 
         """
-        modcommit = self._get_modcommit(key)
-        if not modcommit: 
+        value = self._get_value(key)
+        if value is None:
             return None
-        return TimeMachine(uid = modcommit.value)
+        return TimeMachine(uid = value)
 
     def get_object(self):
         """Return the object of this TimeMachine"""
         return self.content_type.model_class().objects.get(uid = self.uid)
 
     def __exists(self):
+
+        state = self._get_object_state()
+        if state: return state.exists
         
         # Make sure no actions have been created since!
-        if Action.objects.count() != self.actions_count:
+        if _last_action_id() != self.last_action_id:
             self.__update_information()
 
-        created_on = None
-        deleted_on = None
-
-        # Get the *last* time that it was created
-        for c in reversed(self.creation_times):
-            if c <= self.step:
-                created_on = c
-                break
-
-        if not created_on: return False
-
-        # Get the *last* time that it was deleted
-        for d in reversed(self.deletion_times):
-            if d <= self.step:
-                deleted_on = d
-                break
-
-        if deleted_on and deleted_on > created_on: return False
-
-        return True
+        return _exists_at(self.info, self.step)
     
     exists = property(__exists)
 
@@ -708,6 +2300,7 @@ class TimeMachine:
 
     current_action = property(__get_current_action)
 
+    @instrumented("TimeMachine.restore")
     def restore(self, nosave=False):
         """Restore all of the object attributes to the attributes. Return the
         Django object.
@@ -716,8 +2309,8 @@ class TimeMachine:
             obj = self.content_type.model_class().objects.get(uid=self.uid)
         else:
             obj = self.content_type.model_class()(uid=self.uid)
-        for field in self.fields + self.foreignkeys:
-            obj.__setattr__(field, self.get(field))
+        for field, value in self.values().items():
+            obj.__setattr__(field, value)
         if not nosave: obj.save()
         return obj
     
@@ -726,22 +2319,14 @@ class TimeMachine:
             
     def url(self):
         """Return the admin url of the object."""
-        return urlresolvers.reverse(
-            "admin:%s_%s_change" % (self.content_type.app_label,
-                                    self.content_type.model),
-            args = (self.get_object().uid,))
+        return _object_url(self.content_type, self.uid)
             
 
     def _object_type_html(self):
         """Return an html admin link with the object's type as text. If the 
         object doesn't exist, return the object's type crossed out.
         """
-
-        if self.exists:
-            return "<a href=\"%s\">%s</a>" % (self.url(), 
-                                              self.content_type.name,)
-        else:
-            return "<s>%s</s>" % self.content_type.name
+        return _object_type_html(self.content_type, self.uid, self.exists)
     
     def _object_name_html(self):
         """Return an html admin link with the object's name as text. If the 
@@ -757,16 +2342,48 @@ class TimeMachine:
     def _field_value_html(self, field):
         """Return the html representation of the value of the given field"""
         if field in self.fields:
-            return unicode(self.get(field))
+            return unicode(self.get_many([field])[field])
         else:
-            return self.get_timemachine_instance(field)._object_name_html()
+            return self._related_object_name(field, html=True)
 
     def _field_value_text(self, field):
         """Return the html representation of the value of the given field"""
         if field in self.fields:
-            return unicode(self.get(field))
+            return unicode(self.get_many([field])[field])
         else:
-            return self.get_timemachine_instance(field)._object_name_text()
+            return self._related_object_name(field, html=False)
+
+    def _field_value_part(self, field):
+        """Return what the value of the given field looks like as a json
+        serializable list: ["value", text], or ["object", ContentType id,
+        uid] for a ForeignKey, whose name can change and has to be looked
+        up with _object_names."""
+        if field in self.fields:
+            return ["value", unicode(self.get_many([field])[field])]
+        ref = self._related_object_ref(field)
+        if ref is None:
+            return ["value", unicode(None)]
+        return ["object"] + list(ref)
+
+    def _related_object_ref(self, field):
+        """Return a (ContentType id, uid) tuple of the object the given
+        ForeignKey points to, or None."""
+        uid = self._get_values().get(field)
+        if uid is None: return None
+        model = self._foreignkey_model(field)
+        if model is None:
+            content_type = TimeMachine(uid = uid).content_type
+        else:
+            content_type = ContentType.objects.get_for_model(model)
+        return (content_type.id, uid)
+
+    def _related_object_name(self, field, html):
+        """Return the name of the object the given ForeignKey points to, as
+        an html admin link or as text, or "(deleted)" if it doesn't exist
+        anymore."""
+        ref = self._related_object_ref(field)
+        if ref is None: return unicode(None)
+        return _object_names([ref], html)[ref]
 
     def _object_name_text(self):
         """Return the object's unicode representation. If the object doesn't 
@@ -781,6 +2398,209 @@ class TimeMachine:
         """Return the name of the object's content type."""
         return self.content_type.name
 
+class ObjectHistory(object):
+
+    """The whole history of one object, loaded with a constant number of
+    queries, to look at it at many different times without going back to
+    the database.
+
+    Constructor arguments:
+    uid -- The value of the uid field of the object.
+
+    Attributes:
+    steps -- The ids of the Actions done on the object, in order.
+
+    Actions done after the ObjectHistory was created aren't part of it.
+
+    """
+
+    def __init__(self, uid):
+        self.uid = uid
+        # Later SchemaStates can't describe any of its Actions
+        self.__when = datetime.datetime.now()
+        self.info = _object_information([uid])[uid]
+        self.steps = array.array("l", Action.objects.filter(object_uid = uid)
+                                 .order_by("id").values_list("id", flat = True))
+        commits = {}
+        for id, action, key, value in ModificationCommit.objects.filter(
+                object_uid = uid).order_by("id") \
+                .values_list("id", "action", "key", "value"):
+            commits.setdefault(key, []).append((action, id, value))
+        # For every field, the ids of the Actions that changed it and the
+        # ids and values of the ModificationCommits, in the same order
+        self.__steps = {}
+        self.__commits = {}
+        for key, changes in commits.items():
+            changes.sort()
+            self.__steps[key] = array.array("l",
+                [action for action, id, value in changes])
+            self.__commits[key] = [(id, value)
+                                   for action, id, value in changes]
+
+    content_type = property(lambda self: self.info.content_type)
+    last_action_id = property(lambda self: self.info.last_action_id)
+
+    def _get_commit(self, key, step):
+        """Return the id and the encoded value of the last
+        ModificationCommit of the given field at the given step, or
+        None."""
+        steps = self.__steps.get(key)
+        if steps is None: return None
+        i = bisect.bisect_right(steps, step)
+        if not i: return None
+        return self.__commits[key][i - 1]
+
+    def _values_at(self, step):
+        """Return a dict mapping every field with a value at the given step
+        to its encoded value, and one mapping them to the ids of their
+        ModificationCommits."""
+        values = {}
+        sources = {}
+        for key in self.__steps:
+            commit = self._get_commit(key, step)
+            if commit is not None:
+                sources[key], values[key] = commit
+        return values, sources
+
+    def get(self, key, step):
+        """Return the value of a field right after the Action with the id
+        step. ForeignKeys give the uid of the related object."""
+        commit = self._get_commit(key, step)
+        if commit is None: return None
+        id, value = commit
+        if value is None: return None
+        if self.__is_foreignkey(key): return value
+        return value_cache.decode(id, value, _decode_value)
+
+    def exists(self, step):
+        """Return whether the object existed right after the Action with the
+        id step."""
+        return _exists_at(self.info, step)
+
+    def state(self, step):
+        """Return a dict mapping every field with a value right after the
+        Action with the id step to that value, like get."""
+        return dict((key, self.get(key, step)) for key in self.__steps
+                    if self._get_commit(key, step) is not None)
+
+    def at(self, step):
+        """Return a TimeMachine at the given step that reads its values
+        from this history instead of the database."""
+        return TimeMachine(self.uid, step = step, info = self.info,
+                           history = self)
+
+    __foreignkeys = None
+
+    def __is_foreignkey(self, key):
+        # What was a ForeignKey at any time is stored as a uid
+        if self.__foreignkeys is None:
+            self.__foreignkeys = set()
+            for state in _schema_timeline.states(self.__when):
+                schema = state.get_for_content_type(self.content_type)
+                if schema: self.__foreignkeys.update(schema["foreignkeys"])
+        return key in self.__foreignkeys
+
+class Checkpoint(Model):
+
+    """The full state of an object right after an Action, so that a
+    TimeMachine only has to search the ModificationCommits after it.
+
+    Checkpoints are created every DISCIPLINE_CHECKPOINT_INTERVAL Actions
+    on an object, by TimeMachine.checkpoint() and by the
+    discipline_checkpoint management command.
+
+    Fields:
+    object_uid -- The uid of the object.
+    action -- ForeignKey to the Action after which the state was recorded.
+    state -- TextField holding the json representation of the encoded 
+             values of each field. Use get_values().
+
+    """
+
+    object_uid = CharField(
+        max_length = 32,
+        db_index = True
+    )
+    action = ForeignKey(
+        Action, 
+        related_name = "checkpoints",
+        db_index = True
+    )
+    state = TextField()
+
+    def get_values(self):
+        """Return a dict mapping field names to encoded values."""
+        return json.loads(self.state)
+
+class ObjectState(Model):
+
+    """The latest state of a Discipline-controlled object, so that questions
+    about the present don't have to go through its whole history.
+
+    ObjectStates are only maintained when the DISCIPLINE_OBJECT_STATE
+    setting is True. Objects without one fall back to their history, to
+    create them for existing objects use the discipline_object_state
+    management command.
+
+    Fields:
+    object_uid -- The uid of the object.
+    content_type -- ForeignKey to the ContentType of the object.
+    exists -- Whether the object currently exists.
+    step -- The id of the last Action performed on the object.
+    state -- TextField holding the json representation of the encoded 
+             values of each field, as in ModificationCommit.value. Use
+             get_values().
+
+    """
+
+    object_uid = CharField(
+        max_length = 32,
+        primary_key = True,
+    )
+    content_type = ForeignKey(ContentType)
+    exists = BooleanField()
+    step = IntegerField()
+    state = TextField()
+
+    def get_values(self):
+        """Return a dict mapping field names to encoded values."""
+        return json.loads(self.state)
+
+    def __unicode__(self):
+        return "%s %s" % (self.content_type.name, self.object_uid,)
+
+class RenderedAction(Model):
+
+    """What Action._details shows about an Action, rendered once since
+    Actions never change.
+
+    Created the first time the details or the summary of an Action are
+    needed. The names of related objects can change or they can be
+    deleted, so only their ContentTypes and uids are stored and the names
+    are looked up each time.
+
+    Fields:
+    action -- OneToOneField to the Action.
+    content_type -- ForeignKey to the ContentType of the Action's object.
+    parts -- TextField holding the json representation of a list with a
+             [field, old value, new value] list for every field shown. Use
+             get_parts().
+
+    """
+
+    action = OneToOneField(
+        Action,
+        primary_key = True,
+        related_name = "rendered",
+    )
+    content_type = ForeignKey(ContentType)
+    parts = TextField()
+
+    def get_parts(self):
+        """Return the list of [field, old value, new value] lists, see
+        TimeMachine._field_value_part for how values look."""
+        return json.loads(self.parts)
+
 class SchemaState(Model):
 
     """Record the state of each relevant model's fields at a point in time.
@@ -795,10 +2615,15 @@ class SchemaState(Model):
     when = DateTimeField(auto_now_add=True, verbose_name="Saved")
     state = TextField()
 
+    # The parsed state, see get_for_content_type
+    __parsed = None
+
     def get_for_content_type(self, ct):
         """Return the schema for the model of the given ContentType object"""
+        if self.__parsed is None:
+            self.__parsed = json.loads(self.state)
         try:
-            return json.loads(self.state)[ct.app_label][ct.model]
+            return self.__parsed[ct.app_label][ct.model]
         except KeyError:
             return None
 
@@ -824,4 +2649,73 @@ class SchemaState(Model):
     html_state.short_description = "State"
 
 
+class _SchemaTimeline(object):
 
+    """All SchemaStates sorted by time, loaded once per process so that
+    finding the schema at some point in time costs no queries and every
+    state is only parsed once. Cleared whenever a SchemaState is saved or
+    deleted in this process. Those saved by other processes are found by
+    comparing the id of the latest SchemaState with the one loaded, which
+    is only done for times after the last comparison: a new SchemaState
+    gets the time it is saved at, so it can't change the schema of an
+    earlier time.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.timeline = None
+        self.last_id = None
+        self.checked = None
+
+    def __last_id(self):
+        ids = list(SchemaState.objects.order_by("-id")
+                   .values_list("id", flat = True)[:1])
+        return ids and ids[0] or 0
+
+    def _get_timeline(self, when=None):
+        """Return the times and the SchemaStates, reloaded if another
+        process may have saved one before the given time, or at any time
+        if it is None."""
+        now = datetime.datetime.now()
+        if self.timeline is not None and \
+                (when is None or when >= self.checked):
+            if self.__last_id() == self.last_id:
+                self.checked = now
+            else:
+                self.timeline = None
+        timeline = self.timeline
+        if timeline is None:
+            states = list(SchemaState.objects.order_by("when", "id"))
+            timeline = ([state.when for state in states], states)
+            self.last_id = max([state.id for state in states] or [0])
+            self.checked = now
+            self.timeline = timeline
+        return timeline
+
+    def index(self, when):
+        """Return how many SchemaStates there were before the given time."""
+        return bisect.bisect_left(self._get_timeline(when)[0], when)
+
+    def at(self, when):
+        """Return the last SchemaState before the given time, raise
+        IndexError if there is none."""
+        timeline = self._get_timeline(when)
+        i = bisect.bisect_left(timeline[0], when)
+        if not i:
+            raise IndexError("No SchemaState before %s" % when)
+        return timeline[1][i - 1]
+
+    def states(self, when=None):
+        """Return the list of all SchemaStates, from the earliest, with
+        every one before the given time if it isn't None."""
+        return self._get_timeline(when)[1]
+
+_schema_timeline = _SchemaTimeline()
+
+def _clear_schema_timeline(sender, **kwargs):
+    _schema_timeline.clear()
+
+signals.post_save.connect(_clear_schema_timeline, sender=SchemaState)
+signals.post_delete.connect(_clear_schema_timeline, sender=SchemaState)
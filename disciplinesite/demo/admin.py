@@ -28,3 +28,4 @@ admin.site.register(WordConceptConnection, WordConceptConnectionAdmin)
 admin.site.register(LanguageKey, DisciplinedModelAdmin)
 
 
+admin.site.register(Definition, DisciplinedModelAdmin)
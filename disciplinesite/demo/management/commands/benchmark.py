@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+import gc
+import sys
+import time
+import random
+import resource
+import datetime
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.core.signals import request_started
+from django.test.client import Client
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+
+from disciplinesite.demo.models import *
+from disciplinesite.demo.workload import Workload, SIZES
+from disciplinesite.tools import word, mutate
+from discipline.models import *
+from discipline.codec import PickleCodec, TypedCodec
+
+class Command(BaseCommand):
+
+    help = "Measure Discipline on a scratch database, the demo database " \
+           "is left alone"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat", type="int", default=50,
+                    help="How many times to repeat every operation"),
+        make_option("--size", default=None,
+                    help="Generate a history of this many actions first, "
+                         "or small (10k), medium (1M) or large (10M), to "
+                         "measure reading and undoing it"),
+        make_option("--seed", type="int", default=0,
+                    help="Seed of the generated history"),
+        make_option("--width", type="int", default=2,
+                    help="How many fields every generated edit changes, "
+                         "1 to 8"),
+        make_option("--skew", type="float", default=1.0,
+                    help="How much generated edits favor a few objects, "
+                         "0 for none"),
+        make_option("--deletes", type="float", default=0.02,
+                    help="Share of generated actions that are deletions"),
+        make_option("--undos", type="float", default=0.01,
+                    help="Share of generated actions that are undos"),
+        make_option("--database", default=None,
+                    help="File of the scratch SQLite database, for "
+                         "histories too big for memory"),
+        make_option("--json", action="store_true", default=False,
+                    help="Print one JSON object per measurement"),
+    )
+
+    def handle(self, *args, **options):
+
+        self.repeat = options.get("repeat", 50)
+        self.json = options.get("json", False)
+        size = options.get("size")
+        if size is not None:
+            try:
+                size = SIZES.get(size) or int(size)
+            except ValueError:
+                raise CommandError("Unknown size: %s" % size)
+
+        if options.get("database"):
+            settings.DATABASES["default"]["TEST_NAME"] = options["database"]
+        old_name = connection.creation.create_test_db(verbosity=0)
+        # Requests would forget the queries they are measured by
+        request_started.disconnect(reset_queries)
+        try:
+            call_command("discipline_migrate", quiet=True)
+            user = User(username="benchmark", is_staff=True,
+                        is_superuser=True)
+            user.set_password("benchmark")
+            user.save()
+            self.editor = Editor.objects.create(user=user)
+            if size:
+                self.generate(size, options)
+            # connection.queries is only filled in debug mode
+            settings.DEBUG = True
+            self.bench_save_object()
+            self.bench_save_objects()
+            self.bench_codec()
+            self.bench_timemachine_at()
+            if size:
+                self.bench_history()
+                self.bench_cascade_delete()
+                self.bench_changelist()
+        finally:
+            request_started.connect(reset_queries)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def report(self, name, count, elapsed, queries, unit="ms"):
+        """Print the time and queries per operation of count operations,
+        with the peak memory of the process so far."""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.json:
+            print json.dumps({
+                "name": name,
+                "count": count,
+                "wall_%s" % unit: elapsed / count,
+                "queries": float(queries) / count,
+                "peak_rss_kb": peak,
+            })
+        else:
+            print "%-45s %6.1f queries %8.3f %s %8d KB peak" % (
+                name, float(queries) / count, elapsed / count, unit, peak)
+        sys.stdout.flush()
+
+    def measure(self, name, func, objects, batch=False):
+        """Run func on every object, or once on the list of objects if
+        batch is True, print the queries and time it took per object."""
+        reset_queries()
+        start = time.time()
+        if batch:
+            func(objects)
+        else:
+            for obj in objects:
+                func(obj)
+        elapsed = time.time() - start
+        self.report(name, len(objects), elapsed * 1000,
+                    len(connection.queries))
+        reset_queries()
+
+    def generate(self, size, options):
+        """Build a history of about size actions, without keeping the
+        queries."""
+        settings.DEBUG = False
+        self.workload = Workload(self.editor,
+                                 seed = options.get("seed", 0),
+                                 width = options.get("width", 2),
+                                 skew = options.get("skew", 1.0),
+                                 deletes = options.get("deletes", 0.02),
+                                 undos = options.get("undos", 0.01))
+        start = time.time()
+        step = max(size / 10, 1)
+        while self.workload.actions < size:
+            self.workload.run(min(step, size - self.workload.actions))
+            if not self.json:
+                print >> sys.stderr, "%d actions..." % self.workload.actions
+        self.report("generate: action", self.workload.actions,
+                    (time.time() - start) * 1000, 0)
+
+    def bench_save_object(self):
+        """Creation and modification of models with 1, 2 and 8 fields."""
+        save = self.editor.save_object
+
+        languages = [LanguageKey(code=word()[:6] + str(i))
+                     for i in range(self.repeat)]
+        self.measure("save_object: create LanguageKey (1 field)",
+                     save, languages)
+        for language in languages:
+            language.code = mutate(language.code)
+        self.measure("save_object: modify LanguageKey (1 field)",
+                     save, languages)
+
+        words = [Word(full=word(), language=languages[i])
+                 for i in range(self.repeat)]
+        self.measure("save_object: create Word (2 fields)", save, words)
+        for i, w in enumerate(words):
+            w.full = mutate(w.full)
+            w.language = languages[-i - 1]
+        self.measure("save_object: modify Word (2 fields)", save, words)
+
+        definitions = [Definition(text=word(), word=words[i],
+                                  language=languages[i])
+                       for i in range(self.repeat)]
+        self.measure("save_object: create Definition (8 fields)",
+                     save, definitions)
+        for i, d in enumerate(definitions):
+            d.text = mutate(d.text)
+            d.example = word()
+            d.source = word()
+            d.rank += 1
+            d.approved = not d.approved
+            d.added = datetime.date.today()
+            d.word = words[-i - 1]
+            d.language = languages[-i - 1]
+        self.measure("save_object: modify Definition (8 fields)",
+                     save, definitions)
+
+    def bench_save_objects(self):
+        """Creating and modifying words one by one and in bulk."""
+        language = LanguageKey(code="bulk")
+        self.editor.save_object(language)
+        for batch, name in ((False, "save_object"), (True, "save_objects")):
+            if batch:
+                save = self.editor.save_objects
+            else:
+                save = self.editor.save_object
+            words = [Word(full=word(), language=language)
+                     for i in range(self.repeat)]
+            self.measure("%s: create Word" % name, save, words, batch)
+            for w in words:
+                w.full = mutate(w.full)
+            self.measure("%s: modify Word" % name, save, words, batch)
+
+    def bench_codec(self):
+        """Decoding the values of a Definition, pickled and typed."""
+        definition = Definition(text=word(), example=word(), source=word(),
+                                rank=42, approved=True,
+                                added=datetime.date.today())
+        fields = [Definition._meta.get_field(name) for name in
+                  ("text", "example", "source", "rank", "approved", "added")]
+        for codec in (PickleCodec(), TypedCodec()):
+            values = [codec.encode(getattr(definition, field.name), field)
+                      for field in fields] * self.repeat * 100
+            start = time.time()
+            for value in values:
+                codec.decode(value)
+            elapsed = time.time() - start
+            # Too fast for milliseconds
+            self.report("%s: decode a value" % codec.__class__.__name__,
+                        len(values), elapsed * 1000000, 0, unit="us")
+
+    def bench_timemachine_at(self):
+        """Moving a TimeMachine to the other steps of a word, and the
+        objects every TimeMachine keeps alive."""
+        language = LanguageKey(code="at")
+        self.editor.save_object(language)
+        w = Word(full=word(), language=language)
+        self.editor.save_object(w)
+        for i in range(10):
+            w.full = mutate(w.full)
+            self.editor.save_object(w)
+        tm = TimeMachine(w.uid)
+        steps = list(Action.objects.filter(object_uid=w.uid)
+                     .values_list("id", flat=True)) * self.repeat
+        self.measure("TimeMachine.at", tm.at, steps)
+        gc.collect()
+        start = len(gc.get_objects())
+        timemachines = [tm.at(step) for step in steps]
+        gc.collect()
+        kept = float(len(gc.get_objects()) - start) / len(timemachines)
+        if self.json:
+            print json.dumps({
+                "name": "TimeMachine.at: objects kept per TimeMachine",
+                "count": len(timemachines),
+                "objects": kept,
+            })
+        else:
+            print "%-45s %6.1f objects" % (
+                "TimeMachine.at: objects kept per TimeMachine", kept)
+
+    def sample_actions(self, action_type):
+        """Return up to repeat Actions of the given type spread over the
+        generated history, the same ones for the same seed."""
+        rng = random.Random(self.workload.actions)
+        actions = Action.objects.filter(action_type = action_type,
+                                        reverted__isnull = True)
+        last = Action.objects.order_by("-id")[0].id
+        sample = {}
+        for i in range(self.repeat * 10):
+            if len(sample) == self.repeat: break
+            found = list(actions.filter(id__lte = rng.randint(1, last))
+                         .order_by("-id")[:1])
+            if found: sample[found[0].id] = found[0]
+        return [sample[id] for id in sorted(sample)]
+
+    def bench_history(self):
+        """Reading the generated history and undoing parts of it."""
+        actions = self.sample_actions("md")
+        if not actions: return
+        steps = [(action.object_uid, action.id) for action in actions]
+        self.measure("TimeMachine: construct at a step",
+                     lambda (uid, step): TimeMachine(uid, step=step), steps)
+        timemachines = [TimeMachine(uid, step=step) for uid, step in steps]
+        self.measure("TimeMachine: get a field",
+                     lambda tm: tm.get("text"), timemachines)
+        timemachines = [TimeMachine(uid, step=step) for uid, step in steps]
+        self.measure("TimeMachine: get every field",
+                     lambda tm: tm.get_many(), timemachines)
+        # restore() starts from the object as it is now
+        existing = set(Definition.objects.filter(
+            uid__in = [uid for uid, step in steps])
+            .values_list("uid", flat=True))
+        timemachines = [TimeMachine(uid, step=step) for uid, step in steps
+                        if uid in existing]
+        self.measure("TimeMachine: restore without saving",
+                     lambda tm: tm.restore(nosave=True), timemachines)
+        self.measure("ObjectHistory: load",
+                     lambda (uid, step): ObjectHistory(uid), steps)
+        fresh = lambda: [Action.objects.get(id=action.id)
+                         for action in actions]
+        self.measure("Action.is_revertible",
+                     lambda action: action.is_revertible, fresh())
+        self.measure("Action.check_revertible (all at once)",
+                     Action.check_revertible, fresh(), batch=True)
+        revertible = [action for action in fresh() if action.is_revertible
+                      and action.object_uid in existing]
+        if revertible:
+            self.measure("Action.undo",
+                         lambda action: action.undo(self.editor),
+                         revertible)
+
+    def bench_cascade_delete(self):
+        """Deleting languages along with their words and definitions."""
+        languages = []
+        for i in range(max(self.repeat / 10, 1)):
+            language = LanguageKey(code="del%d" % i)
+            self.editor.save_object(language)
+            words = [Word(full=word(), language=language)
+                     for j in range(10)]
+            self.editor.save_objects(words)
+            definitions = [Definition(text=word(), word=w, language=language)
+                           for w in words for k in range(5)]
+            self.editor.save_objects(definitions)
+            languages.append(language)
+        self.measure("delete_object: cascade to 60 objects",
+                     self.editor.delete_object, languages)
+
+    def bench_changelist(self):
+        """Rendering pages of the Action changelist in the admin."""
+        client = Client()
+        client.login(username="benchmark", password="benchmark")
+        pages = range(min(self.repeat, 10))
+        self.measure("admin: Action changelist page",
+                     lambda page: client.get("/admin/discipline/action/",
+                                             {"p": page}), pages)
+        content_type = ContentType.objects.get_for_model(Definition)
+        self.measure("admin: Action changelist of a model",
+                     lambda page: client.get("/admin/discipline/action/", {
+                         "p": page,
+                         "content_type__id__exact": content_type.id,
+                     }), pages)
@@ -37,6 +37,22 @@ class Concept(DisciplinedModel):
     word_list.allow_tags = True
 
 
+# A deliberately wide model, used by the benchmark command
+class Definition(DisciplinedModel):
+
+    text = TextField()
+    example = TextField(null=True)
+    source = CharField(max_length=100, null=True)
+    rank = IntegerField(default=0)
+    approved = BooleanField(default=False)
+    added = DateField(null=True)
+    word = ForeignKey(Word, related_name="definitions")
+    language = ForeignKey(LanguageKey, related_name="definitions")
+
+    def __unicode__(self):
+        return self.text
+
+
 # A connection between a concept and a word
 class WordConceptConnection(DisciplinedModel):
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""A generator of synthetic histories for the benchmark command.
+
+The same seed and parameters always give the same history, so runs can be
+compared with each other.
+"""
+import random
+import datetime
+
+from disciplinesite.demo.models import *
+from disciplinesite import tools
+from discipline.models import *
+
+# Number of actions of the sizes the benchmark command knows by name
+SIZES = {
+    "small": 10000,
+    "medium": 1000000,
+    "large": 10000000,
+}
+
+# The fields of Definition an edit can change, the widest demo model
+FIELDS = ("text", "example", "source", "rank", "approved", "added", "word",
+          "language")
+
+class Workload(object):
+
+    """Builds the history of Definitions edited by an editor.
+
+    Constructor arguments:
+    editor -- The Editor doing everything.
+    seed -- Seed of the random choices.
+    width -- How many fields of a Definition every edit changes, 1 to 8.
+    skew -- How much edits favor the same objects, 0 spreads them evenly
+           and the higher it is, the more they go to a few hot objects.
+    deletes -- The share of actions that delete an object.
+    undos -- The share of actions that undo an earlier action.
+    pool -- How many objects are kept alive to be edited.
+
+    """
+
+    def __init__(self, editor, seed=0, width=2, skew=1.0, deletes=0.02,
+                 undos=0.01, pool=1000):
+        self.editor = editor
+        self.random = random.Random(seed)
+        # disciplinesite.tools uses the random module itself
+        random.seed(seed)
+        self.width = max(1, min(width, len(FIELDS)))
+        self.skew = skew
+        self.deletes = deletes
+        self.undos = undos
+        self.pool = pool
+        self.objects = []
+        self.languages = []
+        self.words = []
+        # The ids of the latest actions, candidates for undoing
+        self.recent = []
+        self.actions = 0
+
+    def run(self, actions, batch=500):
+        """Add about the given number of actions to the history, saving
+        batch objects at a time."""
+        if not self.languages: self.setup()
+        goal = self.actions + actions
+        while self.actions < goal:
+            self.step(min(batch, goal - self.actions))
+
+    def setup(self):
+        """Create the languages and words the Definitions point to. They
+        are never undone, that would delete Definitions along with them."""
+        for code in ("eng", "epo", "fra", "deu"):
+            language = LanguageKey(code=code)
+            self.languages.append(language)
+        for i in range(20):
+            self.words.append(Word(full=tools.word(),
+                                   language=self.random.choice(self.languages)))
+        for objects in (self.languages, self.words):
+            self.actions += len(self.editor.save_objects(objects))
+
+    def step(self, count):
+        """Do count actions: creations, edits, deletions and undos."""
+        saved = []
+        seen = set()
+        for i in range(count):
+            choice = self.random.random()
+            if choice < self.undos and self.recent:
+                self.undo()
+            elif choice < self.undos + self.deletes and self.objects:
+                self.delete(seen)
+            elif len(self.objects) < self.pool or \
+                 self.random.random() < 0.1:
+                # New objects keep coming once the pool is full
+                obj = self.create()
+                saved.append(obj)
+                seen.add(obj.uid)
+            else:
+                obj = self.pick()
+                # An object saved twice in a batch is only one action
+                if obj.uid in seen: continue
+                self.edit(obj)
+                saved.append(obj)
+                seen.add(obj.uid)
+        self.save(saved)
+
+    def save(self, objects):
+        self.record(self.editor.save_objects(objects))
+
+    def record(self, actions):
+        self.actions += len(actions)
+        self.recent.extend([action.id for action in actions])
+        del self.recent[:-1000]
+
+    def pick(self):
+        """Return an object to edit, the first ones more often the bigger
+        the skew."""
+        i = int(len(self.objects) * self.random.random() ** (1 + self.skew))
+        return self.objects[i]
+
+    def create(self):
+        obj = Definition(
+            text = tools.word(),
+            word = self.random.choice(self.words),
+            language = self.random.choice(self.languages),
+        )
+        # Only pool objects are kept in memory, the one at the cold end
+        # is left alone from now on
+        self.objects.insert(self.random.randint(0, len(self.objects)), obj)
+        if len(self.objects) > self.pool:
+            self.objects.pop()
+        return obj
+
+    def edit(self, obj):
+        for field in self.random.sample(FIELDS, self.width):
+            if field == "text":
+                obj.text = tools.mutate(obj.text)
+            elif field == "example":
+                obj.example = tools.sentence()
+            elif field == "source":
+                obj.source = tools.word()
+            elif field == "rank":
+                obj.rank += 1
+            elif field == "approved":
+                obj.approved = not obj.approved
+            elif field == "added":
+                obj.added = datetime.date(2000, 1, 1) + \
+                    datetime.timedelta(self.random.randint(0, 5000))
+            elif field == "word":
+                obj.word = self.random.choice(self.words)
+            else:
+                obj.language = self.random.choice(self.languages)
+
+    def delete(self, seen):
+        i = self.random.randrange(len(self.objects))
+        # Objects of the current batch aren't saved yet
+        if self.objects[i].uid in seen: return
+        obj = self.objects.pop(i)
+        self.editor.delete_object(obj)
+        self.record([Action.objects.latest()])
+
+    def undo(self):
+        action = Action.objects.get(id=self.random.choice(self.recent))
+        if not action.is_revertible: return
+        action.undo(self.editor)
+        self.record([Action.objects.latest()])
+        # Undoing a deletion brings the object back, undoing a creation
+        # removes it, the pool is only refreshed at the next creation
+        if action.action_type == "cr":
+            self.objects = [obj for obj in self.objects
+                            if obj.uid != action.object_uid]
@@ -34,5 +34,6 @@ setup(
         "discipline",
         "discipline.management",
         "discipline.management.commands",
+        "discipline.migrations",
     ],
 )
@@ -130,6 +130,8 @@ def special_phase1():
         print " - No backup database found, creating new one"
         os.unlink("testing.db")
         call("python manage.py syncdb --noinput")
+        # Discipline's own tables come from its migrations
+        call("python manage.py migrate discipline")
         shutil.copyfile("testing.db", "testing.db.bak")
 
     print " - Running initial schema migration"
@@ -286,6 +288,23 @@ class WordConceptConnection(DisciplinedModel):
         Concept, 
         related_name="word_connections"
     )
+
+class Definition(DisciplinedModel):
+    text = TextField()
+    example = TextField(null=True)
+    source = CharField(max_length=100, null=True)
+    rank = IntegerField(default=0)
+    approved = BooleanField(default=False)
+    added = DateField(null=True)
+    word = ForeignKey(Word, related_name="definitions")
+    language = ForeignKey(LanguageKey, related_name="definitions")
+
+class Tag(DisciplinedModel):
+    name = CharField(max_length=30)
+
+class Sense(DisciplinedModel):
+    language = ForeignKey(LanguageKey, related_name="senses")
+    tags = ManyToManyField(Tag, related_name="senses")
 """
 
 original_models = """
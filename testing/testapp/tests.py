@@ -2,16 +2,178 @@ import os
 import json
 import cPickle
 import datetime
+import threading
+import tempfile
+import logging
+import sqlite3
 
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User, UserManager
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
 
 from discipline.models import *
+from discipline.models import _action_index, _latest_commits_query, \
+    _by_action, _HistoryWriter, _differs, _history_writer, _step_at, \
+    _when_of, _bulk_insert, _latest_values, _values_before
+from discipline.cache import LRUCache, value_cache
+from discipline.codec import TypedCodec
+from django.db.models import fields
+from django.utils.tzinfo import FixedOffset
+from discipline.instrumentation import stats, operation_finished, \
+    _CountingCursor
 from testing.testapp.models import *
 
 
+class CountQueries(object):
+    """Count the database queries run inside a with block."""
+
+    def __enter__(self):
+        self.debug = settings.DEBUG
+        settings.DEBUG = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = len(connection.queries) - self.start
+        settings.DEBUG = self.debug
+
+
+class LRUCacheTest(TestCase):
+
+    def test_eviction(self):
+        """The least recently used item is forgotten first."""
+        cache = LRUCache(maxsize=3)
+        for key in "abc":
+            cache.set(key, key.upper())
+        self.assertEquals(cache.get("a"), "A")
+        cache.set("d", "D")
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(len(cache), 3)
+        self.assertEquals([cache.get(key) for key in "acd"], ["A", "C", "D"])
+        self.assertEquals((cache.hits, cache.misses), (4, 1))
+        cache.clear()
+        self.assertEquals((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+
+class TypedCodecTest(TestCase):
+
+    def test_times(self):
+        """Naive datetimes and times are stored typed, aware ones keep
+        their offset, and pickled values written before are still read."""
+        codec = TypedCodec()
+        plus_two = FixedOffset(120)
+        for value, field in (
+                (datetime.datetime(2010, 7, 4, 12, 30), fields.DateTimeField()),
+                (datetime.datetime(2010, 7, 4, 12, 30, 0, 5),
+                 fields.DateTimeField()),
+                (datetime.time(12, 30), fields.TimeField()),
+                (datetime.time(12, 30, 0, 5), fields.TimeField())):
+            self.assertTrue(codec.encode(value, field).startswith("~"))
+            self.assertEquals(codec.decode(codec.encode(value, field)), value)
+            self.assertEquals(codec.decode(cPickle.dumps(value)), value)
+            aware = value.replace(tzinfo = plus_two)
+            decoded = codec.decode(codec.encode(aware, field))
+            self.assertEquals(decoded, aware)
+            self.assertEquals(decoded.utcoffset(), aware.utcoffset())
+        self.assertEquals(codec.encode(datetime.datetime(2010, 7, 4, 12, 30),
+                                       fields.DateTimeField()),
+                          "~T2010-07-04 12:30:00")
+        self.assertEquals(codec.encode(datetime.datetime(2010, 7, 4, 12, 30,
+                                                         tzinfo = plus_two),
+                                       fields.DateTimeField()),
+                          "~T2010-07-04 12:30:00+02:00")
+        for text, value in (
+                ("~T2010-07-04 12:30:00",
+                 datetime.datetime(2010, 7, 4, 12, 30)),
+                ("~T1812-07-04 12:30:00.000250",
+                 datetime.datetime(1812, 7, 4, 12, 30, 0, 250)),
+                ("~T2010-07-04 12:30:00.5-01:30", None),
+                ("~T2010-07-04 12:30:00.000500-01:30",
+                 datetime.datetime(2010, 7, 4, 14, 0, 0, 500,
+                                   tzinfo = FixedOffset(0))),
+                ("~t12:30:00", datetime.time(12, 30)),
+                ("~D2010-07-04", datetime.date(2010, 7, 4))):
+            if value is None:
+                self.assertRaises(ValueError, codec.decode, text)
+            else:
+                self.assertEquals(codec.decode(text), value)
+        self.assertRaises(ValueError, codec.decode, "~D2010-7-4")
+        # Saving an aware value over a naive one is a change
+        self.assertTrue(_differs(datetime.datetime(2010, 7, 4),
+            datetime.datetime(2010, 7, 4, tzinfo = plus_two)))
+
+
+class HistoryWriterTest(TestCase):
+
+    def setUp(self):
+        # Tasks fail on purpose
+        logging.getLogger("discipline").disabled = True
+
+    def tearDown(self):
+        logging.getLogger("discipline").disabled = False
+
+    def test_order_and_backpressure(self):
+        """Tasks run in order in the background, submitting waits when the
+        queue is full and flush() waits for the tasks of its thread."""
+        settings.DISCIPLINE_ASYNC_HISTORY_QUEUE_SIZE = 2
+        try:
+            writer = _HistoryWriter()
+            done = []
+            go = threading.Event()
+            writer.submit(go.wait)
+            submitter = threading.Thread(target = lambda: [
+                writer.submit(done.append, i) for i in range(5)] and
+                writer.flush())
+            submitter.start()
+            submitter.join(0.2)
+            # Two tasks wait behind the blocked one, the rest can't
+            self.assertTrue(submitter.isAlive())
+            self.assertEquals(done, [])
+            go.set()
+            submitter.join()
+            self.assertEquals(done, range(5))
+            writer.flush()
+        finally:
+            del settings.DISCIPLINE_ASYNC_HISTORY_QUEUE_SIZE
+
+    def test_errors(self):
+        """An exception of a task is raised by the next flush()."""
+        writer = _HistoryWriter()
+        done = []
+        writer.submit(int, "not a number")
+        writer.submit(done.append, 1)
+        self.assertRaises(ValueError, writer.flush)
+        self.assertEquals(done, [1])
+        writer.flush()
+
+    def test_threads(self):
+        """A thread neither waits for the tasks of others nor hears about
+        their exceptions."""
+        writer = _HistoryWriter()
+        go = threading.Event()
+        errors = []
+        def other():
+            writer.submit(go.wait)
+            writer.submit(int, "not a number")
+            try:
+                writer.flush()
+            except ValueError, e:
+                errors.append(e)
+        thread = threading.Thread(target = other)
+        thread.start()
+        while writer.queue is None or writer.queue.unfinished_tasks < 2:
+            thread.join(0.01)
+        # Returns right away although the other thread's tasks are waiting
+        writer.flush()
+        go.set()
+        thread.join()
+        self.assertEquals(len(errors), 1)
+        writer.flush()
+
+
 class SchemaStateTest(TestCase):
 
     def setUp(self):
@@ -44,6 +206,49 @@ class SchemaStateTest(TestCase):
         # Object not deleted before schema migration
         self.assertRaises(DisciplineIntegrityError, TimeMachine, epo.uid)
 
+    def test_schema_timeline(self):
+        """After the first TimeMachine, finding the schema of a point in
+        time takes no queries, until discipline_migrate adds a new one."""
+
+        call_command("discipline_migrate", quiet=True)
+
+        epo = LanguageKey(code="epo")
+        self.editor.save_object(epo)
+        tm = TimeMachine(epo.uid)
+        with CountQueries() as queries:
+            TimeMachine(epo.uid, when=tm.when, step=tm.step, info=tm.info)
+        self.assertEquals(queries.count, 0)
+
+        ss = SchemaState.objects.order_by("-when")[0]
+        newss = copy.deepcopy(json.loads(ss.state))
+        newss["testapp"]["languagekey"]["fields"] = ["code", "name"]
+        SchemaState.objects.create(state = json.dumps(newss))
+        eng = LanguageKey(code="eng")
+        self.editor.save_object(eng)
+        self.assertEquals(TimeMachine(eng.uid).fields, ["code", "name"])
+        self.assertEquals(tm.fields, ["code"])
+
+    def test_schema_timeline_other_process(self):
+        """A SchemaState saved by another process, which doesn't clear the
+        timeline of this one, is used for the times after it."""
+
+        call_command("discipline_migrate", quiet=True)
+
+        epo = LanguageKey(code="epo")
+        self.editor.save_object(epo)
+        tm = TimeMachine(epo.uid)
+
+        ss = SchemaState.objects.order_by("-when")[0]
+        newss = copy.deepcopy(json.loads(ss.state))
+        newss["testapp"]["languagekey"]["fields"] = ["code", "name"]
+        # No signal is sent
+        _bulk_insert(SchemaState, [SchemaState(state = json.dumps(newss))])
+        eng = LanguageKey(code="eng")
+        self.editor.save_object(eng)
+        self.assertEquals(TimeMachine(eng.uid).fields, ["code", "name"])
+        self.assertEquals(TimeMachine(epo.uid, step=tm.step).fields,
+                          ["code"])
+
     def test_timemachine_schemastates(self):
         """Test to see if TimeMachine changes its 'fields' and 
         'foreignkeys' properties when moved to a time with a 
@@ -139,6 +344,78 @@ class GeneralDisciplineTests(TestCase):
             response = self.client.get(url)
             self.failUnlessEqual(response.status_code, 200)
 
+    def test_admin_changelist_query_count(self):
+        """The number of queries to render the Action changelist doesn't
+        depend on how many Actions are on the page."""
+        from discipline.admin import ActionAdmin
+        self.editor.save_objects([Word(full="word%d" % i,
+                                       language=self.eng)
+                                  for i in range(20)])
+        self.editor.delete_object(self.hundo)
+        self.editor.undo_action(Action.objects.latest())
+        self.editor.undo_action(Action.objects.latest())
+        # Otherwise the admin only shows the login form
+        self.john.is_staff = True
+        self.john.is_superuser = True
+        self.john.save()
+        self.client.login(username="johndoe", password="secret")
+        counts = []
+        try:
+            for per_page in (5, 40):
+                ActionAdmin.list_per_page = per_page
+                with CountQueries():
+                    response = self.client.get("/admin/discipline/action/")
+                    # The queries are reset when the request starts
+                    counts.append(len(connection.queries))
+                self.assertEquals(response.status_code, 200)
+        finally:
+            ActionAdmin.list_per_page = 50
+        self.assertEquals(counts[0], counts[1])
+        for action in Action.objects.all():
+            response = self.client.get(action.get_absolute_url())
+            self.assertEquals(response.status_code, 200)
+
+    def test_action_content_type(self):
+        """Actions know the model of their object, to list the history of a
+        model without joining the commits."""
+        word_type = ContentType.objects.get_for_model(Word)
+        uid = self.hundo.uid
+        self.hundo.full = "hundoj"
+        self.editor.save_object(self.hundo)
+        self.editor.delete_object(self.hundo)
+        deletion = Action.objects.latest()
+        self.assertEquals(
+            sorted(Action.objects.filter(object_uid=uid)
+                   .values_list("action_type", "content_type")),
+            [("cr", word_type.id), ("dl", word_type.id),
+             ("md", word_type.id)])
+        # What it takes without the column
+        words = Action.objects.filter(object_uid__in=
+            CreationCommit.objects.filter(content_type=word_type)
+            .values_list("object_uid", flat=True)).count()
+        self.assertEquals(Action.objects.for_model(Word).count(), words)
+        self.assertEquals(Action.objects.for_model(word_type).count(), words)
+        self.assertEquals(Action.objects.for_model(LanguageKey).count(), 2)
+        deletion = Action.objects.get(id=deletion.id)
+        with CountQueries() as queries:
+            self.assertEquals(deletion._description(), "Deleted word")
+        self.assertEquals(queries.count, 0)
+
+        Action.objects.update(content_type=None)
+        call_command("discipline_action_content_types", quiet=True)
+        self.assertEquals(Action.objects.for_model(Word).count(), words)
+        self.assertFalse(Action.objects.filter(content_type=None).exists())
+
+        self.john.is_staff = True
+        self.john.is_superuser = True
+        self.john.save()
+        self.client.login(username="johndoe", password="secret")
+        response = self.client.get("/admin/discipline/action/",
+            {"content_type__id__exact": ContentType.objects.get_for_model(
+                LanguageKey).id})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context["cl"].result_count, 2)
+
     def test_creation_basic(self):
         self.assertEquals(User.objects.count(), 1)        
         self.assertEquals(LanguageKey.objects.count(), 2)
@@ -154,8 +431,47 @@ class GeneralDisciplineTests(TestCase):
         self.assertEquals(lastact.object_uid, self.hundo.uid)
         self.assertEquals(lastact.modification_commits.all()[0].key, "full")
         self.assertEquals(lastact.modification_commits.all()[0].value, 
-                          cPickle.dumps("hundoj"))
+                          "~shundoj")
         
+    def test_value_codec(self):
+        """Values are stored in a compact typed form. Old pickled values
+        can still be read and are rewritten by discipline_reencode."""
+        definition = Definition(
+            text = u"\u0109u",
+            source = "dictionary",
+            rank = 3,
+            approved = True,
+            added = datetime.date(2010, 7, 4),
+            word = self.dog,
+            language = self.eng,
+        )
+        self.editor.save_object(definition)
+        values = dict(ModificationCommit.objects.filter(
+            object_uid=definition.uid).values_list("key", "value"))
+        self.assertEquals(values["text"], u"~s\u0109u")
+        self.assertEquals(values["example"], "~n")
+        self.assertEquals(values["rank"], "~i3")
+        self.assertEquals(values["approved"], "~b1")
+        self.assertEquals(values["added"], "~D2010-07-04")
+        tm = TimeMachine(definition.uid)
+        for field in ("text", "example", "source", "rank", "approved",
+                      "added"):
+            self.assertEquals(tm.get(field), getattr(definition, field))
+
+        # Written before the codec existed
+        commit = ModificationCommit.objects.get(object_uid=self.hundo.uid,
+                                                key="full")
+        ModificationCommit.objects.filter(id=commit.id) \
+            .update(value=cPickle.dumps("hundo"))
+        tm = TimeMachine(self.hundo.uid, step=commit.action_id)
+        self.assertEquals(tm.get("full"), "hundo")
+        call_command("discipline_reencode", quiet=True)
+        self.assertEquals(ModificationCommit.objects.get(id=commit.id).value,
+                          "~shundo")
+        # ForeignKeys are left alone
+        self.assertEquals(ModificationCommit.objects.get(
+            object_uid=self.hundo.uid, key="language").value, self.epo.uid)
+
     def test_creation_action(self):
         """Test the creation of a creation action."""
         rus = LanguageKey(code="rus")
@@ -168,6 +484,127 @@ class GeneralDisciplineTests(TestCase):
         self.assertEquals(lastact.creation_commits.all()[0].content_type,
                           ContentType.objects.get_for_model(Word))
 
+    def test_interleaved_commits(self):
+        """The latest value of a field is that of the latest Action, also
+        when its commit was written before that of an earlier Action."""
+        first = Action.objects.create(editor = self.editor,
+                                      object_uid = self.hundo.uid,
+                                      action_type = "md")
+        second = Action.objects.create(editor = self.editor,
+                                       object_uid = self.hundo.uid,
+                                       action_type = "md")
+        ModificationCommit.objects.create(object_uid = self.hundo.uid,
+                                          action = second, key = "full",
+                                          value = "~ssecond")
+        ModificationCommit.objects.create(object_uid = self.hundo.uid,
+                                          action = first, key = "full",
+                                          value = "~sfirst")
+        self.assertEquals(_latest_values(self.hundo.uid)["full"], "~ssecond")
+        self.assertEquals(TimeMachine(self.hundo.uid).get_many()["full"],
+                          "second")
+        self.assertEquals(TimeMachine(self.hundo.uid,
+                                      step = first.id).get("full"), "first")
+        self.assertEquals(_values_before([second])[second.id]["full"],
+                          "~sfirst")
+
+    def test_create_actions_ids(self):
+        """Every new Action gets the id of its own row, also where the ids
+        are read after each insert."""
+
+        def check(code):
+            words = [Word(full="%s%d" % (code, i), language=self.epo)
+                     for i in range(3)]
+            actions = self.editor.save_objects(words + [self.epo])
+            self.assertEquals(len(actions), 3)
+            for action, word in zip(actions, words):
+                row = Action.objects.get(id=action.id)
+                self.assertEquals(row.object_uid, word.uid)
+                self.assertEquals(row.when, action.when)
+
+        check("sqlite")
+        engine = connection.settings_dict["ENGINE"]
+        connection.settings_dict["ENGINE"] = "other"
+        try:
+            check("other")
+        finally:
+            connection.settings_dict["ENGINE"] = engine
+
+    def test_save_objects(self):
+        """save_objects writes the same history as save_object in a loop."""
+
+        def batch(code):
+            rus = LanguageKey(code=code)
+            sobaka = Word(full="sobaka", language=rus)
+            # Another instance of the same object
+            sobaka2 = Word(uid=sobaka.uid, full="sobaka!", language=self.eng)
+            hundo = Word.objects.get(uid=self.hundo.uid)
+            hundo.full = "hundo-" + code
+            dog = Word.objects.get(uid=self.dog.uid)
+            return [rus, sobaka, hundo, sobaka2, dog]
+
+        def history(objs, start, code):
+            # Replace uids by positions to compare different objects
+            uids = dict([(obj.uid, str(i)) for (i, obj)
+                         in reversed(list(enumerate(objs)))])
+            result = []
+            for action in Action.objects.filter(id__gt=start).order_by("id"):
+                commits = [(c.key, uids.get(c.value, c.value)
+                            .replace(code, "")) for c in
+                           action.modification_commits.order_by("key")]
+                result.append((uids[action.object_uid], action.action_type,
+                               action.creation_commits.count(), commits))
+            return result
+
+        start = Action.objects.latest().id
+        objs = batch("rus")
+        for obj in objs:
+            self.editor.save_object(obj)
+        looped = history(objs, start, "rus")
+
+        start = Action.objects.latest().id
+        objs = batch("ukr")
+        actions = self.editor.save_objects(objs)
+        self.assertEquals(history(objs, start, "ukr"), looped)
+        self.assertEquals(len(actions), 4)
+        self.assertEquals([a.id for a in actions], list(Action.objects.filter(
+            id__gt=start).order_by("id").values_list("id", flat=True)))
+        self.assertEquals(TimeMachine(objs[1].uid).get("full"), "sobaka!")
+
+    def test_batch(self):
+        """Inside Editor.batch(), history is written when the block ends and
+        repeated saves of an object are merged into a single Action."""
+        start = Action.objects.latest().id
+        with self.editor.batch():
+            rus = LanguageKey(code="rus")
+            self.editor.save_object(rus)
+            sobaka = Word(full="sobaka", language=rus)
+            self.editor.save_object(sobaka)
+            sobaka.full = "sobaka!"
+            self.editor.save_object(sobaka)
+            self.hundo.full = "hundoj"
+            self.editor.save_object(self.hundo)
+            self.hundo.full = "hundo"
+            self.editor.save_object(self.hundo)
+            self.assertEquals(Action.objects.latest().id, start)
+        actions = Action.objects.filter(id__gt=start).order_by("id")
+        self.assertEquals([(a.object_uid, a.action_type) for a in actions],
+                          [(rus.uid, "cr"), (sobaka.uid, "cr")])
+        self.assertEquals(TimeMachine(sobaka.uid).get("full"), "sobaka!")
+
+    def test_batch_delete(self):
+        """Deleting inside a batch writes the deferred history first."""
+        start = Action.objects.latest().id
+        with self.editor.batch():
+            self.dog.full = "doggy"
+            self.editor.save_object(self.dog)
+            cc = self.hundo.concept_connections.all()[0]
+            self.editor.delete_object(cc)
+            self.dog.full = "dog"
+            self.editor.save_object(self.dog)
+        actions = Action.objects.filter(id__gt=start).order_by("id")
+        self.assertEquals([a.action_type for a in actions],
+                          ["md", "dl", "md"])
+
     def test_deletion_action(self):
         """Test the creation of a deletion action."""
         wcc = WordConceptConnection.objects.all()[0]
@@ -193,6 +630,88 @@ class GeneralDisciplineTests(TestCase):
         self.assertEquals(wcc_act.action_type, "dl")
         self.assertEquals(wcc_act.object_uid, wcc_uid)
         
+    def test_deletion_cascade_many_to_many(self):
+        """Deleting objects by cascading removes their ManyToManyField
+        rows too, from either side."""
+        noun = Tag(name="noun")
+        verb = Tag(name="verb")
+        self.editor.save_objects([noun, verb])
+        sense = Sense(language=self.epo)
+        self.editor.save_object(sense)
+        sense.tags.add(noun, verb)
+        through = Sense.tags.through
+        self.editor.delete_object(verb)
+        self.assertEquals([row.tag_id for row in through.objects.all()],
+                          [noun.uid])
+        self.editor.delete_object(self.epo)
+        self.assertEquals(Sense.objects.count(), 0)
+        self.assertEquals(through.objects.count(), 0)
+        self.assertEquals(Tag.objects.count(), 1)
+
+    def test_deletion_cascade_bulk(self):
+        """Cascading deletions are registered with a number of queries that
+        doesn't depend on how many objects are deleted."""
+
+        def language_with_words(code, count):
+            language = LanguageKey(code=code)
+            self.editor.save_object(language)
+            words = [Word(full="%s%d" % (code, i), language=language)
+                     for i in range(count)]
+            self.editor.save_objects(words)
+            self.editor.save_objects([
+                WordConceptConnection(word=word, concept=self.concept)
+                for word in words])
+            return language
+
+        few = language_with_words("few", 2)
+        many = language_with_words("many", 20)
+        with CountQueries() as few_queries:
+            self.editor.delete_object(few)
+        start = Action.objects.latest().id
+        with CountQueries() as many_queries:
+            self.editor.delete_object(many)
+        self.assertEquals(few_queries.count, many_queries.count)
+        self.assertEquals(Word.objects.filter(full__startswith="many")
+                          .count(), 0)
+        self.assertEquals(WordConceptConnection.objects.count(), 2)
+        actions = Action.objects.filter(id__gt=start).order_by("id")
+        self.assertEquals(actions.count(), 41)
+        self.assertEquals(DeletionCommit.objects.filter(
+            action__id__gt=start).count(), 41)
+        # Children are deleted before their parents
+        types = [ContentType.objects.get_for_id(
+                 TimeMachine(a.object_uid).content_type.id).model
+                 for a in actions]
+        self.assertEquals(types, ["wordconceptconnection"] * 20 +
+                                 ["word"] * 20 + ["languagekey"])
+
+    def test_deletion_cascade_signals(self):
+        """Objects deleted by cascading send pre_delete before and
+        post_delete after they are deleted, just like obj.delete()."""
+        words = [Word(full="sig%d" % i, language=self.epo) for i in range(3)]
+        self.editor.save_objects(words)
+        sent = []
+
+        def receiver(signal, sender, instance, **kwargs):
+            exists = sender.objects.filter(pk=instance.pk).exists()
+            sent.append((signal, sender, instance.pk, exists))
+
+        uid = self.epo.uid
+        signals.pre_delete.connect(receiver)
+        signals.post_delete.connect(receiver)
+        try:
+            self.editor.delete_object(self.epo)
+        finally:
+            signals.pre_delete.disconnect(receiver)
+            signals.post_delete.disconnect(receiver)
+        for word in words:
+            self.assertTrue((signals.pre_delete, Word, word.uid, True)
+                            in sent)
+            self.assertTrue((signals.post_delete, Word, word.uid, False)
+                            in sent)
+        self.assertEquals(sent[-1],
+                          (signals.post_delete, LanguageKey, uid, False))
+
     def test_creation_action_undo(self):
         """Test undo of a creation action and the 'is_revertible' preperty
         for creation actions."""
@@ -242,6 +761,256 @@ class GeneralDisciplineTests(TestCase):
         self.editor.undo_action(action)
         self.assertEquals(WordConceptConnection.objects.count(), 2)
 
+    def test_check_revertible(self):
+        """Action.check_revertible agrees with is_revertible, sets
+        undo_errors and runs a number of queries that doesn't depend on how
+        many Actions are checked."""
+
+        def history(code, count):
+            start = Action.objects.latest().id
+            old = LanguageKey(code=code)
+            new = LanguageKey(code=code.upper())
+            self.editor.save_objects([old, new])
+            words = [Word(full="%s%d" % (code, i), language=old)
+                     for i in range(count)]
+            self.editor.save_objects(words)
+            connections = [WordConceptConnection(word=word,
+                                                 concept=self.concept)
+                           for word in words]
+            self.editor.save_objects(connections)
+            self.editor.delete_object(connections[0])
+            for word in words:
+                word.language = new
+            self.editor.save_objects(words)
+            # The modifications can't be undone without the old language
+            self.editor.delete_object(old)
+            return list(Action.objects.filter(id__gt=start))
+
+        few = history("few", 2)
+        many = history("many", 10)
+        # Load the SchemaStates before counting
+        TimeMachine(self.dog.uid)
+        with CountQueries() as few_queries:
+            Action.check_revertible(few)
+        with CountQueries() as many_queries:
+            errors = Action.check_revertible(many)
+        self.assertEquals(few_queries.count, many_queries.count)
+
+        self.assertEquals(sorted(errors.keys()),
+                          sorted(action.id for action in many))
+        for action in many:
+            self.assertEquals(action.undo_errors, errors[action.id])
+            fresh = Action.objects.get(id=action.id)
+            self.assertEquals(fresh.is_revertible, not errors[action.id])
+            self.assertEquals(fresh.undo_errors, errors[action.id])
+        revertible = [action.action_type for action in many
+                      if not errors[action.id]]
+        # The deletions, the creations of the remaining connections and of
+        # the word that lost its connection
+        self.assertEquals(sorted(revertible), ["cr"] * 10 + ["dl"] * 2)
+
+    def test_undo_actions(self):
+        """Editor.undo_actions brings everything back to how it was before
+        the undone actions, whatever order they depend on each other."""
+        start = Action.objects.latest().id
+        before = sorted(Word.objects.values_list("uid", "full", "language"))
+
+        # Vandalism
+        vandal = LanguageKey(code="xxx")
+        self.editor.save_object(vandal)
+        words = list(Word.objects.all())
+        for word in words:
+            word.full = word.full.upper()
+            word.language = vandal
+        self.editor.save_objects(words)
+        spam = [Word(full="spam%d" % i, language=vandal) for i in range(5)]
+        self.editor.save_objects(spam)
+        self.editor.delete_object(self.concept)
+
+        errors = self.editor.undo_actions(
+            Action.objects.filter(id__gt=start))
+        self.assertEquals(errors, [])
+        self.assertEquals(
+            sorted(Word.objects.values_list("uid", "full", "language")),
+            before)
+        self.assertEquals(LanguageKey.objects.filter(code="xxx").count(), 0)
+        self.assertEquals(WordConceptConnection.objects.count(), 2)
+        self.assertEquals(
+            Action.objects.filter(id__gt=start, reverted=None,
+                                  reverts=None).count(), 0)
+        for word in Word.objects.all():
+            self.assertEquals(TimeMachine(word.uid).get("full"), word.full)
+
+    def test_undo_actions_new_fields(self):
+        """Fields the object had no value for before the undone action get
+        their default back instead of keeping their current value."""
+        definition = Definition(text="a pet", word=self.dog,
+                                language=self.eng)
+        self.editor.save_object(definition)
+        # As if the fields were added to the model after the creation
+        ModificationCommit.objects.filter(object_uid=definition.uid,
+                                          key__in=["rank", "example"]).delete()
+        definition.rank = 5
+        definition.example = "Good dog"
+        definition.text = "a loyal pet"
+        self.editor.save_object(definition)
+        modification = Action.objects.latest()
+        self.assertEquals(self.editor.undo_actions([modification]), [])
+        definition = Definition.objects.get(uid=definition.uid)
+        self.assertEquals(definition.text, "a pet")
+        self.assertEquals(definition.rank, 0)
+        self.assertEquals(definition.example, None)
+
+    def test_undo_actions_errors(self):
+        """Actions that can't be undone are left alone and their errors
+        returned, those that can are undone."""
+        creation = CreationCommit.objects.get(object_uid=self.dog.uid).action
+        self.dog.full = "dawg"
+        self.editor.save_object(self.dog)
+        modification = Action.objects.latest()
+        errors = self.editor.undo_actions([creation, modification])
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(errors, creation.undo_errors)
+        self.assertEquals(Word.objects.get(uid=self.dog.uid).full, "dog")
+        self.assertEquals(Action.objects.get(id=creation.id).reverted, None)
+        self.assertEquals(
+            self.editor.undo_actions([modification]),
+            ["Cannot undo action %s: it was already undone"
+             % modification.id])
+
+    def test_rendered_details(self):
+        """Action details are rendered once and stored, but the names of
+        related objects are looked up every time."""
+        cc = self.hundo.concept_connections.all()[0]
+        cc.word = self.dog
+        self.editor.save_object(cc)
+        action = Action.objects.latest()
+        summary = action.summary
+        self.assertTrue("word: Word object -> Word object\n" in summary)
+        self.assertEquals(RenderedAction.objects.filter(
+            action=action).count(), 1)
+        details = action._details()
+
+        action = Action.objects.get(id=action.id)
+        with CountQueries() as queries:
+            self.assertEquals(action._details(), details)
+        # The RenderedAction and the words
+        self.assertEquals(queries.count, 2)
+        self.assertEquals(action.summary, summary)
+
+        self.editor.delete_object(self.hundo)
+        action = Action.objects.get(id=action.id)
+        self.assertTrue("word: (deleted) -> Word object\n" in action.summary)
+        self.assertEquals(RenderedAction.objects.filter(
+            action=action).count(), 1)
+
+    def test_value_cache(self):
+        """Values read by TimeMachines are only decoded once."""
+        value_cache.clear()
+        self.assertEquals(TimeMachine(self.hundo.uid).get("full"), "hundo")
+        self.assertEquals(value_cache.misses, 1)
+        tm = TimeMachine(self.hundo.uid)
+        self.assertEquals(tm.get_many(["full"]), {"full": "hundo"})
+        self.assertEquals(tm.get("full"), "hundo")
+        self.assertEquals((value_cache.hits, value_cache.misses), (2, 1))
+        settings.DISCIPLINE_VALUE_CACHE_SIZE = 0
+        try:
+            self.assertEquals(TimeMachine(self.dog.uid).get("full"), "dog")
+            self.assertEquals((value_cache.hits, value_cache.misses), (2, 1))
+        finally:
+            del settings.DISCIPLINE_VALUE_CACHE_SIZE
+
+    def test_action_index(self):
+        """The step at a time and the time of a step are found without
+        queries once the Actions are known, and new Actions are picked up."""
+        actions = list(Action.objects.order_by("id"))
+        for action in actions:
+            tm = TimeMachine(self.hundo.uid, when=action.when)
+            self.assertEquals(
+                tm.step,
+                Action.objects.filter(when__lte=action.when)[0].id)
+        info = TimeMachine(self.hundo.uid).info
+        with CountQueries() as queries:
+            for action in actions[:-1]:
+                tm = TimeMachine(self.hundo.uid, step=action.id, info=info)
+                self.assertEquals(tm.when, action.when)
+                TimeMachine(self.hundo.uid, when=action.when, info=info)
+        self.assertEquals(queries.count, 0)
+        self.hundo.full = "hundoj"
+        self.editor.save_object(self.hundo)
+        latest = Action.objects.latest()
+        self.assertEquals(TimeMachine(self.hundo.uid, step=latest.id).when,
+                          latest.when)
+        self.assertEquals(
+            TimeMachine(self.hundo.uid,
+                        when=datetime.datetime.now()).step, latest.id)
+        settings.DISCIPLINE_ACTION_INDEX = False
+        try:
+            with CountQueries() as queries:
+                tm = TimeMachine(self.hundo.uid, step=actions[0].id,
+                                 info=info)
+            self.assertEquals(tm.when, actions[0].when)
+            self.assertTrue(queries.count > 0)
+        finally:
+            del settings.DISCIPLINE_ACTION_INDEX
+
+    def test_action_index_gaps(self):
+        """An Action committed after one with a higher id is put in its
+        place. While its id is missing, the database answers for the times
+        after the Action before it, the index for earlier ones."""
+        first = Action.objects.order_by("id")[0]
+        last = Action.objects.latest().id
+        _step_at(datetime.datetime.now())
+        later = Action.objects.create(id = last + 2, editor = self.editor,
+                                      object_uid = self.hundo.uid,
+                                      action_type = "md")
+        self.assertEquals(_step_at(datetime.datetime.now()), later.id)
+        self.assertEquals(_action_index.gaps.keys(), [last + 1])
+        self.assertEquals(_action_index.step_at(later.when), None)
+        with CountQueries() as queries:
+            self.assertEquals(_action_index.step_at(first.when), first.id)
+        self.assertEquals(queries.count, 0)
+        late = Action.objects.create(id = last + 1, editor = self.editor,
+                                     object_uid = self.hundo.uid,
+                                     action_type = "md")
+        # Found without reading every Action again
+        with CountQueries() as queries:
+            self.assertEquals(_action_index.when_of(late.id), late.when)
+        self.assertEquals(queries.count, 1)
+        self.assertEquals(list(_action_index.ids[-3:]),
+                          [last, late.id, later.id])
+        self.assertEquals(_action_index.gaps, {})
+        self.assertEquals(_action_index.step_at(datetime.datetime.now()),
+                          later.id)
+
+    def test_action_index_clear(self):
+        """Clearing the index waits for a thread reading Actions into it."""
+        _action_index.lock.acquire()
+        thread = threading.Thread(target=_action_index.clear)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.isAlive())
+        _action_index.lock.release()
+        thread.join()
+
+    def test_exists_staleness(self):
+        """TimeMachine.exists notices new Actions without counting them."""
+        created_on = CreationCommit.objects.get(
+            object_uid=self.hundo.uid).action.id
+        self.hundo.full = "hundoj"
+        self.editor.save_object(self.hundo)
+        tm = TimeMachine(self.hundo.uid, step=created_on)
+        with CountQueries() as queries:
+            self.assertTrue(tm.exists)
+        for query in connection.queries[-queries.count:]:
+            self.assertFalse("COUNT" in query["sql"].upper())
+        self.assertEquals(tm.deletion_times, ())
+        self.editor.delete_object(self.hundo)
+        self.assertTrue(tm.exists)
+        self.assertEquals(tm.deletion_times,
+                          (Action.objects.latest().id,))
+        self.assertEquals(tm.last_action_id, Action.objects.latest().id)
+
     def test_timemachine_time(self):
         """Test the TimeMachine's 'at' and 'presently' properties."""
         tm = TimeMachine(self.hundo.uid)
@@ -255,6 +1024,59 @@ class GeneralDisciplineTests(TestCase):
         self.editor.undo_action(action)
         self.assertTrue(tm.presently.exists)
 
+    def test_timemachine_shared_information(self):
+        """TimeMachines of the same object share their information, which
+        can't be changed."""
+        tm = TimeMachine(self.hundo.uid)
+        with CountQueries() as queries:
+            previous = tm.at_previous_action
+        self.assertEquals(queries.count, 0)
+        self.assertTrue(previous.info is tm.info)
+        self.assertEquals(previous.content_type,
+                          ContentType.objects.get_for_model(Word))
+        self.assertRaises(AttributeError, setattr, tm.info,
+                          "deletion_times", ())
+        self.assertFalse(hasattr(tm.info, "__dict__"))
+
+    def test_object_history(self):
+        """An ObjectHistory answers like TimeMachines at every step without
+        any more queries."""
+        for i in range(3):
+            self.hundo.full = "hundo%d" % i
+            self.hundo.language = i % 2 and self.epo or self.eng
+            self.editor.save_object(self.hundo)
+        uid = self.hundo.uid
+        self.editor.delete_object(self.hundo)
+        self.editor.undo_action(Action.objects.latest())
+
+        with CountQueries() as queries:
+            history = ObjectHistory(uid)
+        with CountQueries() as short_queries:
+            ObjectHistory(self.dog.uid)
+        self.assertEquals(queries.count, short_queries.count)
+        self.assertEquals(list(history.steps), list(Action.objects.filter(
+            object_uid=uid).order_by("id").values_list("id", flat=True)))
+
+        steps = range(history.steps[0], Action.objects.latest().id + 1)
+        expected = []
+        for step in steps:
+            tm = TimeMachine(uid, step=step)
+            expected.append((tm.exists, tm.get("full"),
+                             tm._get_value("language")))
+        with CountQueries() as queries:
+            for step, (exists, full, language) in zip(steps, expected):
+                self.assertEquals(history.exists(step), exists)
+                self.assertEquals(history.get("full", step), full)
+                self.assertEquals(history.get("language", step), language)
+                self.assertEquals(history.state(step),
+                                  {"full": full, "language": language})
+                tm = history.at(step)
+                self.assertEquals(tm.get("full"), full)
+        self.assertEquals(queries.count, 0)
+        self.assertEquals(history.get("full", history.steps[0] - 1), None)
+        self.assertEquals(history.at(steps[-1]).get_many(),
+                          TimeMachine(uid).get_many())
+
     def test_timemachine_fields(self):
         """Test the TimeMachine's 'get' method."""
         tm = TimeMachine(self.hundo.uid)
@@ -265,6 +1087,58 @@ class GeneralDisciplineTests(TestCase):
         self.assertEquals(tm.get("full"), "hundo")
         self.assertEquals(tm.presently.get("full"), "hundooo")
 
+    def test_timemachine_get_many(self):
+        """Test the TimeMachine's 'get_many' and 'values' methods."""
+        definition = Definition(text="A domestic animal", rank=2,
+                                word=self.dog, language=self.eng)
+        self.editor.save_object(definition)
+        definition.text = "A friend"
+        definition.word = self.hundo
+        self.editor.save_object(definition)
+        tm = TimeMachine(definition.uid)
+        with CountQueries() as queries:
+            values = tm.values()
+        # One query for the values, one for each related model and one
+        # for the Checkpoint if they are enabled
+        self.assertTrue(queries.count <= 4)
+        self.assertEquals(values, dict([(field, tm.get(field)) for field in
+                                        tm.fields + tm.foreignkeys]))
+        self.assertEquals(values["word"], self.hundo)
+        self.assertEquals(tm.at_previous_action.get_many(["text", "word"]),
+                          {"text": "A domestic animal", "word": self.dog})
+        restored = tm.at_previous_action.restore(nosave=True)
+        self.assertEquals(restored.text, "A domestic animal")
+        self.assertEquals(restored.rank, 2)
+        self.assertEquals(restored.word, self.dog)
+
+    def test_timemachine_bulk(self):
+        """TimeMachine.bulk builds many TimeMachines with a constant number
+        of queries."""
+        uids = [self.eng.uid, self.dog.uid]
+        # Load the SchemaStates before counting
+        TimeMachine(self.dog.uid)
+        with CountQueries() as few:
+            TimeMachine.bulk(uids)
+        self.editor.delete_object(self.hundo.concept_connections.all()[0])
+        uids += [self.epo.uid, self.hundo.uid, self.concept.uid]
+        uids += list(WordConceptConnection.objects.values_list("uid",
+                                                               flat=True))
+        with CountQueries() as many:
+            timemachines = TimeMachine.bulk(uids)
+        self.assertEquals(few.count, many.count)
+        self.assertEquals(sorted(timemachines.keys()), sorted(uids))
+        for uid, tm in timemachines.items():
+            single = TimeMachine(uid)
+            self.assertEquals(tm.step, single.step)
+            self.assertEquals(tm.content_type, single.content_type)
+            self.assertEquals(tm.creation_times, single.creation_times)
+            self.assertEquals(tm.deletion_times, single.deletion_times)
+            self.assertEquals(tm.fields, single.fields)
+        step = CreationCommit.objects.get(object_uid=self.dog.uid).action.id
+        past = TimeMachine.bulk(uids, step=step)
+        self.assertTrue(past[self.dog.uid].exists)
+        self.assertFalse(past[self.hundo.uid].exists)
+
     def test_timemachine_get_timemachine_instance(self):
         """Test TimeMachine's 'get_timemachine_instance' method."""
         tm = TimeMachine(self.hundo.uid)
@@ -283,4 +1157,511 @@ class GeneralDisciplineTests(TestCase):
         curact = Action.objects.latest()
         self.assertEquals(curact.id, TimeMachine(hundouid).current_action.id)
 
+    def test_save_object_query_count(self):
+        """The number of queries save_object runs doesn't depend on the
+        number of fields of the model."""
+        rus = LanguageKey(code="rus")
+        definition = Definition(text="A domestic animal",
+                                word=self.dog, language=self.eng)
+        with CountQueries() as narrow:
+            self.editor.save_object(rus)
+        with CountQueries() as wide:
+            self.editor.save_object(definition)
+        self.assertEquals(narrow.count, wide.count)
+        rus.code = "ru"
+        definition.text = "A friend"
+        definition.example = "Good dog!"
+        definition.source = "Wiktionary"
+        definition.rank = 3
+        definition.approved = True
+        definition.added = datetime.date(2010, 7, 4)
+        definition.word = self.hundo
+        definition.language = self.epo
+        with CountQueries() as narrow:
+            self.editor.save_object(rus)
+        with CountQueries() as wide:
+            self.editor.save_object(definition)
+        self.assertEquals(narrow.count, wide.count)
+        self.assertEquals(Action.objects.latest().modification_commits.count(), 8)
+
+    def test_save_object_foreignkey_change(self):
+        """ForeignKeys are compared by uid and stored as uids."""
+        self.hundo.language = self.eng
+        self.editor.save_object(self.hundo)
+        lastact = Action.objects.latest()
+        self.assertEquals(lastact.action_type, "md")
+        self.assertEquals([(c.key, c.value) for c in
+                           lastact.modification_commits.all()],
+                          [("language", self.eng.uid)])
+        # Saving again without changes doesn't create an Action
+        self.editor.save_object(self.hundo)
+        self.assertEquals(Action.objects.latest(), lastact)
+
+
+    def test_async_history_in_memory(self):
+        """A thread of its own can't reach an in-memory SQLite database,
+        so the history is written right away."""
+        settings.DISCIPLINE_ASYNC_HISTORY = True
+        try:
+            self.dog.full = "doge"
+            actions = self.editor.save_objects([self.dog])
+            flush_history()
+        finally:
+            settings.DISCIPLINE_ASYNC_HISTORY = False
+        self.assertEquals(actions, [Action.objects.latest()])
+        self.assertEquals(TimeMachine(self.dog.uid).get("full"), "doge")
+
+    def test_export_import(self):
+        """The exported history is imported as it was, continuing after the
+        Actions already in the database."""
+        cut = Action.objects.latest().id
+        self.dog.full = "doge"
+        self.editor.save_object(self.dog)
+        self.editor.undo_action(Action.objects.latest())
+        hundo = self.hundo.uid
+        self.editor.delete_object(self.hundo)
+
+        def history():
+            return [list(Action.objects.order_by("id").values_list("id",
+                        "editor", "when", "object_uid", "action_type",
+                        "content_type", "reverted"))] + \
+                   [list(model.objects.order_by("action", "id")
+                         .values_list(*fields)) for model, fields in (
+                        (CreationCommit, ("action", "object_uid",
+                                          "content_type")),
+                        (DeletionCommit, ("action", "object_uid")),
+                        (ModificationCommit, ("action", "object_uid", "key",
+                                              "value")))]
+        before = history()
+        fd, path = tempfile.mkstemp(suffix = ".jsonl.gz")
+        os.close(fd)
+        try:
+            call_command("discipline_export", path, quiet=True)
+            Action.objects.filter(id__gt = cut).delete()
+            self.assertNotEquals(history(), before)
+            call_command("discipline_import", path, quiet=True)
+            self.assertEquals(history(), before)
+            # Everything is there already
+            call_command("discipline_import", path, quiet=True)
+            self.assertEquals(history(), before)
+        finally:
+            os.remove(path)
+        self.assertEquals(TimeMachine(self.dog.uid).get("full"), "dog")
+        self.assertFalse(TimeMachine(hundo).exists)
+
+    def test_instrumentation(self):
+        """Operations are only recorded with DISCIPLINE_INSTRUMENTATION on,
+        with the same queries the debug cursor sees."""
+        stats.reset()
+        self.dog.full = "doge"
+        self.editor.save_object(self.dog)
+        self.assertEquals(stats.as_dict(), {})
+
+        finished = []
+        def receiver(sender, **kwargs):
+            finished.append((sender, kwargs["queries"]))
+        operation_finished.connect(receiver)
+        settings.DISCIPLINE_INSTRUMENTATION = True
+        try:
+            self.dog.full = "doggy"
+            with CountQueries() as queries:
+                self.editor.save_object(self.dog)
+            TimeMachine(self.dog.uid).get("full")
+            # Only the queries of operations go through the wrapper
+            self.assertFalse(isinstance(connection.cursor(),
+                                        _CountingCursor))
+        finally:
+            settings.DISCIPLINE_INSTRUMENTATION = False
+            operation_finished.disconnect(receiver)
+        wrapped = connection.cursor
+        TimeMachine(self.dog.uid)
+        self.assertNotEqual(connection.cursor, wrapped)
+        self.assertEquals(connection._discipline_cursor, None)
+        operations = stats.as_dict()
+        self.assertEquals(operations["Editor.save_object"]["calls"], 1)
+        self.assertEquals(operations["Editor.save_object"]["queries"],
+                          queries.count)
+        # Nested operations count towards both
+        self.assertEquals(operations["Editor.save_objects"]["queries"],
+                          queries.count)
+        self.assertEquals(operations["TimeMachine.__init__"]["calls"], 1)
+        self.assertEquals(operations["TimeMachine.get"]["calls"], 1)
+        self.assertTrue(("Editor.save_object", queries.count) in finished)
+        self.assertEquals(len(finished), 4)
+        # Decorated admin columns still render html
+        self.assertTrue(Action._description.allow_tags)
+
+class ObjectStateTests(GeneralDisciplineTests):
+    """Run the general tests again while maintaining ObjectStates."""
+
+    def setUp(self):
+        settings.DISCIPLINE_OBJECT_STATE = True
+        super(ObjectStateTests, self).setUp()
+
+    def tearDown(self):
+        settings.DISCIPLINE_OBJECT_STATE = False
+
+    def test_object_state_maintained(self):
+        """Saving, deleting and undoing keep the ObjectState current."""
+        state = ObjectState.objects.get(object_uid=self.hundo.uid)
+        self.assertTrue(state.exists)
+        self.assertEquals(state.content_type,
+                          ContentType.objects.get_for_model(Word))
+        self.assertEquals(state.get_values()["language"], self.epo.uid)
+        self.hundo.full = "hundoj"
+        self.editor.save_object(self.hundo)
+        state = ObjectState.objects.get(object_uid=self.hundo.uid)
+        self.assertEquals(state.step, Action.objects.latest().id)
+        self.assertEquals(state.get_values()["full"], "~shundoj")
+        uid = self.hundo.uid
+        self.editor.delete_object(self.hundo)
+        self.assertFalse(ObjectState.objects.get(object_uid=uid).exists)
+        self.editor.undo_action(Action.objects.latest())
+        self.assertTrue(ObjectState.objects.get(object_uid=uid).exists)
+
+    def test_object_state_present_lookup(self):
+        """Questions about the present are answered by the ObjectState with
+        a single query."""
+        for i in range(5):
+            self.hundo.full = "hundo%d" % i
+            self.editor.save_object(self.hundo)
+        tm = TimeMachine(self.hundo.uid)
+        with CountQueries() as queries:
+            self.assertTrue(tm.exists)
+            self.assertEquals(tm.get("full"), "hundo4")
+        self.assertEquals(queries.count, 1)
+        # The past still comes from history
+        self.assertEquals(tm.at(tm.step - 1).get("full"), "hundo3")
+
+    def test_object_state_behind(self):
+        """An ObjectState that missed Actions done while the setting was off
+        is ignored, and deleting the object doesn't make it look current."""
+        settings.DISCIPLINE_OBJECT_STATE = False
+        self.hundo.full = "hundoj"
+        self.editor.save_object(self.hundo)
+        settings.DISCIPLINE_OBJECT_STATE = True
+        tm = TimeMachine(self.hundo.uid)
+        self.assertEquals(tm.get("full"), "hundoj")
+        # Nothing changed since the missed save
+        self.assertEquals(self.editor.save_objects([self.hundo]), [])
+        uid = self.hundo.uid
+        self.editor.delete_object(self.hundo)
+        state = ObjectState.objects.get(object_uid=uid)
+        self.assertTrue(state.exists)
+        self.assertFalse(TimeMachine(uid).exists)
+        self.assertEquals(TimeMachine(uid).get("full"), "hundoj")
+
+    def test_object_state_rebuild(self):
+        """The management command recreates missing ObjectStates."""
+        ObjectState.objects.all().delete()
+        call_command("discipline_object_state", quiet=True)
+        self.assertEquals(ObjectState.objects.count(), 7)
+        state = ObjectState.objects.get(object_uid=self.dog.uid)
+        self.assertEquals(state.get_values()["full"], "~sdog")
+
+
+class CheckpointTests(GeneralDisciplineTests):
+    """Run the general tests again with frequent Checkpoints."""
+
+    def setUp(self):
+        settings.DISCIPLINE_CHECKPOINT_INTERVAL = 2
+        super(CheckpointTests, self).setUp()
+
+    def tearDown(self):
+        settings.DISCIPLINE_CHECKPOINT_INTERVAL = None
+
+    def test_checkpoint_interval(self):
+        """A Checkpoint is created every second Action on an object and
+        TimeMachines in between read it plus the newer modcommits."""
+        steps = []
+        for i in range(4):
+            self.hundo.full = "hundo%d" % i
+            self.editor.save_object(self.hundo)
+            steps.append(Action.objects.latest().id)
+        checkpoints = Checkpoint.objects.filter(object_uid=self.hundo.uid)
+        self.assertEquals([c.action_id for c in checkpoints.order_by("id")],
+                          [steps[0], steps[2]])
+        tm = TimeMachine(self.hundo.uid)
+        for i, step in enumerate(steps):
+            self.assertEquals(tm.at(step).get("full"), "hundo%d" % i)
+            self.assertEquals(tm.at(step).get("language"), self.epo)
+
+    def test_checkpoint_command(self):
+        """The management command fills in Checkpoints for history
+        recorded without them."""
+        settings.DISCIPLINE_CHECKPOINT_INTERVAL = None
+        for i in range(5):
+            self.dog.full = "dog%d" % i
+            self.editor.save_object(self.dog)
+        Checkpoint.objects.all().delete()
+        call_command("discipline_checkpoint", interval=3, quiet=True)
+        steps = list(Action.objects.filter(object_uid=self.dog.uid)
+                     .order_by("id").values_list("id", flat=True))
+        self.assertEquals(
+            list(Checkpoint.objects.filter(object_uid=self.dog.uid)
+                 .order_by("id").values_list("action", flat=True)),
+            [steps[2], steps[5]])
+        settings.DISCIPLINE_CHECKPOINT_INTERVAL = 0
+        tm = TimeMachine(self.dog.uid)
+        self.assertEquals(tm.at(steps[4]).get("full"), "dog3")
+        checkpoint = tm.at(steps[4]).checkpoint()
+        self.assertEquals(checkpoint.action_id, steps[4])
+
+
+class QueryPlanTest(TransactionTestCase):
+    """The queries Discipline runs most use an index on SQLite, without
+    sorting the rows in a temporary b-tree. (EXPLAIN commits the
+    transaction of the sqlite3 module, so every test starts over.)"""
+
+    def setUp(self):
+        _action_index.clear()
+        call_command("discipline_migrate", quiet=True)
+        john = User.objects.create(username="johndoe")
+        self.editor = Editor.objects.create(user=john)
+        self.eng = LanguageKey(code="eng")
+        self.editor.save_object(self.eng)
+        self.word = Word(full="dog", language=self.eng)
+        self.editor.save_object(self.word)
+        self.step = Action.objects.latest().id
+
+    def explain(self, queryset):
+        """Return the details of the query plan of the given QuerySet."""
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, queryset, search=None):
+        """Check that the QuerySet only searches indexes, without scanning
+        a whole table or index or sorting in a temporary b-tree. If search
+        is given, one of the steps of the plan has to contain it."""
+        if "sqlite" not in connection.settings_dict["ENGINE"]: return
+        plan = self.explain(queryset)
+        for step in plan:
+            self.assertFalse(step.startswith("SCAN"), plan)
+            self.assertFalse("TEMP B-TREE" in step, plan)
+        if search is not None:
+            self.assertTrue([step for step in plan if search in step], plan)
+
+    def test_modcommit(self):
+        """The last value of a field at a step, TimeMachine._get_modcommit"""
+        self.assertIndexed(_by_action(ModificationCommit.objects.filter(
+            object_uid=self.word.uid, key="full",
+            action__id__lte=self.step))[:1],
+            "(object_uid=? AND key=? AND action_id<?)")
+
+    def test_latest_commits(self):
+        """The last values of every field at a step"""
+        self.assertIndexed(_latest_commits_query([self.word.uid], self.step),
+                           "USING COVERING INDEX")
+        self.assertIndexed(_latest_commits_query([self.word.uid], self.step,
+                                                 after=1),
+                           "USING COVERING INDEX")
+
+    def test_checkpoint(self):
+        """The last Checkpoint at a step"""
+        self.assertIndexed(_by_action(Checkpoint.objects.filter(
+            object_uid=self.word.uid, action__id__lte=self.step))[:1],
+            "(object_uid=? AND action_id<?)")
+
+    def test_object_information(self):
+        """The creations and deletions of objects, _object_information"""
+        self.assertIndexed(CreationCommit.objects.filter(
+            object_uid__in=[self.word.uid])
+            .values_list("object_uid", "action", "content_type"),
+            "USING COVERING INDEX")
+        self.assertIndexed(DeletionCommit.objects.filter(
+            object_uid__in=[self.word.uid])
+            .values_list("object_uid", "action"),
+            "USING COVERING INDEX")
+        self.assertIndexed(_by_action(DeletionCommit.objects.filter(
+            object_uid=self.word.uid))[:1],
+            "(object_uid=?)")
+
+    def test_object_actions(self):
+        """The Actions on an object, ObjectHistory"""
+        self.assertIndexed(Action.objects.filter(object_uid=self.word.uid)
+                           .order_by("id").values_list("id", flat=True),
+                           "(object_uid=?)")
+        self.assertIndexed(Action.objects.filter(object_uid=self.word.uid)
+                           .order_by("-id")[:1],
+                           "(object_uid=?)")
+
+    def test_model_actions(self):
+        """The latest Actions on a model, like the filtered admin list"""
+        self.assertIndexed(Action.objects.for_model(Word)[:50],
+                           "(content_type_id=?)")
+
+
+class BatchTransactionTest(TransactionTestCase):
+
+    def test_batch_rollback(self):
+        """If a batch raises an exception, nothing is saved."""
+        call_command("discipline_migrate", quiet=True)
+        john = User.objects.create(username="johndoe")
+        editor = Editor.objects.create(user=john)
+        eng = LanguageKey(code="eng")
+        editor.save_object(eng)
+        actions = Action.objects.count()
+        try:
+            with editor.batch():
+                editor.save_object(LanguageKey(code="epo"))
+                editor.save_object(Word(full="dog", language=eng))
+                eng.code = "en"
+                editor.save_object(eng)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(Action.objects.count(), actions)
+        self.assertEquals(LanguageKey.objects.count(), 1)
+        self.assertEquals(Word.objects.count(), 0)
+        self.assertEquals(LanguageKey.objects.get(uid=eng.uid).code, "eng")
+        with editor.batch():
+            editor.save_object(LanguageKey(code="epo"))
+        self.assertEquals(Action.objects.count(), actions + 1)
+
+    def test_batch_rollback_action_index(self):
+        """The Action index forgets the Actions of a batch rolled back,
+        whose ids are used again."""
+        call_command("discipline_migrate", quiet=True)
+        john = User.objects.create(username="johndoe")
+        editor = Editor.objects.create(user=john)
+        eng = LanguageKey(code="eng")
+        editor.save_object(eng)
+        try:
+            with editor.batch():
+                epo = LanguageKey(code="epo")
+                editor.save_object(epo)
+                # Writes the deferred history
+                editor.delete_object(epo)
+                rolled_back = Action.objects.latest().id
+                TimeMachine(eng.uid, step=rolled_back)
+                raise ValueError
+        except ValueError:
+            pass
+        deu = LanguageKey(code="deu")
+        editor.save_object(deu)
+        editor.save_object(LanguageKey(code="fra"))
+        self.assertEquals(Action.objects.latest().id, rolled_back)
+        self.assertEquals(TimeMachine(deu.uid, step=rolled_back).when,
+                          Action.objects.get(id=rolled_back).when)
+
+
+class AsyncHistoryTest(TransactionTestCase):
+    """The history written in the background. The thread writing it can't
+    reach the in-memory test database, so the tests run on a copy of it in
+    a file."""
+
+    def setUp(self):
+        _action_index.clear()
+        call_command("discipline_migrate", quiet=True)
+        fd, self.path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        copy = sqlite3.connect(self.path)
+        copy.executescript("\n".join(connection.connection.iterdump()))
+        copy.close()
+        self.memory = connection.connection
+        connection.connection = None
+        connection.settings_dict["NAME"] = self.path
+        settings.DISCIPLINE_ASYNC_HISTORY = True
+
+        john = User.objects.create(username="johndoe")
+        self.editor = Editor.objects.create(user=john)
+        self.eng = LanguageKey(code="eng")
+        self.editor.save_object(self.eng)
+        flush_history()
+
+    def tearDown(self):
+        settings.DISCIPLINE_ASYNC_HISTORY = False
+        flush_history()
+        connection.close()
+        connection.settings_dict["NAME"] = ":memory:"
+        connection.connection = self.memory
+        os.remove(self.path)
+        _action_index.clear()
+
+    def test_save_objects(self):
+        """Objects are saved right away and their history is written in
+        the order they were saved."""
+        dog = Word(full="dog", language=self.eng)
+        self.assertEquals(self.editor.save_objects([dog]), [])
+        self.assertEquals(Word.objects.get(uid=dog.uid).full, "dog")
+        for full in ("doge", "doggy", "hound"):
+            dog.full = full
+            self.editor.save_object(dog)
+        # Changed after saving, the history has the saved value
+        dog.full = "cat"
+        flush_history()
+        actions = Action.objects.filter(object_uid=dog.uid).order_by("id")
+        self.assertEquals([a.action_type for a in actions],
+                          ["cr", "md", "md", "md"])
+        self.assertEquals([TimeMachine(dog.uid, step=a.id).get("full")
+                           for a in actions],
+                          ["dog", "doge", "doggy", "hound"])
+        self.assertEquals(TimeMachine(dog.uid).get("language").uid,
+                          self.eng.uid)
+        # Deleting writes what is still queued first
+        dog.full = "hound dog"
+        self.editor.save_object(dog)
+        uid = dog.uid
+        self.editor.delete_object(dog)
+        self.assertEquals([a.action_type for a in Action.objects.filter(
+            object_uid=uid).order_by("id")][-2:], ["md", "dl"])
+
+    def test_errors(self):
+        """A write that fails is reported to the thread that saved the
+        object, not to the others."""
+        # Actions can't be written without an editor
+        nobody = Editor()
+        epo = LanguageKey(code="epo")
+        nobody.save_objects([epo])
+        errors = []
+        def other():
+            try:
+                flush_history()
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target = other)
+        logger = logging.getLogger("discipline")
+        logger.disabled = True
+        try:
+            thread.start()
+            thread.join()
+            self.assertEquals(errors, [])
+            self.assertRaises(Exception, flush_history)
+        finally:
+            logger.disabled = False
+        self.assertEquals(Action.objects.filter(object_uid=epo.uid).count(), 0)
+        flush_history()
+
+    def test_connection(self):
+        """The writer's thread closes its connection once it has nothing
+        left to do, and after an error, so a dropped connection doesn't
+        fail later writes."""
+        # Each thread has a connection of its own, look at the writer's one
+        opened = []
+        def query():
+            Action.objects.count()
+            opened.append(connection.connection)
+        _history_writer.submit(query)
+        flush_history()
+        _history_writer.submit(lambda: opened.append(connection.connection))
+        flush_history()
+        self.assertTrue(opened[0] is not None)
+        self.assertEquals(opened[1:], [None])
+        # The database drops the connection behind Django's back
+        def drop():
+            Action.objects.count()
+            connection.connection.close()
+            Action.objects.count()
+        _history_writer.submit(drop)
+        epo = LanguageKey(code="epo")
+        self.editor.save_object(epo)
+        logger = logging.getLogger("discipline")
+        logger.disabled = True
+        try:
+            self.assertRaises(Exception, flush_history)
+        finally:
+            logger.disabled = False
+        self.assertEquals(Action.objects.filter(object_uid=epo.uid).count(), 1)
 